@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import psycopg
+
+import fake_telegram
+
+# =================================================================
+# بنچمارک آفلاین ربات لایتنر
+# =================================================================
+# Application واقعی (build_application در main.py) را روی یک Bot API جعلی محلی و یک
+# PostgreSQL محلی اجرا می‌کند و سه مرحله را اندازه می‌گیرد:
+#   notes:  هر کاربر /start و چند یادداشت می‌فرستد
+#   taps:   هر کاربر دکمه‌های مرور را می‌زند
+#   daily:  همه کاربران سررسید می‌شوند، یک tick زمان‌بند (run_review_scheduler) و تخلیه کامل صف ارسال
+# برای هر مرحله p50/p99 زمان پردازش هر آپدیت، تعداد آپدیت در ثانیه و تعداد کوئری به ازای هر آپدیت گزارش می‌شود.
+#
+# مثال:
+#   DATABASE_URL=postgresql://localhost/leitner_bench python bench.py --users 200 --notes 10 --taps 10
+# کاربران بنچمارک از --first-user-id شروع می‌شوند و داده‌هایشان در ابتدای هر اجرا پاک می‌شود؛
+# با این حال بهتر است از یک دیتابیس جدا استفاده شود.
+
+FAKE_API_PORT = 18081
+WEBHOOK_PORT = 18443
+WEBHOOK_SECRET = "bench-secret"
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class QueryCounter:
+    # شمارش کوئری‌ها روی همه کرسرهای async پسیکوپگ (شامل conn.execute)
+    def __init__(self):
+        self.count = 0
+        self.original_execute = psycopg.AsyncCursor.execute
+        self.original_executemany = psycopg.AsyncCursor.executemany
+
+    def install(self) -> None:
+        counter = self
+
+        async def execute(cursor, *args, **kwargs):
+            counter.count += 1
+            return await counter.original_execute(cursor, *args, **kwargs)
+
+        async def executemany(cursor, *args, **kwargs):
+            counter.count += 1
+            return await counter.original_executemany(cursor, *args, **kwargs)
+
+        psycopg.AsyncCursor.execute = execute
+        psycopg.AsyncCursor.executemany = executemany
+
+    def uninstall(self) -> None:
+        psycopg.AsyncCursor.execute = self.original_execute
+        psycopg.AsyncCursor.executemany = self.original_executemany
+
+
+class UpdateTimer:
+    # زمان پردازش هر آپدیت (از شروع اولین handler تا پایان) و به تفکیک handler
+    def __init__(self, application):
+        self.processed = 0
+        self.latencies: list[float] = []
+        self.by_handler: dict[str, list[float]] = {}
+        self.wrap_process_update(application)
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if hasattr(handler, "callback"):
+                    handler.callback = self.wrap_callback(handler.callback)
+
+    def wrap_process_update(self, application) -> None:
+        original = application.process_update
+
+        async def process_update(update):
+            started = time.perf_counter()
+            try:
+                await original(update)
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+                self.processed += 1
+
+        application.process_update = process_update
+
+    def wrap_callback(self, callback):
+        name = callback.__name__
+
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.by_handler.setdefault(name, []).append(time.perf_counter() - started)
+
+        timed.__name__ = name
+        return timed
+
+    def reset(self) -> None:
+        self.processed = 0
+        self.latencies = []
+        self.by_handler = {}
+
+
+class Bench:
+    def __init__(self, args, main, fake: fake_telegram.FakeTelegram):
+        self.args = args
+        self.main = main
+        self.fake = fake
+        self.queries = QueryCounter()
+        self.report: list[str] = []
+        self.user_ids = range(args.first_user_id, args.first_user_id + args.users)
+        self.webhook_url = f"http://127.0.0.1:{WEBHOOK_PORT}/bench"
+
+    def log(self, line: str = "") -> None:
+        print(line, flush=True)
+        self.report.append(line)
+
+    async def reset_bench_users(self) -> None:
+        first, last = self.user_ids.start, self.user_ids.stop - 1
+        async with self.main.db_pool.connection() as conn:
+            for table in ("outbox", "settings", "messages", "messages_archive",
+                          "review_events", "review_stats_daily", "review_stats_users", "users"):
+                await conn.execute(f"DELETE FROM {table} WHERE user_id BETWEEN %s AND %s", (first, last))
+
+    def dropped_updates(self) -> int:
+        # آپدیت‌های تکراری یا اضافه بر سقف صف هر کاربر هیچ‌وقت به handler نمی‌رسند.
+        return int(sum(
+            sample.value for metric in self.main.updates_dropped.collect()
+            for sample in metric.samples if sample.name.endswith("_total")
+        ))
+
+    async def run_updates_phase(self, name: str, updates: list[dict], timer: UpdateTimer) -> None:
+        timer.reset()
+        self.queries.count = 0
+        calls_before = len(self.fake.calls)
+        dropped_before = self.dropped_updates()
+        started = time.perf_counter()
+        await fake_telegram.post_updates(self.webhook_url, updates, WEBHOOK_SECRET, self.args.concurrency)
+        deadline = time.monotonic() + self.args.timeout
+        while (timer.processed + self.dropped_updates() - dropped_before < len(updates)
+               and time.monotonic() < deadline):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        # نوشتن‌های تجمیعی آخرین آپدیت‌ها هم باید در شمارش کوئری‌ها بیایند.
+        await asyncio.sleep(self.main.WRITE_BATCH_MAX_DELAY * 2)
+
+        self.log(f"[{name}] {timer.processed}/{len(updates)} updates in {elapsed:.2f}s "
+                 f"({timer.processed / elapsed:.1f} updates/s, {self.dropped_updates() - dropped_before} dropped)")
+        self.log(f"[{name}] update latency p50 {percentile(timer.latencies, 0.5) * 1000:.1f}ms, "
+                 f"p99 {percentile(timer.latencies, 0.99) * 1000:.1f}ms")
+        self.log(f"[{name}] DB queries per update: {self.queries.count / max(len(updates), 1):.2f} "
+                 f"({self.queries.count} total), Bot API calls: {len(self.fake.calls) - calls_before}")
+        for handler, latencies in sorted(timer.by_handler.items()):
+            self.log(f"[{name}]   {handler}: n={len(latencies)}, p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+                     f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+    async def run_daily_phase(self) -> None:
+        first, last = self.user_ids.start, self.user_ids.stop - 1
+        async with self.main.db_pool.connection() as conn:
+            await conn.execute(
+                "UPDATE messages SET next_review_at = now() WHERE user_id BETWEEN %s AND %s", (first, last)
+            )
+            await conn.execute(
+                "UPDATE users SET next_delivery_at = now() WHERE user_id BETWEEN %s AND %s", (first, last)
+            )
+        self.queries.count = 0
+        calls_before = len(self.fake.calls)
+        started = time.perf_counter()
+        await self.main.run_review_scheduler(None)
+        enqueued_at = time.perf_counter()
+
+        deadline = time.monotonic() + self.args.timeout
+        pending = None
+        while time.monotonic() < deadline:
+            async with self.main.db_pool.connection() as conn:
+                cursor = await conn.execute(
+                    "SELECT count(*) FROM outbox WHERE user_id BETWEEN %s AND %s", (first, last)
+                )
+                pending = (await cursor.fetchone())[0]
+            if pending == 0:
+                break
+            await asyncio.sleep(0.1)
+        finished = time.perf_counter()
+
+        self.log(f"[daily] enqueue {enqueued_at - started:.2f}s, delivery {finished - enqueued_at:.2f}s, "
+                 f"total wall time {finished - started:.2f}s ({pending} items left in outbox)")
+        self.log(f"[daily] DB queries: {self.queries.count}, Bot API calls: {len(self.fake.calls) - calls_before}")
+
+    async def run(self) -> None:
+        application = self.main.build_application()
+        # جاب‌های زمان‌بندی‌شده در وسط بنچمارک اجرا نشوند؛ مرحله daily خودش زمان‌بند را صدا می‌زند.
+        for job in application.job_queue.jobs():
+            job.schedule_removal()
+        timer = UpdateTimer(application)
+        self.queries.install()
+        try:
+            async with application:
+                await application.post_init(application)
+                await application.updater.start_webhook(
+                    listen="127.0.0.1", port=WEBHOOK_PORT, url_path="bench",
+                    webhook_url=self.webhook_url, secret_token=WEBHOOK_SECRET,
+                )
+                await application.start()
+                try:
+                    await self.reset_bench_users()
+                    await self.run_phases(timer)
+                finally:
+                    await application.updater.stop()
+                    await application.stop()
+                    await application.post_shutdown(application)
+        finally:
+            self.queries.uninstall()
+
+    async def run_phases(self, timer: UpdateTimer) -> None:
+        args = self.args
+        self.log(f"Users: {args.users}, notes/user: {args.notes}, taps/user: {args.taps}, "
+                 f"injected 429 rate: {args.retry_after_rate}, injected 400 rate: {args.bad_request_rate}")
+
+        notes = []
+        for note in range(args.notes):
+            for user_id in self.user_ids:
+                if note == 0:
+                    notes.append(fake_telegram.message_update(user_id, 1, "/start"))
+                notes.append(fake_telegram.message_update(user_id, 100 + note, f"note {note} from {user_id}"))
+        await self.run_updates_phase("notes", notes, timer)
+
+        taps = []
+        for _ in range(args.taps):
+            for user_id in self.user_ids:
+                note = random.randrange(max(args.notes, 1))
+                action = random.choice(["up", "up", "reset"])
+                taps.append(fake_telegram.callback_update(user_id, f"leitner_{action}_{100 + note}"))
+        await self.run_updates_phase("taps", taps, timer)
+
+        await self.run_daily_phase()
+        self.log(f"Injected errors: {self.fake.injected}")
+
+
+async def run_bench(args) -> list[str]:
+    fake = fake_telegram.FakeTelegram(args.retry_after_rate, args.bad_request_rate, args.retry_after)
+    server = fake_telegram.make_bot_api_app(fake).listen(FAKE_API_PORT, address="127.0.0.1")
+
+    # main تنظیماتش را هنگام import از متغیرهای محیطی می‌خواند.
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ["BOT_API_BASE_URL"] = f"http://127.0.0.1:{FAKE_API_PORT}/bot"
+    os.environ["RUN_MODE"] = "all"
+    import main as leitner
+
+    bench = Bench(args, leitner, fake)
+    try:
+        await bench.run()
+    finally:
+        server.stop()
+    return bench.report
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test for the Leitner bot.")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--notes", type=int, default=5, help="Notes sent by each user.")
+    parser.add_argument("--taps", type=int, default=5, help="Review button taps by each user.")
+    parser.add_argument("--first-user-id", type=int, default=900_000_000)
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent webhook POSTs.")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="Share of sends answered with 429.")
+    parser.add_argument("--bad-request-rate", type=float, default=0.0, help="Share of sends answered with 400.")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in injected 429s.")
+    parser.add_argument("--timeout", type=float, default=300, help="Max seconds to wait for each phase.")
+    parser.add_argument("--output", help="Also write the report to this file (e.g. bench_output.txt).")
+    args = parser.parse_args()
+
+    if not os.environ.get("DATABASE_URL"):
+        parser.error("DATABASE_URL must point to a local PostgreSQL database.")
+
+    report = asyncio.run(run_bench(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write("\n".join(report) + "\n")
+
+if __name__ == "__main__":
+    main()
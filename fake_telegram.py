@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+import httpx
+from tornado.web import Application as TornadoApplication, RequestHandler
+
+# =================================================================
+# جایگزین محلی Bot API تلگرام برای تست و بنچمارک
+# =================================================================
+# دو کار انجام می‌دهد:
+#   serve: یک Bot API جعلی که ربات با BOT_API_BASE_URL=http://127.0.0.1:8081/bot به آن وصل می‌شود
+#          و همه فراخوانی‌ها را ثبت می‌کند.
+#   send:  آپدیت‌های ساختگی (یادداشت جدید و ضربه دکمه‌های مرور) را به webhook ربات POST می‌کند.
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger("fake_telegram")
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Leitner", "username": "fake_leitner_bot"}
+
+
+# متدهای ارسالی که خطای ساختگی روی آن‌ها تزریق می‌شود
+SEND_METHODS = {"sendmessage", "copymessage", "forwardmessage", "copymessages", "forwardmessages"}
+
+
+class FakeTelegram:
+    def __init__(self, retry_after_rate: float = 0.0, bad_request_rate: float = 0.0, retry_after: int = 1):
+        self.calls: list[tuple[float, str, dict]] = []
+        self.message_ids = itertools.count(1_000_000)
+        self.retry_after_rate = retry_after_rate
+        self.bad_request_rate = bad_request_rate
+        self.retry_after = retry_after
+        self.injected = {"retry_after": 0, "bad_request": 0}
+
+    def chat(self, chat_id) -> dict:
+        return {"id": int(chat_id), "type": "private", "first_name": f"user{chat_id}"}
+
+    def message(self, chat_id, **extra) -> dict:
+        return {"message_id": next(self.message_ids), "date": int(time.time()), "chat": self.chat(chat_id), **extra}
+
+    def handle(self, method: str, params: dict):
+        # خروجی: (کد HTTP، بدنه پاسخ)
+        self.calls.append((time.monotonic(), method, params))
+        method = method.lower()
+        if method in SEND_METHODS:
+            roll = random.random()
+            if roll < self.retry_after_rate:
+                self.injected["retry_after"] += 1
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            if roll < self.retry_after_rate + self.bad_request_rate:
+                self.injected["bad_request"] += 1
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: message to copy not found"}
+        if method == "getme":
+            result = BOT_USER
+        elif method == "getupdates":
+            result = []
+        elif method in ("setwebhook", "deletewebhook", "answercallbackquery", "deletemessage", "deletemessages"):
+            result = True
+        elif method == "copymessage":
+            result = {"message_id": next(self.message_ids)}
+        elif method == "copymessages":
+            result = [{"message_id": next(self.message_ids)} for _ in json.loads(params["message_ids"])]
+        elif method == "forwardmessages":
+            result = [{"message_id": next(self.message_ids)} for _ in json.loads(params["message_ids"])]
+        elif method == "sendmessage":
+            result = self.message(params["chat_id"], text=params.get("text", ""), **{"from": BOT_USER})
+        elif method == "forwardmessage":
+            result = self.message(params["chat_id"], text="forwarded")
+        elif method in ("editmessagetext", "editmessagecaption", "editmessagereplymarkup"):
+            result = self.message(params.get("chat_id", 0), text=params.get("text", ""))
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def calls_by_method(self) -> dict:
+        counts: dict[str, int] = {}
+        for _, method, _ in self.calls:
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+
+class BotApiHandler(RequestHandler):
+    def initialize(self, fake: FakeTelegram):
+        self.fake = fake
+
+    async def post(self, token: str, method: str):
+        if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+            params = json.loads(self.request.body)
+        else:
+            params = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+        status, body = self.fake.handle(method, params)
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(body))
+
+    get = post
+
+
+def make_bot_api_app(fake: FakeTelegram) -> TornadoApplication:
+    return TornadoApplication([(r"/bot([^/]+)/(\w+)", BotApiHandler, {"fake": fake})])
+
+
+# =================================================================
+# ساخت و ارسال آپدیت‌های ساختگی به webhook
+# =================================================================
+
+update_ids = itertools.count(1)
+
+def user_payload(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+def message_update(user_id: int, message_id: int, text: str) -> dict:
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+        "from": user_payload(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(update_ids), "message": message}
+
+def callback_update(user_id: int, data: str, text: str = "note") -> dict:
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": random.randint(1, 10**9),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+                "from": BOT_USER,
+                "text": text,
+            },
+        },
+    }
+
+def simulated_updates(users: int, notes: int, taps: int, first_user_id: int = 10_000) -> list[dict]:
+    updates = []
+    for user_id in range(first_user_id, first_user_id + users):
+        updates.append(message_update(user_id, 1, "/start"))
+        for note in range(notes):
+            updates.append(message_update(user_id, 100 + note, f"note {note} from {user_id}"))
+        for _ in range(taps):
+            note = random.randrange(max(notes, 1))
+            action = random.choice(["up", "up", "reset"])
+            updates.append(callback_update(user_id, f"leitner_{action}_{100 + note}"))
+    return updates
+
+async def post_updates(webhook_url: str, updates: list[dict], secret: str | None = None, concurrency: int = 20) -> list[float]:
+    # خروجی: زمان پاسخ webhook برای هر آپدیت (ثانیه)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def send(update: dict):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(webhook_url, json=update, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    logger.warning(f"Webhook answered {response.status_code} for update {update['update_id']}")
+
+        await asyncio.gather(*(send(update) for update in updates))
+    return latencies
+
+
+async def serve(args) -> None:
+    port = args.port
+    fake = FakeTelegram(args.retry_after_rate, args.bad_request_rate, args.retry_after)
+    make_bot_api_app(fake).listen(port, address="127.0.0.1")
+    logger.info(f"Fake Bot API listening on http://127.0.0.1:{port}/bot (set BOT_API_BASE_URL to this).")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            logger.info(f"Calls so far: {fake.calls_by_method()}, injected errors: {fake.injected}")
+    except asyncio.CancelledError:
+        pass
+
+async def send(args) -> None:
+    updates = simulated_updates(args.users, args.notes, args.taps)
+    started = time.perf_counter()
+    latencies = sorted(await post_updates(args.webhook, updates, args.secret, args.concurrency))
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.1f} updates/s), "
+        f"p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms."
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Run a fake Bot API server.")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    serve_parser.add_argument("--retry-after-rate", type=float, default=0.0, help="Share of sends answered with 429.")
+    serve_parser.add_argument("--bad-request-rate", type=float, default=0.0, help="Share of sends answered with 400.")
+    serve_parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in injected 429s.")
+    send_parser = commands.add_parser("send", help="POST simulated updates to the bot's webhook.")
+    send_parser.add_argument("--webhook", default="http://127.0.0.1:8443/telegram")
+    send_parser.add_argument("--secret", default=None)
+    send_parser.add_argument("--users", type=int, default=10)
+    send_parser.add_argument("--notes", type=int, default=5)
+    send_parser.add_argument("--taps", type=int, default=5)
+    send_parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        asyncio.run(serve(args))
+    else:
+        asyncio.run(send(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,645 +1,3556 @@
-import logging
-import psycopg 
-import os 
-import asyncio
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ParseMode
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
-    CallbackQueryHandler,
-    ConversationHandler,
-)
-from telegram.error import BadRequest
-from psycopg.rows import dict_row 
-
-# --- تنظیمات ضروری ---
-BOT_TOKEN = os.environ.get("BOT_TOKEN")
-YOUR_CHAT_ID = int(os.environ.get("YOUR_CHAT_ID", "0")) 
-DATABASE_URL = os.environ.get("DATABASE_URL") 
-# --- ---
-
-MAX_LEITNER_BOX = 5 
-AWAITING_REVIEW_COUNT = 1
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# =================================================================
-# متن راهنما (بدون تغییر)
-# =================================================================
-HELP_MESSAGE_TEXT = """
-🧠 <b>این ربات چطور به حافظه شما کمک می‌کنه؟</b>
-
-سلام! من ربات دستیار حافظه شما هستم.
-حتماً براتون پیش اومده که نکته‌ای رو یاد بگیرید، یادداشت کنید، ولی چند هفته بعد کاملاً فراموشش کنید.
-
-<b>مشکل کجاست؟</b>
-مغز ما برای فراموش کردن طراحی شده! مگر اینکه اطلاعات رو در زمان‌های مشخصی "مرور" کنیم.
-
-<b>راه حل: سیستم لایتنر (Leitner System)</b>
-این ربات بر اساس یک روش علمی و مشهور به نام «سیستم جعبه لایتنر» یا «تکرار فاصله‌دار» (Spaced Repetition) کار می‌کنه.
-
----
-
-📥 <b>۱. چطور ازش استفاده کنم؟</b>
-
-خیلی ساده‌ست!
-<b>هر چیزی</b> (متن، عکس، فایل، ویس، لینک) که می‌خواید به خاطر بسپارید رو مستقیماً برای من بفرستید.
-
-من اون رو در <b>"جعبه ۱"</b> شما قرار می‌دم.
-
----
-
-🔁 <b>۲. "مرور روزانه" چیه؟</b>
-
-من هر روز (یا هر وقت دکمه «🎲 مرور روزانه» رو بزنید) چندتا از یادداشت‌هاتون رو براتون می‌فرستم و می‌پرسم:
-
-• <b>"✅ یادم بود"</b>: عالی! اون یادداشت به جعبه بعدی می‌ره (مثلاً از ۱ به ۲).
-• <b>"🤔 مرور مجدد"</b>: اشکالی نداره! اون یادداشت به "جعبه ۱" برمی‌گرده تا بیشتر مرورش کنیم.
-
----
-
-📈 <b>۳. جادوی کار کجاست؟</b>
-
-• یادداشت‌های <b>جعبه ۱</b> (چیزایی که تازه یاد گرفتید) <b>زود به زود</b> مرور می‌شن.
-• یادداشت‌های <b>جعبه ۵</b> (چیزایی که کاملاً بلدید) <b>دیر به دیر</b> (مثلاً هر چند ماه) مرور می‌شن.
-
-اینطوری، شما وقتتون رو روی چیزایی که بلدید تلف نمی‌کنید و روی چیزایی که یادتون می‌ره تمرکز می‌کنید. این کار، اطلاعات رو به حافظه بلندمدت شما منتقل می‌کنه.
-
----
-
-❓ <b>معنی دکمه‌ها:</b>
-
-• <b>🎲 مرور روزانه</b>: شروع یک جلسه مرور دستی.
-• <b>📊 آمار لایتنر</b>: ببینید در هر جعبه چندتا یادداشت دارید.
-• <b>📚 نمایش همه</b>: تمام یادداشت‌هایی که ذخیره کردید رو براتون فوروارد می‌کنه.
-• <b>⚙️ تنظیمات</b>: تعداد مرورهای روزانه رو می‌تونید کم یا زیاد کنید.
-• <b>❓ راهنما</b>: همین پیامی که دارید می‌خونید!
-
-<b>برای شروع، اولین نکته‌ای که می‌خواید یادتون بمونه رو برای من بفرستید.</b>
-"""
-
-
-# =================================================================
-# بخش دیتابیس (بدون تغییر)
-# =================================================================
-
-def get_db_conn():
-    try:
-        conn = psycopg.connect(DATABASE_URL)
-        return conn
-    except psycopg.OperationalError as e:
-        logger.error(f"FATAL: Could not connect to PostgreSQL database: {e}")
-        return None
-
-def init_db():
-    conn = get_db_conn()
-    if not conn: return
-    
-    with conn.cursor() as cursor:
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            chat_id BIGINT NOT NULL,
-            message_id BIGINT NOT NULL,
-            leitner_box INTEGER NOT NULL DEFAULT 1,
-            UNIQUE(user_id, message_id)
-        );
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            user_id BIGINT NOT NULL,
-            key TEXT NOT NULL,
-            value TEXT NOT NULL,
-            PRIMARY KEY(user_id, key)
-        );
-        """)
-        conn.commit()
-    conn.close()
-    logger.info("Database PostgreSQL initialized for Multi-User Leitner system.")
-
-def add_message_id_to_db(user_id: int, chat_id: int, message_id: int):
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            cursor.execute("""
-            INSERT INTO messages (user_id, chat_id, message_id, leitner_box) VALUES (%s, %s, %s, 1)
-            ON CONFLICT (user_id, message_id) DO NOTHING;
-            """, (user_id, chat_id, message_id))
-            conn.commit()
-        conn.close()
-        return True
-    except psycopg.Error as e:
-        logger.error(f"Database error in add_message_id_to_db: {e}")
-        return False
-
-def get_leitner_stats(user_id: int) -> dict:
-    stats = {f"box_{i}": 0 for i in range(1, MAX_LEITNER_BOX + 1)}
-    total = 0
-    try:
-        conn = get_db_conn()
-        with conn.cursor(row_factory=dict_row) as cursor:
-            cursor.execute("SELECT leitner_box, COUNT(*) as count FROM messages WHERE user_id = %s GROUP BY leitner_box", (user_id,))
-            rows = cursor.fetchall()
-            for row in rows:
-                if 1 <= row['leitner_box'] <= MAX_LEITNER_BOX:
-                    stats[f"box_{row['leitner_box']}"] = row['count']
-                    total += row['count']
-        conn.close()
-    except psycopg.Error as e:
-        logger.error(f"Database error in get_leitner_stats: {e}")
-    stats['total'] = total
-    return stats
-
-def move_leitner_box(user_id: int, message_id: int, direction: str) -> int:
-    new_box = 0
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            if direction == 'up':
-                cursor.execute(f"""
-                UPDATE messages 
-                SET leitner_box = LEAST(leitner_box + 1, {MAX_LEITNER_BOX}) 
-                WHERE user_id = %s AND message_id = %s
-                RETURNING leitner_box;
-                """, (user_id, message_id))
-            elif direction == 'reset':
-                cursor.execute("""
-                UPDATE messages SET leitner_box = 1 
-                WHERE user_id = %s AND message_id = %s
-                RETURNING leitner_box;
-                """, (user_id, message_id))
-            
-            result = cursor.fetchone()
-            new_box = result[0] if result else 0
-            conn.commit()
-        conn.close()
-        return new_box
-    except psycopg.Error as e:
-        logger.error(f"Database error in move_leitner_box: {e}")
-        return 0
-
-def get_setting(user_id: int, key: str, default: str) -> str:
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT value FROM settings WHERE user_id = %s AND key = %s", (user_id, key))
-            result = cursor.fetchone()
-        conn.close()
-        if not result:
-            set_setting(user_id, key, default)
-            return default
-        return result[0]
-    except psycopg.Error as e:
-        logger.error(f"Database error in get_setting: {e}")
-        return default
-
-def set_setting(user_id: int, key: str, value: str):
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            cursor.execute("""
-            INSERT INTO settings (user_id, key, value) VALUES (%s, %s, %s)
-            ON CONFLICT (user_id, key) DO UPDATE SET value = EXCLUDED.value;
-            """, (user_id, key, value))
-            conn.commit()
-        conn.close()
-        logger.info(f"Setting '{key}' for user '{user_id}' updated to '{value}'.")
-    except psycopg.Error as e:
-        logger.error(f"Database error in set_setting: {e}")
-
-def get_messages_in_box(user_id: int, box_number: int) -> list:
-    messages = []
-    try:
-        conn = get_db_conn()
-        with conn.cursor(row_factory=dict_row) as cursor:
-            cursor.execute("SELECT message_id, chat_id FROM messages WHERE user_id = %s AND leitner_box = %s ORDER BY id ASC", (user_id, box_number))
-            messages = cursor.fetchall()
-        conn.close()
-        return messages
-    except psycopg.Error as e:
-        logger.error(f"Database error in get_messages_in_box: {e}")
-        return []
-
-def get_all_messages_for_user(user_id: int) -> list:
-    messages = []
-    try:
-        conn = get_db_conn()
-        with conn.cursor(row_factory=dict_row) as cursor:
-            cursor.execute("SELECT message_id, chat_id FROM messages WHERE user_id = %s ORDER BY id ASC", (user_id,))
-            messages = cursor.fetchall()
-        conn.close()
-        return messages
-    except psycopg.Error as e:
-        logger.error(f"Database error in get_all_messages_for_user: {e}")
-        return []
-
-def get_all_users_for_review() -> list:
-    users = []
-    try:
-        conn = get_db_conn()
-        with conn.cursor(row_factory=dict_row) as cursor:
-            cursor.execute("SELECT DISTINCT user_id, chat_id FROM messages")
-            users = cursor.fetchall()
-        conn.close()
-        return users
-    except psycopg.Error as e:
-        logger.error(f"Database error in get_all_users_for_review: {e}")
-        return []
-
-def delete_message_from_db(user_id: int, message_id: int) -> bool:
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM messages WHERE user_id = %s AND message_id = %s", (user_id, message_id))
-            conn.commit()
-        conn.close()
-        logger.info(f"Message {message_id} deleted for user {user_id}.")
-        return True
-    except psycopg.Error as e:
-        logger.error(f"Database error in delete_message_from_db: {e}")
-        return False
-
-
-# =================================================================
-# دستورات و دکمه‌های اصلی (تابع start اصلاح شد)
-# =================================================================
-
-# <--- تابع start با parse_mode=HTML اصلاح شد --->
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    
-    keyboard = [
-        ["🎲 مرور روزانه", "📊 آمار لایتنر"],
-        ["📚 نمایش همه", "⚙️ تنظیمات"],
-        ["❓ راهنما"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-    
-    stats = get_leitner_stats(user_id) 
-    
-    # <--- متن خوشامدگویی به فرمت HTML تغییر کرد --->
-    welcome_message = (
-        f"سلام! به سیستم یادآوری لایتنر شخصی خود خوش آمدید.\n\n"
-        f"شما <b>{stats['total']}</b> یادداشت در آرشیو خود دارید.\n\n"
-        "هر چیزی برای من بفرستید تا به <b>جعبه ۱</b> لایتنر شما اضافه شود.\n\n"
-        "اگر نمی‌دانید چطور کار می‌کند، دکمه <b>«❓ راهنما»</b> را بزنید."
-    )
-    
-    # <--- parse_mode به HTML تغییر کرد تا خطا برطرف شود --->
-    await update.message.reply_text(
-        welcome_message, 
-        reply_markup=reply_markup, 
-        parse_mode=ParseMode.HTML
-    )
-
-async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        HELP_MESSAGE_TEXT, 
-        parse_mode=ParseMode.HTML, 
-        disable_web_page_preview=True
-    )
-
-async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    message_id = update.message.message_id
-    
-    if add_message_id_to_db(user_id, chat_id, message_id):
-        stats = get_leitner_stats(user_id) 
-        await update.message.reply_text(f"✅ به جعبه ۱ شما اضافه شد! (مجموع: {stats['total']})", reply_to_message_id=message_id)
-
-# =================================================================
-# منطق اصلی مرور و بازخورد لایتنر (بدون تغییر)
-# =================================================================
-
-async def trigger_leitner_review(bot, user_id: int, chat_id: int) -> int:
-    daily_reviews = int(get_setting(user_id, 'daily_reviews', '2'))
-    logger.info(f"Triggering {daily_reviews} Leitner reviews for user {user_id}...")
-    
-    conn = get_db_conn()
-    if not conn: return 0
-    
-    with conn.cursor(row_factory=dict_row) as cursor:
-        cursor.execute("SELECT message_id, chat_id FROM messages WHERE user_id = %s ORDER BY leitner_box ASC, RANDOM() LIMIT %s", (user_id, daily_reviews))
-        messages = cursor.fetchall()
-    conn.close()
-    
-    if not messages: return 0
-
-    for msg in messages:
-        message_id = msg['message_id']
-        from_chat_id = msg['chat_id'] 
-        
-        keyboard = [[
-            InlineKeyboardButton("✅ یادم بود", callback_data=f"leitner_up_{message_id}"),
-            InlineKeyboardButton("🤔 مرور مجدد", callback_data=f"leitner_reset_{message_id}"),
-            InlineKeyboardButton("🗑️ حذف", callback_data=f"leitner_del_{message_id}")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=reply_markup)
-        except BadRequest as e:
-            logger.error(f"Failed to copy message {message_id} for user {user_id} (BadRequest): {e}. It might be deleted.")
-        except Exception as e:
-            logger.error(f"An unexpected error occurred while copying message {message_id} for user {user_id}: {e}")
-            
-    return len(messages)
-
-async def trigger_daily_reviews_for_all_users(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Running daily review job for ALL users...")
-    bot = context.bot
-    users = get_all_users_for_review() 
-    
-    if not users:
-        logger.info("No users with messages found to review.")
-        return
-
-    logger.info(f"Found {len(users)} users to review.")
-    for user in users:
-        try:
-            await trigger_leitner_review(bot, user['user_id'], user['chat_id'])
-            await asyncio.sleep(1) 
-        except Exception as e:
-            logger.error(f"Failed to trigger review for user {user['user_id']}: {e}")
-
-
-async def handle_leitner_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-
-    try:
-        data_part = query.data.replace("leitner_", "", 1)
-        parts = data_part.rsplit("_", 1)
-        action = parts[0]
-        message_id = int(parts[1])
-
-    except (ValueError, IndexError, TypeError):
-        logger.error(f"Invalid callback data received: {query.data}")
-        await query.edit_message_text(text="❌ خطای داخلی.")
-        return
-
-    feedback_text = ""
-    new_keyboard = None 
-
-    if action == "up":
-        new_box = move_leitner_box(user_id, message_id, 'up')
-        feedback_text = f"👍 عالی! این یادداشت به جعبه <b>{new_box}</b> منتقل شد."
-    
-    elif action == "reset":
-        new_box = move_leitner_box(user_id, message_id, 'reset')
-        feedback_text = f"🔄 این یادداشت برای مرور بیشتر به جعبه <b>{new_box}</b> برگشت."
-    
-    elif action == "del":
-        feedback_text = "⚠️ <b>آیا از حذف این یادداشت مطمئن هستید؟</b>\nاین عمل قابل بازگشت نیست."
-        new_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🚮 بله، حذف کن", callback_data=f"leitner_del_confirm_{message_id}"),
-                InlineKeyboardButton("↪️ انصراف", callback_data=f"leitner_del_cancel_{message_id}")
-            ]
-        ])
-
-    elif action == "del_confirm":
-        if delete_message_from_db(user_id, message_id):
-            feedback_text = "🗑️ یادداشت برای همیشه حذف شد."
-        else:
-            feedback_text = "❌ خطایی در هنگام حذف رخ داد."
-
-    elif action == "del_cancel":
-        feedback_text = "عملیات حذف لغو شد."
-        new_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ یادم بود", callback_data=f"leitner_up_{message_id}"),
-                InlineKeyboardButton("🤔 مرور مجدد", callback_data=f"leitner_reset_{message_id}"),
-                InlineKeyboardButton("🗑️ حذف", callback_data=f"leitner_del_{message_id}")
-            ]
-        ])
-
-    else:
-        feedback_text = "❌ دستور نامعتبر."
-
-    try:
-        if action == "del_confirm" and "حذف شد" in feedback_text:
-            await query.delete_message()
-        else:
-            if query.message.text:
-                await query.edit_message_text(
-                    text=feedback_text, 
-                    parse_mode=ParseMode.HTML, 
-                    reply_markup=new_keyboard
-                )
-            else:
-                await query.edit_message_caption(
-                    caption=feedback_text, 
-                    parse_mode=ParseMode.HTML, 
-                    reply_markup=new_keyboard
-                )
-    except BadRequest as e:
-        if "message is not modified" not in str(e):
-            logger.warning(f"Could not edit message after callback: {e}")
-    except Exception as e:
-        logger.error(f"Failed to edit/delete message after callback: {e}")
-
-
-# =================================================================
-# منوی آمار (بدون تغییر)
-# =================================================================
-
-async def stats_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    stats = get_leitner_stats(user_id) 
-    
-    keyboard = []
-    for i in range(1, MAX_LEITNER_BOX + 1):
-        box_count = stats[f'box_{i}']
-        button_text = f"📦 جعبه {i} ({box_count} مورد)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"view_box_{i}")])
-    
-    keyboard.append([InlineKeyboardButton("❌ بستن", callback_data="stats_close")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    stats_text = f"📊 <b>آمار جعبه لایتنر شما</b>\n\nبرای مشاهده محتوای هر جعبه، روی دکمه آن کلیک کنید."
-
-    if update.message:
-        await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
-    elif update.callback_query:
-        try:
-            await update.callback_query.message.edit_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
-        except BadRequest:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
-
-
-async def handle_view_box_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-    
-    try:
-        box_number = int(query.data.split("_")[2])
-    except (ValueError, IndexError):
-        await query.edit_message_text("❌ خطای داخلی در انتخاب جعبه.")
-        return
-
-    messages = get_messages_in_box(user_id, box_number)
-    
-    await query.edit_message_text(f"شما <b>{len(messages)}</b> یادداشت در جعبه {box_number} دارید. در حال ارسال...", parse_mode=ParseMode.HTML)
-    
-    if not messages:
-        await query.delete_message()
-        await stats_menu_handler(update, context) 
-        return
-
-    await query.delete_message()
-
-    for msg in messages:
-        message_id = msg['message_id']
-        from_chat_id = msg['chat_id']
-        
-        keyboard = [[
-            InlineKeyboardButton("✅ یادم بود", callback_data=f"leitner_up_{message_id}"),
-            InlineKeyboardButton("🤔 مرور مجدد", callback_data=f"leitner_reset_{message_id}"),
-            InlineKeyboardButton("🗑️ حذف", callback_data=f"leitner_del_{message_id}")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await context.bot.copy_message(
-                chat_id=from_chat_id, 
-                from_chat_id=from_chat_id,
-                message_id=message_id,
-                reply_markup=reply_markup
-            )
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            logger.warning(f"Could not copy message {message_id} from box view for user {user_id}: {e}")
-
-    await stats_menu_handler(update, context)
-
-
-async def handle_stats_close_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    try:
-        await query.delete_message()
-    except Exception as e:
-        logger.warning(f"Could not delete stats message: {e}")
-
-# =================================================================
-# سایر دکمه‌ها و مکالمه تنظیمات (بدون تغییر)
-# =================================================================
-
-async def handle_review_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    daily_reviews = int(get_setting(user_id, 'daily_reviews', '2'))
-    
-    await update.message.reply_text(f"⏳ در حال یافتن <b>{daily_reviews}</b> یادداشت برای مرور...", parse_mode=ParseMode.HTML)
-    sent_count = await trigger_leitner_review(context.bot, user_id, chat_id)
-    if sent_count == 0: await update.message.reply_text("هنوز هیچ یادداشتی برای مرور ذخیره نکرده‌اید!")
-
-async def list_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    
-    await update.message.reply_text("⏳ در حال دریافت لیست کامل یادداشت‌ها...")
-    
-    all_messages = get_all_messages_for_user(user_id)
-    
-    if not all_messages:
-        await update.message.reply_text("هنوز هیچ یادداشتی ذخیره نکرده‌اید!")
-        return
-
-    await update.message.reply_text(f"در حال ارسال <b>{len(all_messages)}</b> یادداشت...", parse_mode=ParseMode.HTML)
-    for msg in all_messages:
-        try:
-            await context.bot.forward_message(chat_id=chat_id, from_chat_id=msg['chat_id'], message_id=msg['message_id'])
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            logger.warning(f"Could not forward message {msg['message_id']} for user {user_id}: {e}")
-    await update.message.reply_text("✅ ارسال تمام شد.")
-
-async def settings_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    current_count = get_setting(user_id, 'daily_reviews', '2')
-    
-    await update.message.reply_text(
-        f"⚙️ <b>تنظیمات</b>\n\nتعداد مرور روزانه در حال حاضر: <b>{current_count}</b>\n\n"
-        "لطفاً تعداد جدید را به صورت یک عدد (مثلاً 5) ارسال کنید.\nبرای لغو، /cancel را بزنید.",
-        parse_mode=ParseMode.HTML
-    )
-    return AWAITING_REVIEW_COUNT
-
-async def settings_receive_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    try:
-        new_count = int(update.message.text)
-        if 1 <= new_count <= 20:
-            set_setting(user_id, 'daily_reviews', str(new_count))
-            await update.message.reply_text(f"✅ تعداد مرور روزانه به <b>{new_count}</b> تغییر کرد.", parse_mode=ParseMode.HTML)
-            return ConversationHandler.END
-        else:
-            await update.message.reply_text("❌ لطفاً یک عدد بین ۱ تا ۲۰ وارد کنید.")
-            return AWAITING_REVIEW_COUNT
-    except (ValueError, TypeError):
-        await update.message.reply_text("❌ ورودی نامعتبر است. لطفاً فقط یک عدد ارسال کنید.")
-        return AWAITING_REVIEW_COUNT
-
-async def settings_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("عملیات لغو شد.")
-    return ConversationHandler.END
-
-# =================================================================
-# تابع اصلی (بدون تغییر)
-# =================================================================
-def main() -> None:
-    if not BOT_TOKEN:
-        logger.error("FATAL: Missing environment variable: BOT_TOKEN")
-        return
-    if not DATABASE_URL:
-        logger.error("FATAL: Missing environment variable: DATABASE_URL")
-        return
-        
-    init_db() 
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    private_chat_filter = filters.ChatType.PRIVATE
-
-    conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.TEXT & filters.Regex("^⚙️ تنظیمات$") & private_chat_filter, settings_start)],
-        states={AWAITING_REVIEW_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND & private_chat_filter, settings_receive_count)],},
-        fallbacks=[CommandHandler("cancel", settings_cancel, filters=private_chat_filter)],
-    )
-    application.add_handler(conv_handler)
-
-    application.add_handler(CommandHandler("start", start, filters=private_chat_filter))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🎲 مرور روزانه$") & private_chat_filter, handle_review_button))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📊 آمار لایتنر$") & private_chat_filter, stats_menu_handler))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📚 نمایش همه$") & private_chat_filter, list_all_messages))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^❓ راهنما$") & private_chat_filter, show_help))
-    
-    application.add_handler(CallbackQueryHandler(handle_leitner_callback, pattern="^leitner_"))
-    application.add_handler(CallbackQueryHandler(handle_view_box_callback, pattern="^view_box_"))
-    application.add_handler(CallbackQueryHandler(handle_stats_close_callback, pattern="^stats_close$"))
-
-    button_texts = ["^🎲 مرور روزانه$", "^📊 آمار لایتنر$", "^📚 نمایش همه$", "^⚙️ تنظیمات$", "^❓ راهنما$"]
-    button_regex = "|".join(button_texts)
-    application.add_handler(MessageHandler(
-        filters.ALL & (~filters.COMMAND) & (~filters.Regex(button_regex)) & private_chat_filter,
-        handle_new_message
-    ))
-
-    job_queue = application.job_queue
-    job_queue.run_repeating(trigger_daily_reviews_for_all_users, interval=86400, first=10) 
-
-    logger.info("Starting Leitner System Bot (Multi-User Edition with Delete Feature)...")
-    application.run_polling()
-
-if __name__ == "__main__":
+import argparse
+import logging
+import psycopg 
+import os 
+import asyncio
+import cProfile
+import csv
+import functools
+import html
+import io
+import re
+import pstats
+import random
+import shutil
+import signal
+import sys
+import tarfile
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.constants import ParseMode
+from telegram.ext import (
+    Application,
+    BaseUpdateProcessor,
+    CommandHandler,
+    ContextTypes,
+    MessageHandler,
+    filters,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    ConversationHandler,
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from psycopg.rows import dict_row 
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# --- تنظیمات ضروری ---
+BOT_TOKEN = os.environ.get("BOT_TOKEN")
+YOUR_CHAT_ID = int(os.environ.get("YOUR_CHAT_ID", "0")) 
+DATABASE_URL = os.environ.get("DATABASE_URL") 
+# --- ---
+
+# --- تنظیمات استخر اتصال دیتابیس ---
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+WRITE_BATCH_MAX_SIZE = int(os.environ.get("WRITE_BATCH_MAX_SIZE", "200"))
+WRITE_BATCH_MAX_DELAY = float(os.environ.get("WRITE_BATCH_MAX_DELAY_MS", "5")) / 1000
+MIGRATION_LOCK_TIMEOUT = os.environ.get("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_LOCK_RETRIES = int(os.environ.get("MIGRATION_LOCK_RETRIES", "10"))
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", "5000"))
+MIGRATIONS_LOCK_KEY = 7261000
+# --- ---
+
+# --- رپلیکای فقط‌خواندنی (اختیاری) ---
+# با READ_DATABASE_URL خواندن‌های سنگین (آمار، نمای جعبه، جست‌وجو و خروجی) از رپلیکا انجام می‌شوند.
+READ_DATABASE_URL = os.environ.get("READ_DATABASE_URL")
+READ_DB_POOL_MAX_SIZE = int(os.environ.get("READ_DB_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+READ_REPLICA_MAX_LAG = float(os.environ.get("READ_REPLICA_MAX_LAG_SECONDS", "5"))
+READ_REPLICA_CHECK_INTERVAL = float(os.environ.get("READ_REPLICA_CHECK_INTERVAL", "2"))
+# بعد از هر نوشتن، خواندن‌های همان کاربر تا این مدت از primary انجام می‌شوند؛ باید از مجموع دو مقدار بالا بیشتر باشد.
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "10"))
+# --- ---
+
+# --- تنظیمات نرخ ارسال و نمایش ---
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+# سهم این پردازه از سقف سراسری ربات. هر پردازه‌ای که پیام می‌فرستد (all، bot و worker) سهم خودش را دارد و
+# مجموع سهم همه پردازه‌ها نباید از ۱ بیشتر شود؛ مثلاً یک bot و دو worker: 0.4، 0.3 و 0.3.
+TELEGRAM_RATE_SHARE = float(os.environ.get("TELEGRAM_RATE_SHARE", "1"))
+TELEGRAM_PER_CHAT_RATE = float(os.environ.get("TELEGRAM_PER_CHAT_RATE", "1"))
+TELEGRAM_PER_CHAT_BURST = float(os.environ.get("TELEGRAM_PER_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+BOX_PAGE_SIZE = int(os.environ.get("BOX_PAGE_SIZE", "10"))
+SHOW_ALL_PROGRESS_INTERVAL = float(os.environ.get("SHOW_ALL_PROGRESS_INTERVAL", "5"))
+RENDERED_MESSAGES_CACHE_SIZE = int(os.environ.get("RENDERED_MESSAGES_CACHE_SIZE", "20000"))
+# --- ---
+
+# --- زمان‌بندی مرور روزانه هر کاربر ---
+# کاربرانی که ساعت مرور انتخاب نکرده‌اند بر اساس user_id در یک بازه روزانه پخش می‌شوند.
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "Asia/Tehran")
+DEFAULT_REVIEW_WINDOW_START = os.environ.get("DEFAULT_REVIEW_WINDOW_START", "09:00")
+DEFAULT_REVIEW_WINDOW_HOURS = float(os.environ.get("DEFAULT_REVIEW_WINDOW_HOURS", "12"))
+REVIEW_TIME_JITTER_SECONDS = int(os.environ.get("REVIEW_TIME_JITTER_SECONDS", "600"))
+SCHEDULER_TICK_SECONDS = float(os.environ.get("SCHEDULER_TICK_SECONDS", "60"))
+SCHEDULER_BATCH_SIZE = int(os.environ.get("SCHEDULER_BATCH_SIZE", "500"))
+SCHEDULER_MAX_USERS_PER_TICK = int(os.environ.get("SCHEDULER_MAX_USERS_PER_TICK", "5000"))
+# --- ---
+
+# --- خروجی و بازگردانی deck با COPY ---
+COPY_CHUNK_SIZE = 1 << 16
+# سقف Bot API برای فایلی که ربات می‌فرستد (50MB) و فایلی که با getFile می‌گیرد (20MB)؛ سرور محلی Bot API بیشتر اجازه می‌دهد.
+TELEGRAM_UPLOAD_MAX_BYTES = int(os.environ.get("TELEGRAM_UPLOAD_MAX_BYTES", str(50 * 1000 * 1000)))
+TELEGRAM_DOWNLOAD_MAX_BYTES = int(os.environ.get("TELEGRAM_DOWNLOAD_MAX_BYTES", str(20 * 1000 * 1000)))
+# سقف هر CSV پس از باز کردن آرشیوی که از چت رسیده (در برابر آرشیوهای با فشردگی غیرعادی).
+IMPORT_MAX_FILE_BYTES = int(os.environ.get("IMPORT_MAX_FILE_BYTES", str(200 * 1000 * 1000)))
+# --- ---
+
+# --- کارت‌های خراب (پیام مبدأ حذف شده) ---
+CARD_FAILURE_THRESHOLD = int(os.environ.get("CARD_FAILURE_THRESHOLD", "3"))
+CARD_FAILURE_RETRY_DELAY = timedelta(hours=float(os.environ.get("CARD_FAILURE_RETRY_HOURS", "24")))
+TOMBSTONE_SWEEP_INTERVAL = float(os.environ.get("TOMBSTONE_SWEEP_INTERVAL", "3600"))
+TOMBSTONE_SWEEP_BATCH = int(os.environ.get("TOMBSTONE_SWEEP_BATCH", "1000"))
+# --- ---
+
+# --- پارتیشن‌بندی messages و بایگانی کارت‌های مسلط ---
+# تعداد پارتیشن‌های hash جدول messages؛ فقط هنگام مهاجرت پارتیشن‌بندی خوانده می‌شود.
+MESSAGES_PARTITIONS = int(os.environ.get("MESSAGES_PARTITIONS", "16"))
+# کارتی که این مدت پیوسته در آخرین جعبه مانده باشد به messages_archive منتقل می‌شود.
+ARCHIVE_MASTERED_AFTER = timedelta(days=float(os.environ.get("ARCHIVE_MASTERED_AFTER_DAYS", "365")))
+ARCHIVE_SWEEP_INTERVAL = float(os.environ.get("ARCHIVE_SWEEP_INTERVAL", "3600"))
+ARCHIVE_SWEEP_BATCH = int(os.environ.get("ARCHIVE_SWEEP_BATCH", "500"))
+ARCHIVE_SWEEP_MAX_BATCHES = int(os.environ.get("ARCHIVE_SWEEP_MAX_BATCHES", "100"))
+# --- ---
+
+# --- رویدادهای مرور و آمار تجمیعی ---
+REVIEW_ROLLUP_INTERVAL = float(os.environ.get("REVIEW_ROLLUP_INTERVAL", "300"))
+REVIEW_ROLLUP_BATCH = int(os.environ.get("REVIEW_ROLLUP_BATCH", "10000"))
+# رویدادهای تازه‌تر از این هنوز تجمیع نمی‌شوند تا درج‌هایی که شناسه کوچک‌تر گرفته‌اند ولی دیرتر commit شده‌اند جا نمانند.
+REVIEW_ROLLUP_SAFETY_LAG = timedelta(seconds=float(os.environ.get("REVIEW_ROLLUP_SAFETY_LAG_SECONDS", "30")))
+REVIEW_HISTORY_DAYS = int(os.environ.get("REVIEW_HISTORY_DAYS", "7"))
+# --- ---
+
+# --- جست‌وجوی یادداشت‌ها ---
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+SEARCH_SNIPPET_LENGTH = int(os.environ.get("SEARCH_SNIPPET_LENGTH", "80"))
+# عبارت‌های کوتاه‌تر از این فقط با کلمه یا ابتدای کلمه پیدا می‌شوند (trigram برای آن‌ها کمکی نمی‌کند).
+SEARCH_MIN_SUBSTRING_LENGTH = 3
+# --- ---
+
+# --- تنظیمات صف ارسال (Outbox) ---
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_RETRY_DELAY = float(os.environ.get("OUTBOX_RETRY_DELAY", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+# سقف Bot API برای تعداد پیام در هر copyMessages/forwardMessages
+OUTBOX_GROUP_SIZE = 100
+# --- ---
+
+# --- حالت اجرا ---
+# all: دریافت آپدیت‌ها + جاب روزانه + تخلیه صف | bot: فقط آپدیت‌ها | worker: فقط جاب روزانه + تخلیه صف
+# چند worker کاربران و ردیف‌های صف را با SKIP LOCKED بین خودشان تقسیم می‌کنند و شماره‌ای لازم ندارند.
+RUN_MODE = os.environ.get("RUN_MODE", "all")
+# --- ---
+
+# --- دریافت آپدیت‌ها: polling یا webhook ---
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+# برای اجرای محلی با fake_telegram.py، مثلاً http://127.0.0.1:8081/bot
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL")
+# --- ---
+
+# --- محدودیت کار هم‌زمان هر کاربر ---
+# دکمه یا callback تکراری که تا این مدت بعد از قبلی برسد نادیده گرفته می‌شود.
+USER_DEBOUNCE_SECONDS = float(os.environ.get("USER_DEBOUNCE_SECONDS", "2"))
+# سقف آپدیت‌های دکمه/callback و سقف کل آپدیت‌های در انتظار هر کاربر؛ بیشتر از این دور ریخته می‌شود.
+# آپدیت‌ها از لحظه رسیدن شمرده می‌شوند، نه از وقتی سهمی از CONCURRENT_UPDATES می‌گیرند.
+USER_MAX_PENDING_ACTIONS = int(os.environ.get("USER_MAX_PENDING_ACTIONS", "10"))
+USER_MAX_PENDING_UPDATES = int(os.environ.get("USER_MAX_PENDING_UPDATES", "200"))
+# --- ---
+
+# --- تنظیمات کش تنظیمات کاربر ---
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", "50000"))
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "600"))
+SETTINGS_NOTIFY_CHANNEL = "leitner_settings_changed"
+PROCESS_TOKEN = uuid.uuid4().hex
+# --- ---
+
+# --- متریک‌ها (Prometheus) و پروفایل handlerهای کند ---
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0 یعنی بدون endpoint متریک
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+METRICS_SAMPLE_INTERVAL = float(os.environ.get("METRICS_SAMPLE_INTERVAL", "15"))
+PROFILE_SLOW_HANDLER_MS = float(os.environ.get("PROFILE_SLOW_HANDLER_MS", "0"))  # 0 یعنی پروفایل خاموش
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_TOP_FUNCTIONS = int(os.environ.get("PROFILE_TOP_FUNCTIONS", "25"))
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.environ.get("TELEGRAM_CONNECTION_POOL_SIZE", "256"))
+# --- ---
+
+MAX_LEITNER_BOX = 5 
+AWAITING_REVIEW_COUNT = 1
+
+# فاصله مرور هر جعبه بر حسب روز (جعبه ۱ تا جعبه MAX_LEITNER_BOX)
+LEITNER_BOX_INTERVALS = [
+    timedelta(days=float(days))
+    for days in os.environ.get("LEITNER_BOX_INTERVALS", "1,3,7,30,90").split(",")
+]
+if len(LEITNER_BOX_INTERVALS) != MAX_LEITNER_BOX:
+    raise ValueError(f"LEITNER_BOX_INTERVALS must list exactly {MAX_LEITNER_BOX} intervals.")
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# =================================================================
+# متریک‌ها و پروفایل (Prometheus)
+# =================================================================
+# با METRICS_PORT، متریک‌ها روی http://METRICS_ADDR:METRICS_PORT/metrics در دسترس‌اند.
+
+handler_latency = Histogram("leitner_handler_seconds", "Time spent in each update handler.", ["handler"])
+handler_errors = Counter("leitner_handler_errors_total", "Update handlers that raised an exception.", ["handler"])
+db_query_latency = Histogram(
+    "leitner_db_query_seconds", "Latency of each DB statement, by the function that ran it.", ["caller"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0),
+)
+db_query_errors = Counter("leitner_db_query_errors_total", "DB statements that failed.", ["caller"])
+telegram_api_latency = Histogram("leitner_telegram_api_seconds", "Latency of Bot API requests.", ["method"])
+telegram_api_errors = Counter("leitner_telegram_api_errors_total", "Failed Bot API requests.", ["method", "status"])
+telegram_flood_waits = Counter("leitner_telegram_flood_waits_total", "Flood-control (429) answers from the Bot API.", ["method"])
+telegram_send_wait = Histogram("leitner_telegram_send_wait_seconds", "Time sends waited in the local rate limiter.", ["lane"])
+telegram_edits_skipped = Counter("leitner_telegram_edits_skipped_total", "Message edits skipped because the message already showed that content.")
+scheduler_users = Counter("leitner_scheduler_users_total", "Users whose daily review was queued by the scheduler.")
+scheduler_cards = Counter("leitner_scheduler_cards_total", "Cards queued by the review scheduler.")
+scheduler_lag = Gauge("leitner_scheduler_lag_seconds", "Age of the oldest due delivery left after the last scheduler tick.")
+scheduler_tick_duration = Gauge("leitner_scheduler_last_tick_seconds", "Wall time of the last scheduler tick.")
+outbox_deliveries = Counter("leitner_outbox_deliveries_total", "Outbox items handled by the workers.", ["result"])
+users_deactivated = Counter("leitner_users_deactivated_total", "Users marked inactive after blocking the bot or losing their chat.")
+cards_archived = Counter("leitner_cards_archived_total", "Mastered cards moved to messages_archive.")
+cards_pruned = Counter("leitner_cards_pruned_total", "Cards whose source message is gone, by pruning stage.", ["stage"])
+outbox_depth = Gauge("leitner_outbox_items", "Outbox rows waiting to be sent.", ["state"])
+update_queue_depth = Gauge("leitner_update_queue_depth", "Updates received but not yet picked up.")
+users_in_flight = Gauge("leitner_users_in_flight", "Users with an update being processed or waiting.")
+updates_dropped = Counter("leitner_updates_dropped_total", "Updates dropped before reaching a handler.", ["reason"])
+user_tasks_running = Gauge("leitner_user_tasks_running", "Long per-user operations running in the background.")
+user_tasks_refused = Counter("leitner_user_tasks_refused_total", "Long operations refused because one was already running.", ["kind"])
+write_batch_pending = Gauge("leitner_write_batch_pending", "Writes waiting for the next batch flush.", ["batcher"])
+db_reads = Counter("leitner_db_reads_total", "Routed read-only queries, by the database that served them.", ["target"])
+read_replica_lag = Gauge("leitner_read_replica_lag_seconds", "Replay lag of the read replica at the last check (-1 when unreachable).")
+
+class SlowHandlerProfiler:
+    # cProfile کل thread را می‌بیند؛ پس هر بار فقط یک handler پروفایل می‌شود و خروجی
+    # ممکن است کار کوروتین‌های هم‌زمان را هم شامل شود.
+    def __init__(self, threshold_ms: float, sample_rate: float, top_functions: int):
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.top_functions = top_functions
+        self.active = False
+
+    def start(self) -> cProfile.Profile | None:
+        if self.threshold <= 0 or self.active or random.random() >= self.sample_rate:
+            return None
+        self.active = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def finish(self, profiler: cProfile.Profile, name: str, elapsed: float) -> None:
+        profiler.disable()
+        self.active = False
+        if elapsed < self.threshold:
+            return
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(self.top_functions)
+        logger.warning(f"Slow handler {name} took {elapsed * 1000:.0f}ms. Profile:\n{output.getvalue()}")
+
+slow_handler_profiler = SlowHandlerProfiler(PROFILE_SLOW_HANDLER_MS, PROFILE_SAMPLE_RATE, PROFILE_TOP_FUNCTIONS)
+
+def observed_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        profiler = slow_handler_profiler.start()
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_latency.labels(name).observe(elapsed)
+            if profiler is not None:
+                slow_handler_profiler.finish(profiler, name, elapsed)
+
+    return wrapper
+
+def db_caller() -> str:
+    # نزدیک‌ترین تابع همین ماژول در پشته (مثلاً get_leitner_stats) برچسب کوئری می‌شود.
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get("__name__") != __name__:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+class InstrumentedCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        caller = db_caller()
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        except psycopg.Error:
+            db_query_errors.labels(caller).inc()
+            raise
+        finally:
+            db_query_latency.labels(caller).observe(time.perf_counter() - started)
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        # دانلود فایل‌ها با برچسب ثابت file ثبت می‌شود تا مسیر فایل برچسب نشود.
+        endpoint = "file" if "/file/" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            telegram_api_errors.labels(endpoint, type(e).__name__).inc()
+            raise
+        finally:
+            telegram_api_latency.labels(endpoint).observe(time.perf_counter() - started)
+        if status == 429:
+            telegram_flood_waits.labels(endpoint).inc()
+        if status != 200:
+            telegram_api_errors.labels(endpoint, str(status)).inc()
+        return status, payload
+
+metrics_sampler_task: asyncio.Task | None = None
+
+async def sample_queue_depths() -> None:
+    # عمق صف outbox از دیتابیس خوانده می‌شود؛ صف‌های داخل حافظه با set_function لحظه scrape خوانده می‌شوند.
+    while True:
+        for state, count in (await count_outbox_depth()).items():
+            outbox_depth.labels(state).set(count)
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+def start_metrics(application: Application) -> None:
+    global metrics_sampler_task
+    if not METRICS_PORT:
+        return
+    start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+    update_queue_depth.set_function(application.update_queue.qsize)
+    users_in_flight.set_function(lambda: len(getattr(application.update_processor, "user_locks", ())))
+    user_tasks_running.set_function(lambda: sum(len(tasks) for tasks in user_tasks.tasks.values()))
+    for batcher in (message_insert_batcher, box_move_batcher, review_event_batcher):
+        write_batch_pending.labels(batcher.name).set_function(lambda batcher=batcher: len(batcher.pending))
+    metrics_sampler_task = asyncio.create_task(sample_queue_depths())
+    logger.info(f"Metrics endpoint listening on http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
+
+async def stop_metrics() -> None:
+    if metrics_sampler_task is not None:
+        metrics_sampler_task.cancel()
+        await asyncio.gather(metrics_sampler_task, return_exceptions=True)
+
+# =================================================================
+# متن راهنما
+# =================================================================
+HELP_MESSAGE_TEXT = """
+🧠 <b>این ربات چطور به حافظه شما کمک می‌کنه؟</b>
+
+سلام! من ربات دستیار حافظه شما هستم.
+حتماً براتون پیش اومده که نکته‌ای رو یاد بگیرید، یادداشت کنید، ولی چند هفته بعد کاملاً فراموشش کنید.
+
+<b>مشکل کجاست؟</b>
+مغز ما برای فراموش کردن طراحی شده! مگر اینکه اطلاعات رو در زمان‌های مشخصی "مرور" کنیم.
+
+<b>راه حل: سیستم لایتنر (Leitner System)</b>
+این ربات بر اساس یک روش علمی و مشهور به نام «سیستم جعبه لایتنر» یا «تکرار فاصله‌دار» (Spaced Repetition) کار می‌کنه.
+
+---
+
+📥 <b>۱. چطور ازش استفاده کنم؟</b>
+
+خیلی ساده‌ست!
+<b>هر چیزی</b> (متن، عکس، فایل، ویس، لینک) که می‌خواید به خاطر بسپارید رو مستقیماً برای من بفرستید.
+
+من اون رو در <b>"جعبه ۱"</b> شما قرار می‌دم.
+
+---
+
+🔁 <b>۲. "مرور روزانه" چیه؟</b>
+
+من هر روز (یا هر وقت دکمه «🎲 مرور روزانه» رو بزنید) چندتا از یادداشت‌هاتون رو براتون می‌فرستم و می‌پرسم:
+
+• <b>"✅ یادم بود"</b>: عالی! اون یادداشت به جعبه بعدی می‌ره (مثلاً از ۱ به ۲).
+• <b>"🤔 مرور مجدد"</b>: اشکالی نداره! اون یادداشت به "جعبه ۱" برمی‌گرده تا بیشتر مرورش کنیم.
+
+---
+
+📈 <b>۳. جادوی کار کجاست؟</b>
+
+• یادداشت‌های <b>جعبه ۱</b> (چیزایی که تازه یاد گرفتید) <b>زود به زود</b> مرور می‌شن.
+• یادداشت‌های <b>جعبه ۵</b> (چیزایی که کاملاً بلدید) <b>دیر به دیر</b> (مثلاً هر چند ماه) مرور می‌شن.
+
+اینطوری، شما وقتتون رو روی چیزایی که بلدید تلف نمی‌کنید و روی چیزایی که یادتون می‌ره تمرکز می‌کنید. این کار، اطلاعات رو به حافظه بلندمدت شما منتقل می‌کنه.
+
+---
+
+❓ <b>معنی دکمه‌ها:</b>
+
+• <b>🎲 مرور روزانه</b>: شروع یک جلسه مرور دستی.
+• <b>📊 آمار لایتنر</b>: ببینید در هر جعبه چندتا یادداشت دارید.
+• <b>📚 نمایش همه</b>: تمام یادداشت‌هایی که ذخیره کردید رو براتون فوروارد می‌کنه.
+• <b>⚙️ تنظیمات</b>: تعداد مرورهای روزانه رو می‌تونید کم یا زیاد کنید.
+• <b>❓ راهنما</b>: همین پیامی که دارید می‌خونید!
+• <b>/search عبارت</b>: بین متن و کپشن یادداشت‌هاتون می‌گرده.
+• <b>/timezone Asia/Tehran</b>: منطقه زمانی شما رو تنظیم می‌کنه تا مرور روزانه به وقت خودتون بیاد.
+• <b>/reviewtime 08:30</b>: ساعت ارسال مرور روزانه رو تعیین می‌کنه.
+• <b>/export</b>: یه فایل پشتیبان از یادداشت‌ها و تنظیمات‌تون براتون می‌فرسته.
+• <b>/import</b>: همون فایل پشتیبان رو با کپشن /import بفرستید تا یادداشت‌هاتون برگرده.
+
+<b>برای شروع، اولین نکته‌ای که می‌خواید یادتون بمونه رو برای من بفرستید.</b>
+"""
+
+# =================================================================
+# بخش دیتابیس (استخر اتصال async)
+# =================================================================
+
+db_pool: AsyncConnectionPool | None = None
+
+async def open_db_pool() -> None:
+    global db_pool
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        check=AsyncConnectionPool.check_connection,
+        kwargs={"cursor_factory": InstrumentedCursor},
+        open=False,
+    )
+    try:
+        await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    except PoolTimeout as e:
+        logger.error(f"FATAL: Could not connect to PostgreSQL database: {e}")
+        raise
+    logger.info(f"Database pool opened (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}, timeout={DB_POOL_TIMEOUT}s).")
+    await open_read_replica()
+
+async def close_db_pool() -> None:
+    await stop_read_replica()
+    if db_pool is not None:
+        await db_pool.close()
+        logger.info("Database pool closed.")
+
+# --- مسیریابی خواندن‌ها بین primary و رپلیکا ---
+
+read_pool: AsyncConnectionPool | None = None
+replica_monitor_task: asyncio.Task | None = None
+
+# روی primary (مثلاً وقتی READ_DATABASE_URL به خود primary اشاره می‌کند) عقب‌ماندگی صفر است. رپلیکایی که
+# streaming آن قطع است همه آنچه گرفته را بازپخش کرده ولی ممکن است دلخواه عقب باشد؛ پس NULL (در دسترس نیست).
+# فقط وقتی streaming برقرار است و همه WAL رسیده بازپخش شده، رپلیکا عقب نیست، حتی اگر آخرین تراکنش بازپخش‌شده
+# قدیمی باشد (primary بیکار). status در pg_stat_wal_receiver فقط برای نقش‌های عضو pg_read_all_stats دیده می‌شود.
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+# بدون pg_read_all_stats ستون status برای این نقش NULL خوانده می‌شود و رپلیکا همیشه «در دسترس نیست» به نظر می‌رسد.
+REPLICA_PRIVILEGE_QUERY = "SELECT NOT pg_is_in_recovery() OR pg_has_role('pg_read_all_stats', 'USAGE'), current_user"
+
+class ReadRouter:
+    # خواندن‌ها به رپلیکا می‌روند مگر اینکه رپلیکا تعریف نشده، در دسترس نیست یا بیش از حد عقب است،
+    # یا همین کاربر در READ_YOUR_WRITES_SECONDS گذشته چیزی نوشته باشد (تا تغییر خودش را حتماً ببیند).
+    def __init__(self, max_lag: float, sticky_seconds: float):
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.lag: float | None = None  # None یعنی رپلیکا هنوز بررسی نشده یا در دسترس نیست
+        self.recent_writers: OrderedDict[int, float] = OrderedDict()
+
+    def note_write(self, user_id: int) -> None:
+        now = time.monotonic()
+        self.recent_writers[user_id] = now + self.sticky_seconds
+        self.recent_writers.move_to_end(user_id)
+        # مهلت‌ها به ترتیب درج منقضی می‌شوند، پس کافی است از ابتدای صف پاک شود.
+        while self.recent_writers and next(iter(self.recent_writers.values())) <= now:
+            self.recent_writers.popitem(last=False)
+
+    def use_replica(self, user_id: int | None) -> bool:
+        if read_pool is None or self.lag is None or self.lag > self.max_lag:
+            return False
+        expires_at = self.recent_writers.get(user_id) if user_id is not None else None
+        return expires_at is None or expires_at <= time.monotonic()
+
+    def pool(self, user_id: int | None = None) -> AsyncConnectionPool:
+        if self.use_replica(user_id):
+            db_reads.labels("replica").inc()
+            return read_pool
+        db_reads.labels("primary").inc()
+        return db_pool
+
+    def set_lag(self, lag: float | None) -> None:
+        healthy = self.lag is not None and self.lag <= self.max_lag
+        self.lag = lag
+        read_replica_lag.set(-1 if lag is None else lag)
+        if healthy and (lag is None or lag > self.max_lag):
+            logger.warning(f"Read replica is {'unreachable' if lag is None else f'{lag:.1f}s behind'}; reading from the primary.")
+        elif not healthy and lag is not None and lag <= self.max_lag:
+            logger.info(f"Read replica is {lag:.1f}s behind; routing reads to it.")
+
+read_router = ReadRouter(READ_REPLICA_MAX_LAG, READ_YOUR_WRITES_SECONDS)
+
+async def monitor_replica_lag() -> None:
+    privileges_checked = False
+    while True:
+        try:
+            async with read_pool.connection() as conn:
+                if not privileges_checked:
+                    cursor = await conn.execute(REPLICA_PRIVILEGE_QUERY)
+                    can_read_status, role = await cursor.fetchone()
+                    if not can_read_status:
+                        logger.error(
+                            f"Read replica disabled: role '{role}' cannot read pg_stat_wal_receiver.status, so replica lag "
+                            f"cannot be measured. Grant it pg_read_all_stats and restart; reading from the primary."
+                        )
+                        return
+                    privileges_checked = True
+                cursor = await conn.execute(REPLICA_LAG_QUERY)
+                lag = (await cursor.fetchone())[0]
+            read_router.set_lag(None if lag is None else float(lag))
+        except psycopg.Error as e:
+            logger.debug(f"Read replica lag check failed: {e}")
+            read_router.set_lag(None)
+        await asyncio.sleep(READ_REPLICA_CHECK_INTERVAL)
+
+async def open_read_replica() -> None:
+    global read_pool, replica_monitor_task
+    if not READ_DATABASE_URL:
+        return
+    # اتصال‌ها در پس‌زمینه باز می‌شوند؛ رپلیکای در دسترس‌نبودن جلوی بالا آمدن ربات را نمی‌گیرد.
+    read_pool = AsyncConnectionPool(
+        READ_DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=READ_DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        check=AsyncConnectionPool.check_connection,
+        kwargs={"cursor_factory": InstrumentedCursor},
+        open=False,
+    )
+    await read_pool.open(wait=False)
+    replica_monitor_task = asyncio.create_task(monitor_replica_lag())
+    logger.info(f"Read replica pool opened (max={READ_DB_POOL_MAX_SIZE}, max lag={READ_REPLICA_MAX_LAG}s).")
+
+async def stop_read_replica() -> None:
+    if replica_monitor_task is not None:
+        replica_monitor_task.cancel()
+        await asyncio.gather(replica_monitor_task, return_exceptions=True)
+    if read_pool is not None:
+        await read_pool.close()
+        logger.info("Read replica pool closed.")
+
+# =================================================================
+# مهاجرت‌های نسخه‌دار پایگاه داده
+# =================================================================
+# هر مهاجرت فقط یک بار اجرا و در schema_migrations ثبت می‌شود. مهاجرت‌های اولیه
+# idempotent هستند تا دیتابیس‌هایی که قبلاً با init_db قدیمی ساخته شده‌اند هم پذیرفته شوند.
+# مهاجرت‌هایی که transactional=False دارند (مثل CREATE INDEX CONCURRENTLY) بیرون از تراکنش اجرا می‌شوند.
+
+MIGRATIONS = []
+
+def migration(version: int, name: str, transactional: bool = True):
+    def register(func):
+        MIGRATIONS.append((version, name, func, transactional))
+        return func
+    return register
+
+async def create_index_concurrently(conn, name: str, definition: str) -> None:
+    # ایندکسی که ساختش با CONCURRENTLY نیمه‌کاره مانده INVALID است و باید از نو ساخته شود.
+    cursor = await conn.execute("""
+    SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+    """, (name,))
+    row = await cursor.fetchone()
+    if row and row[0]:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+@migration(1, "initial schema")
+async def migrate_initial_schema(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        leitner_box INTEGER NOT NULL DEFAULT 1,
+        UNIQUE(user_id, message_id)
+    );
+    """)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        user_id BIGINT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY(user_id, key)
+    );
+    """)
+
+@migration(2, "review schedule columns")
+async def migrate_review_schedule(conn):
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS next_review_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS last_reviewed_at TIMESTAMPTZ")
+
+@migration(3, "due review index", transactional=False)
+async def migrate_due_index(conn):
+    await create_index_concurrently(conn, "idx_messages_user_due", "messages (user_id, next_review_at)")
+
+@migration(4, "delivery outbox")
+async def migrate_outbox(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        from_chat_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        method TEXT NOT NULL CHECK (method IN ('copy', 'forward')),
+        with_review_keyboard BOOLEAN NOT NULL DEFAULT FALSE,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_available ON outbox (available_at, id)")
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_review_runs (
+        user_id BIGINT NOT NULL,
+        run_date DATE NOT NULL,
+        PRIMARY KEY(user_id, run_date)
+    );
+    """)
+
+async def create_box_count_triggers(conn, table: str) -> None:
+    await conn.execute(f"DROP TRIGGER IF EXISTS {table}_box_counts_insert ON {table}")
+    await conn.execute(f"DROP TRIGGER IF EXISTS {table}_box_counts_update ON {table}")
+    await conn.execute(f"DROP TRIGGER IF EXISTS {table}_box_counts_delete ON {table}")
+    await conn.execute(f"""
+    CREATE TRIGGER {table}_box_counts_insert AFTER INSERT ON {table}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_user_box_count_deltas();
+    """)
+    await conn.execute(f"""
+    CREATE TRIGGER {table}_box_counts_update AFTER UPDATE ON {table}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_user_box_count_deltas();
+    """)
+    await conn.execute(f"""
+    CREATE TRIGGER {table}_box_counts_delete AFTER DELETE ON {table}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_user_box_count_deltas();
+    """)
+
+async def create_register_users_trigger(conn) -> None:
+    await conn.execute("DROP TRIGGER IF EXISTS messages_register_users ON messages")
+    await conn.execute("""
+    CREATE TRIGGER messages_register_users AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_message_users();
+    """)
+
+async def create_box_count_schema(conn):
+    # شمارنده‌های هر جعبه با تریگرهای سطح دستور (با جدول‌های انتقالی) در همان تراکنش نوشتن به‌روز می‌شوند.
+    await conn.execute("""
+    CREATE OR REPLACE FUNCTION apply_user_box_count_deltas() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, COUNT(*) FROM new_rows
+            GROUP BY user_id, leitner_box ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, -COUNT(*) FROM old_rows
+            GROUP BY user_id, leitner_box ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        ELSE
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, SUM(delta) FROM (
+                SELECT user_id, leitner_box, 1 AS delta FROM new_rows
+                UNION ALL
+                SELECT user_id, leitner_box, -1 AS delta FROM old_rows
+            ) changes
+            GROUP BY user_id, leitner_box HAVING SUM(delta) <> 0 ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_box_counts (
+        user_id BIGINT NOT NULL,
+        leitner_box INTEGER NOT NULL,
+        count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, leitner_box)
+    );
+    """)
+    await create_box_count_triggers(conn, "messages")
+
+async def reconcile_box_counts_range(conn, after_user_id: int, last_user_id: int) -> None:
+    # قفل فقط نوشتن‌ها را (تا پایان شمارش همین بازه از کاربران) نگه می‌دارد و نوشتن‌های نیمه‌کاره قبلی را هم منتظر می‌ماند.
+    await conn.execute("LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE")
+    await conn.execute("DELETE FROM user_box_counts WHERE user_id > %s AND user_id <= %s", (after_user_id, last_user_id))
+    await conn.execute("""
+    INSERT INTO user_box_counts (user_id, leitner_box, count)
+    SELECT user_id, leitner_box, COUNT(*) FROM messages WHERE user_id > %s AND user_id <= %s
+    GROUP BY user_id, leitner_box
+    """, (after_user_id, last_user_id))
+
+@migration(5, "per-user box counters", transactional=False)
+async def migrate_box_counts(conn):
+    # تریگرها اول ساخته می‌شوند تا از همین لحظه هر تغییر شمرده شود؛ بعد شمارنده‌ها دسته‌دسته (بازه‌ای از user_id)
+    # از روی messages بازسازی می‌شوند. شمارنده کاربری که هنوز نوبتش نرسیده تا بازسازی بازه‌اش ممکن است نادرست باشد.
+    await apply_migration(conn, create_box_count_schema, transactional=True)
+    last_user_id = -1
+    while True:
+        cursor = await conn.execute("""
+        SELECT max(user_id) FROM (
+            SELECT DISTINCT user_id FROM messages WHERE user_id > %s ORDER BY user_id LIMIT %s
+        ) AS batch
+        """, (last_user_id, MIGRATION_BATCH_SIZE))
+        batch_max = (await cursor.fetchone())[0]
+        if batch_max is None:
+            break
+        await apply_migration(conn, functools.partial(reconcile_box_counts_range, after_user_id=last_user_id, last_user_id=batch_max), transactional=True)
+        last_user_id = batch_max
+
+@migration(6, "box listing index", transactional=False)
+async def migrate_box_index(conn):
+    await create_index_concurrently(conn, "idx_messages_user_box_id", "messages (user_id, leitner_box, id)")
+
+@migration(7, "users table")
+async def migrate_users(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    # هر مسیری که یادداشت اضافه کند (از جمله درج گروهی) کاربر را هم ثبت می‌کند.
+    await conn.execute("""
+    CREATE OR REPLACE FUNCTION register_message_users() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO users (user_id, chat_id)
+        SELECT DISTINCT ON (user_id) user_id, chat_id FROM new_rows ORDER BY user_id
+        ON CONFLICT (user_id) DO NOTHING;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    await create_register_users_trigger(conn)
+
+@migration(8, "users backfill", transactional=False)
+async def migrate_users_backfill(conn):
+    # پر کردن تدریجی users به ترتیب user_id؛ هر دسته یک تراکنش کوتاه است و جلوی نوشتن روی messages را نمی‌گیرد.
+    last_user_id = -1
+    while True:
+        cursor = await conn.execute("""
+        WITH batch AS (
+            SELECT DISTINCT ON (user_id) user_id, chat_id FROM messages
+            WHERE user_id > %s ORDER BY user_id, id DESC LIMIT %s
+        ), inserted AS (
+            INSERT INTO users (user_id, chat_id) SELECT user_id, chat_id FROM batch
+            ON CONFLICT (user_id) DO NOTHING
+        )
+        SELECT max(user_id) FROM batch
+        """, (last_user_id, MIGRATION_BATCH_SIZE))
+        batch_max = (await cursor.fetchone())[0]
+        if batch_max is None:
+            break
+        last_user_id = batch_max
+
+@migration(9, "outbox delivery batches")
+async def migrate_outbox_batches(conn):
+    await conn.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS batch_key TEXT")
+
+@migration(10, "outbox batch index", transactional=False)
+async def migrate_outbox_batch_index(conn):
+    await create_index_concurrently(conn, "idx_outbox_batch_key", "outbox (batch_key) WHERE batch_key IS NOT NULL")
+
+@migration(11, "card failure tracking")
+async def migrate_card_failures(conn):
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS failure_count INTEGER NOT NULL DEFAULT 0")
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS tombstoned_at TIMESTAMPTZ")
+
+@migration(12, "tombstone index", transactional=False)
+async def migrate_tombstone_index(conn):
+    await create_index_concurrently(conn, "idx_messages_tombstoned", "messages (tombstoned_at) WHERE tombstoned_at IS NOT NULL")
+
+@migration(13, "user activity state")
+async def migrate_user_activity(conn):
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT TRUE")
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ")
+
+@migration(14, "active users index", transactional=False)
+async def migrate_active_users_index(conn):
+    await create_index_concurrently(conn, "idx_users_active", "users (user_id) WHERE active")
+
+@migration(15, "per-user delivery schedule")
+async def migrate_delivery_schedule(conn):
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone TEXT")
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS review_time TIME")
+    # NULL یعنی هنوز زمان‌بندی نشده؛ زمان‌بند در اولین tick آن را پر می‌کند.
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS next_delivery_at TIMESTAMPTZ")
+    # اولین لحظه بعد از after که ساعت محلی tz برابر local_time است (تغییر ساعت تابستانی را Postgres حساب می‌کند).
+    await conn.execute("""
+    CREATE OR REPLACE FUNCTION next_delivery_time(tz TEXT, local_time TIME, after TIMESTAMPTZ) RETURNS TIMESTAMPTZ AS $$
+        SELECT CASE
+            WHEN ((after AT TIME ZONE tz)::date + local_time) AT TIME ZONE tz > after
+            THEN ((after AT TIME ZONE tz)::date + local_time) AT TIME ZONE tz
+            ELSE ((after AT TIME ZONE tz)::date + 1 + local_time) AT TIME ZONE tz
+        END
+    $$ LANGUAGE sql STABLE;
+    """)
+
+@migration(16, "next delivery index", transactional=False)
+async def migrate_next_delivery_index(conn):
+    await create_index_concurrently(conn, "idx_users_next_delivery", "users (next_delivery_at) WHERE active")
+
+# ستون‌های messages به ترتیب، همان‌طور که هنگام کپی به جدول پارتیشن‌شده (مهاجرت ۱۸) بودند.
+MESSAGE_COLUMNS = (
+    "id, user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at, "
+    "failure_count, tombstoned_at, mastered_at"
+)
+# همه ستون‌هایی که با کارت بین messages و بایگانی جابه‌جا می‌شوند.
+CARD_COLUMNS = MESSAGE_COLUMNS + ", content_text, content_tsv"
+
+# هنگام کپی به جدول پارتیشن‌شده، کارت‌هایی که از قبل در آخرین جعبه‌اند از آخرین مرورشان مسلط حساب می‌شوند.
+PARTITION_COPY_COLUMNS = MESSAGE_COLUMNS.replace(
+    "mastered_at", f"CASE WHEN leitner_box = {MAX_LEITNER_BOX} THEN COALESCE(mastered_at, last_reviewed_at, now()) END"
+)
+
+@migration(17, "mastered card timestamp")
+async def migrate_mastered_at(conn):
+    # لحظه ورود کارت به آخرین جعبه؛ برای کارت‌های جعبه‌های دیگر NULL است.
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS mastered_at TIMESTAMPTZ")
+
+async def copy_captured_message_changes(conn, limit: int) -> int:
+    # ردیف‌هایی که حین کپی عوض شده‌اند از نو از جدول قدیمی خوانده می‌شوند (حذف‌شده‌ها دیگر برنمی‌گردند).
+    async with conn.transaction():
+        cursor = await conn.execute("""
+        DELETE FROM messages_partition_changes
+        WHERE id IN (SELECT id FROM messages_partition_changes LIMIT %s) RETURNING id
+        """, (limit,))
+        ids = [row[0] for row in await cursor.fetchall()]
+        if ids:
+            await conn.execute("DELETE FROM messages_partitioned WHERE id = ANY(%s)", (ids,))
+            await conn.execute(f"""
+            INSERT INTO messages_partitioned ({MESSAGE_COLUMNS})
+            SELECT {PARTITION_COPY_COLUMNS} FROM messages WHERE id = ANY(%s)
+            """, (ids,))
+    return len(ids)
+
+@migration(18, "hash-partitioned messages", transactional=False)
+async def migrate_partition_messages(conn):
+    # جدول پارتیشن‌شده کنار جدول فعلی دسته‌دسته پر می‌شود و تغییرات هم‌زمان با یک trigger ردیفی ثبت می‌شوند؛
+    # فقط جابه‌جایی نهایی نام‌ها (چند میلی‌ثانیه) جلوی خواندن و نوشتن را می‌گیرد.
+    cursor = await conn.execute("SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass")
+    if (await cursor.fetchone())[0] != 'p':
+        # باقی‌مانده یک اجرای نیمه‌کاره از نو ساخته می‌شود.
+        await conn.execute("DROP TRIGGER IF EXISTS messages_capture_changes ON messages")
+        await conn.execute("DROP TABLE IF EXISTS messages_partitioned, messages_partition_changes")
+        # کلید اصلی باید کلید پارتیشن را داشته باشد؛ id اول می‌آید تا جست‌وجو فقط با id هم از ایندکس استفاده کند.
+        await conn.execute("""
+        CREATE TABLE messages_partitioned (
+            LIKE messages INCLUDING DEFAULTS,
+            PRIMARY KEY (id, user_id),
+            UNIQUE (user_id, message_id)
+        ) PARTITION BY HASH (user_id)
+        """)
+        for remainder in range(MESSAGES_PARTITIONS):
+            await conn.execute(
+                f"CREATE TABLE messages_p{remainder} PARTITION OF messages_partitioned "
+                f"FOR VALUES WITH (MODULUS {MESSAGES_PARTITIONS}, REMAINDER {remainder})"
+            )
+        # جدول هنوز خالی است، پس ایندکس‌ها بدون CONCURRENTLY ساخته می‌شوند؛ نامشان بعد از جابه‌جایی درست می‌شود.
+        await conn.execute("CREATE INDEX idx_messages_user_due_new ON messages_partitioned (user_id, next_review_at)")
+        await conn.execute("CREATE INDEX idx_messages_user_box_id_new ON messages_partitioned (user_id, leitner_box, id)")
+        await conn.execute("CREATE INDEX idx_messages_tombstoned_new ON messages_partitioned (tombstoned_at) WHERE tombstoned_at IS NOT NULL")
+        await conn.execute("CREATE INDEX idx_messages_mastered ON messages_partitioned (mastered_at) WHERE mastered_at IS NOT NULL")
+
+        await conn.execute("CREATE TABLE messages_partition_changes (id BIGINT PRIMARY KEY)")
+        await conn.execute("""
+        CREATE OR REPLACE FUNCTION capture_message_changes() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO messages_partition_changes (id)
+            VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)
+            ON CONFLICT (id) DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """)
+        await conn.execute("""
+        CREATE TRIGGER messages_capture_changes AFTER INSERT OR UPDATE OR DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION capture_message_changes();
+        """)
+
+        last_id = 0
+        while True:
+            cursor = await conn.execute(f"""
+            WITH batch AS (
+                SELECT {PARTITION_COPY_COLUMNS} FROM messages WHERE id > %s ORDER BY id LIMIT %s
+            ), copied AS (
+                INSERT INTO messages_partitioned ({MESSAGE_COLUMNS}) SELECT * FROM batch
+                ON CONFLICT DO NOTHING
+            )
+            SELECT max(id) FROM batch
+            """, (last_id, MIGRATION_BATCH_SIZE))
+            batch_max = (await cursor.fetchone())[0]
+            if batch_max is None:
+                break
+            last_id = batch_max
+        while await copy_captured_message_changes(conn, MIGRATION_BATCH_SIZE) == MIGRATION_BATCH_SIZE:
+            pass
+
+        for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+            try:
+                async with conn.transaction():
+                    await conn.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+                    await conn.execute("LOCK TABLE messages, messages_partitioned IN ACCESS EXCLUSIVE MODE")
+                    while await copy_captured_message_changes(conn, MIGRATION_BATCH_SIZE):
+                        pass
+                    await conn.execute("DROP TRIGGER messages_capture_changes ON messages")
+                    await conn.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+                    await conn.execute("ALTER TABLE messages_partitioned RENAME TO messages")
+                    await conn.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+                    await create_box_count_triggers(conn, "messages")
+                    await create_register_users_trigger(conn)
+                break
+            except psycopg.errors.LockNotAvailable:
+                if attempt == MIGRATION_LOCK_RETRIES:
+                    raise
+                logger.warning(f"Partition swap could not lock messages in time (attempt {attempt}), retrying...")
+                await asyncio.sleep(attempt)
+
+    await conn.execute("DROP TABLE IF EXISTS messages_unpartitioned, messages_partition_changes")
+    await conn.execute("DROP FUNCTION IF EXISTS capture_message_changes()")
+    for name in ("idx_messages_user_due", "idx_messages_user_box_id", "idx_messages_tombstoned"):
+        await conn.execute(f"ALTER INDEX IF EXISTS {name}_new RENAME TO {name}")
+    for name in ("pkey", "user_id_message_id_key"):
+        cursor = await conn.execute(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = 'messages'::regclass AND conname = %s", (f"messages_partitioned_{name}",)
+        )
+        if await cursor.fetchone():
+            await conn.execute(f"ALTER TABLE messages RENAME CONSTRAINT messages_partitioned_{name} TO messages_{name}")
+
+@migration(19, "mastered card archive")
+async def migrate_messages_archive(conn):
+    # کارت‌های بایگانی‌شده در شمارنده‌های جعبه می‌مانند، پس آمار و «نمایش همه» آن‌ها را هم می‌بینند.
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS messages_archive (
+        LIKE messages,
+        archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id),
+        UNIQUE (user_id, message_id)
+    )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_archive_user_id ON messages_archive (user_id, id)")
+    await create_box_count_triggers(conn, "messages_archive")
+
+@migration(20, "review event log and rollups")
+async def migrate_review_events(conn):
+    # review_events فقط اضافه می‌شود و تحلیل‌ها به‌جای messages روی آن و جدول‌های تجمیعی اجرا می‌شوند.
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS review_events (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        action TEXT NOT NULL CHECK (action IN ('up', 'reset', 'delete')),
+        from_box INTEGER,
+        to_box INTEGER,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    # روز بر حسب منطقه زمانی کاربر در لحظه تجمیع است.
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS review_stats_daily (
+        user_id BIGINT NOT NULL,
+        day DATE NOT NULL,
+        ups INTEGER NOT NULL DEFAULT 0,
+        resets INTEGER NOT NULL DEFAULT 0,
+        deletes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, day)
+    );
+    """)
+    # به تفکیک جعبه‌ای که کارت هنگام مرور در آن بود؛ نسبت ups به resets هر جعبه برای تنظیم فاصله‌ها است.
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS review_stats_users (
+        user_id BIGINT NOT NULL,
+        leitner_box INTEGER NOT NULL,
+        ups BIGINT NOT NULL DEFAULT 0,
+        resets BIGINT NOT NULL DEFAULT 0,
+        deletes BIGINT NOT NULL DEFAULT 0,
+        last_review_at TIMESTAMPTZ,
+        PRIMARY KEY(user_id, leitner_box)
+    );
+    """)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS review_rollup_state (
+        name TEXT PRIMARY KEY,
+        last_event_id BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    await conn.execute("INSERT INTO review_rollup_state (name) VALUES ('review_stats') ON CONFLICT (name) DO NOTHING")
+
+@migration(21, "note text columns")
+async def migrate_note_text(conn):
+    # متن یا کپشن یادداشت هنگام ذخیره نگه داشته می‌شود؛ یادداشت‌های قدیمی‌تر متن ندارند و در جست‌وجو نمی‌آیند.
+    # content_tsv ستون تولیدشده نیست تا اضافه کردنش کل جدول را بازنویسی نکند؛ هنگام درج پر می‌شود.
+    for table in ("messages", "messages_archive"):
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_text TEXT")
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR")
+
+async def create_partitioned_index_concurrently(conn, name: str, table: str, definition: str) -> None:
+    # روی جدول پارتیشن‌شده CONCURRENTLY ممکن نیست: ایندکس والد با ON ONLY (نامعتبر) ساخته می‌شود، ایندکس هر
+    # پارتیشن با CONCURRENTLY ساخته و به آن وصل می‌شود و با وصل شدن آخرین پارتیشن، ایندکس والد معتبر می‌شود.
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    cursor = await conn.execute(
+        "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1", (table,)
+    )
+    for (partition,) in await cursor.fetchall():
+        partition_index = f"{name}_{partition.rsplit('_', 1)[-1]}"
+        await create_index_concurrently(conn, partition_index, f"{partition} {definition}")
+        await conn.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+@migration(22, "note text search indexes", transactional=False)
+async def migrate_note_search_indexes(conn):
+    await create_partitioned_index_concurrently(
+        conn, "idx_messages_content_tsv", "messages", "USING GIN (content_tsv) WHERE content_tsv IS NOT NULL"
+    )
+    await create_index_concurrently(
+        conn, "idx_messages_archive_content_tsv", "messages_archive USING GIN (content_tsv) WHERE content_tsv IS NOT NULL"
+    )
+    # trigram برای پیدا کردن بخشی از کلمه (مثلاً «کتاب» در «کتابخانه» یا پسوندها) است؛ بدون pg_trgm جست‌وجو
+    # فقط کلمه‌ها و ابتدای کلمه‌ها را پیدا می‌کند.
+    cursor = await conn.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    if await cursor.fetchone() is None:
+        logger.warning("pg_trgm is not available; /search will only match whole words and word prefixes.")
+        return
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg.errors.InsufficientPrivilege as e:
+        logger.warning(f"Cannot create pg_trgm ({e}); /search will only match whole words and word prefixes.")
+        return
+    await create_partitioned_index_concurrently(
+        conn, "idx_messages_content_trgm", "messages", "USING GIN (content_text gin_trgm_ops) WHERE content_text IS NOT NULL"
+    )
+    await create_index_concurrently(
+        conn, "idx_messages_archive_content_trgm",
+        "messages_archive USING GIN (content_text gin_trgm_ops) WHERE content_text IS NOT NULL"
+    )
+
+@migration(23, "drop daily review runs")
+async def migrate_drop_daily_review_runs(conn):
+    # از وقتی workerها کاربران را با SKIP LOCKED بین خود تقسیم می‌کنند، این جدول خوانده یا نوشته نمی‌شود.
+    await conn.execute("DROP TABLE IF EXISTS daily_review_runs")
+
+@migration(24, "box counters skip tombstoned cards")
+async def migrate_box_counts_skip_tombstoned(conn):
+    # کارت tombstone‌شده دیگر انتخاب یا نمایش داده نمی‌شود، پس از همان لحظه از شمارنده جعبه‌اش کم می‌شود و حذف بعدی‌اش
+    # در sweep شمارنده را تغییر نمی‌دهد. قفل نوشتن‌ها تا جایگزینی تابع و کم کردن کارت‌های tombstone‌شده فعلی نگه داشته می‌شود.
+    await conn.execute("LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE")
+    await conn.execute("""
+    CREATE OR REPLACE FUNCTION apply_user_box_count_deltas() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, COUNT(*) FROM new_rows WHERE tombstoned_at IS NULL
+            GROUP BY user_id, leitner_box ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, -COUNT(*) FROM old_rows WHERE tombstoned_at IS NULL
+            GROUP BY user_id, leitner_box ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        ELSE
+            INSERT INTO user_box_counts (user_id, leitner_box, count)
+            SELECT user_id, leitner_box, SUM(delta) FROM (
+                SELECT user_id, leitner_box, 1 AS delta FROM new_rows WHERE tombstoned_at IS NULL
+                UNION ALL
+                SELECT user_id, leitner_box, -1 AS delta FROM old_rows WHERE tombstoned_at IS NULL
+            ) changes
+            GROUP BY user_id, leitner_box HAVING SUM(delta) <> 0 ORDER BY user_id, leitner_box
+            ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = user_box_counts.count + EXCLUDED.count;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    await conn.execute("""
+    UPDATE user_box_counts AS c SET count = c.count - t.count
+    FROM (
+        SELECT user_id, leitner_box, COUNT(*) AS count FROM messages WHERE tombstoned_at IS NOT NULL
+        GROUP BY user_id, leitner_box
+    ) t
+    WHERE c.user_id = t.user_id AND c.leitner_box = t.leitner_box
+    """)
+
+@migration(25, "outbox user message index", transactional=False)
+async def migrate_outbox_user_message_index(conn):
+    # غیرفعال کردن کاربر (حذف صفش) و جایگزینی کارت خراب (بررسی تکراری نبودن) بدون آن کل صف را می‌خواندند.
+    await create_index_concurrently(conn, "idx_outbox_user_message", "outbox (user_id, message_id)")
+
+async def init_db():
+    global search_uses_trigram
+    async with db_pool.connection() as conn:
+        await conn.set_autocommit(True)
+        try:
+            # فقط یک پردازه در هر لحظه مهاجرت‌ها را اجرا می‌کند.
+            await conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """)
+            cursor = await conn.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in await cursor.fetchall()}
+            for version, name, apply, transactional in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                logger.info(f"Applying database migration {version}: {name}...")
+                await apply_migration(conn, apply, transactional)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            cursor = await conn.execute("SELECT to_regclass('idx_messages_content_trgm') IS NOT NULL")
+            search_uses_trigram = (await cursor.fetchone())[0]
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+            await conn.set_autocommit(False)
+    logger.info("Database PostgreSQL initialized for Multi-User Leitner system.")
+
+async def apply_migration(conn, apply, transactional: bool) -> None:
+    if not transactional:
+        await apply(conn)
+        return
+    # با lock_timeout کوتاه، DDL پشت تراکنش‌های طولانی صف نمی‌کشد و جلوی ترافیک زنده را نمی‌گیرد؛ بعد دوباره تلاش می‌کنیم.
+    for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+        try:
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+                await apply(conn)
+            return
+        except psycopg.errors.LockNotAvailable:
+            if attempt == MIGRATION_LOCK_RETRIES:
+                raise
+            logger.warning(f"Migration could not get its locks in time (attempt {attempt}), retrying...")
+            await asyncio.sleep(attempt)
+
+
+# =================================================================
+# تجمیع نوشتن‌ها (Write batching)
+# =================================================================
+# ضربه‌های دکمه‌های مرور و یادداشت‌های جدید در چند میلی‌ثانیه جمع می‌شوند و هر دسته با یک
+# دستور چندردیفی (unnest) و یک commit نوشته می‌شود؛ هر فراخواننده نتیجه خودش را از Future می‌گیرد.
+
+class WriteBatcher:
+    def __init__(self, name: str, flush, max_batch: int, max_delay: float):
+        self.name = name
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: list[tuple[tuple, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.flush_tasks: set[asyncio.Task] = set()
+
+    def submit(self, item: tuple) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self._start_flush)
+        return future
+
+    def _start_flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._flush_batch(batch))
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+
+    async def _flush_batch(self, batch: list) -> None:
+        items = [item for item, _ in batch]
+        try:
+            for attempt in range(2):
+                try:
+                    results = await self.flush(items)
+                    break
+                except psycopg.errors.DeadlockDetected:
+                    if attempt == 1:
+                        raise
+                    logger.warning(f"Deadlock while flushing {self.name} batch of {len(items)}, retrying once.")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self) -> None:
+        self._start_flush()
+        await asyncio.gather(*self.flush_tasks, return_exceptions=True)
+
+
+async def flush_message_inserts(items: list) -> list:
+    user_ids, chat_ids, message_ids, content_texts = (list(column) for column in zip(*items))
+    search_texts = [normalize_search_text(text) if text else None for text in content_texts]
+    async with db_pool.connection() as conn:
+        await conn.execute("""
+        INSERT INTO messages (user_id, chat_id, message_id, leitner_box, content_text, content_tsv)
+        SELECT user_id, chat_id, message_id, 1, content_text, to_tsvector('simple', search_text)
+        FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[], %s::text[], %s::text[])
+            AS v(user_id, chat_id, message_id, content_text, search_text)
+        WHERE NOT EXISTS (SELECT 1 FROM messages_archive AS a WHERE a.user_id = v.user_id AND a.message_id = v.message_id)
+        ON CONFLICT (user_id, message_id) DO NOTHING;
+        """, (user_ids, chat_ids, message_ids, content_texts, search_texts))
+    return [True] * len(items)
+
+def split_into_rounds(keys: list) -> list[list[int]]:
+    # اندیس‌ها را طوری دسته می‌کند که هر کلید در هر دسته حداکثر یک بار باشد؛ تکرار n-ام یک کلید در دسته n-ام
+    # می‌آید، پس با اجرای دسته‌ها به ترتیب، تکرارهای هر کلید به ترتیب رسیدن اعمال می‌شوند.
+    rounds: list[list[int]] = []
+    round_keys: list[set] = []
+    for index, key in enumerate(keys):
+        for keys_in_round, indexes in zip(round_keys, rounds):
+            if key not in keys_in_round:
+                keys_in_round.add(key)
+                indexes.append(index)
+                break
+        else:
+            round_keys.append({key})
+            rounds.append([index])
+    return rounds
+
+async def flush_box_moves(items: list) -> list:
+    # UPDATE ... FROM برای کلید تکراری فقط یک ردیف را به‌روز می‌کند؛ پس ضربه‌های تکراری روی یک کارت
+    # در زیردسته‌های جداگانه (به ترتیب رسیدن) و همگی در یک تراکنش اجرا می‌شوند.
+    rounds = split_into_rounds([(user_id, message_id) for user_id, message_id, _ in items])
+
+    # نتیجه هر ضربه: (جعبه قبل، جعبه بعد)؛ (0, 0) یعنی کارت پیدا نشد.
+    results = [(0, 0)] * len(items)
+    async with db_pool.connection() as conn:
+        async def apply_moves(indexes: list[int]) -> None:
+            new_box = f"CASE WHEN v.direction = 'up' THEN LEAST(m.leitner_box + 1, {MAX_LEITNER_BOX}) ELSE 1 END"
+            cursor = await conn.execute(f"""
+            UPDATE messages AS m
+            SET leitner_box = {new_box},
+                last_reviewed_at = now(),
+                next_review_at = now() + (%s::interval[])[{new_box}],
+                mastered_at = CASE WHEN {new_box} = {MAX_LEITNER_BOX} THEN COALESCE(m.mastered_at, now()) END
+            FROM unnest(%s::bigint[], %s::bigint[], %s::text[]) AS v(user_id, message_id, direction), messages AS old
+            WHERE m.user_id = v.user_id AND m.message_id = v.message_id AND old.id = m.id AND old.user_id = m.user_id
+            RETURNING m.user_id, m.message_id, old.leitner_box, m.leitner_box;
+            """, (
+                LEITNER_BOX_INTERVALS,
+                [items[i][0] for i in indexes],
+                [items[i][1] for i in indexes],
+                [items[i][2] for i in indexes],
+            ))
+            moves = {(row[0], row[1]): (row[2], row[3]) for row in await cursor.fetchall()}
+            for i in indexes:
+                results[i] = moves.get((items[i][0], items[i][1]), (0, 0))
+
+        for indexes in rounds:
+            await apply_moves(indexes)
+            # کارتی که در messages نبود شاید بایگانی شده باشد (مثلاً از نمای جعبه زده شده)؛ به messages برمی‌گردد.
+            missing = [i for i in indexes if not results[i][1]]
+            if missing and await restore_archived_cards(conn, [items[i][0] for i in missing], [items[i][1] for i in missing]):
+                await apply_moves(missing)
+    return results
+
+async def restore_archived_cards(conn, user_ids: list, message_ids: list) -> int:
+    cursor = await conn.execute(f"""
+    WITH restored AS (
+        DELETE FROM messages_archive AS a
+        USING unnest(%s::bigint[], %s::bigint[]) AS v(user_id, message_id)
+        WHERE a.user_id = v.user_id AND a.message_id = v.message_id
+        RETURNING {", ".join("a." + column for column in CARD_COLUMNS.split(", "))}
+    )
+    INSERT INTO messages ({CARD_COLUMNS}) SELECT {CARD_COLUMNS} FROM restored
+    """, (user_ids, message_ids))
+    return cursor.rowcount
+
+
+async def flush_review_events(items: list) -> list:
+    user_ids, message_ids, actions, from_boxes, to_boxes = (list(column) for column in zip(*items))
+    async with db_pool.connection() as conn:
+        await conn.execute("""
+        INSERT INTO review_events (user_id, message_id, action, from_box, to_box)
+        SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::text[], %s::int[], %s::int[]);
+        """, (user_ids, message_ids, actions, from_boxes, to_boxes))
+    return [True] * len(items)
+
+
+message_insert_batcher = WriteBatcher("message insert", flush_message_inserts, WRITE_BATCH_MAX_SIZE, WRITE_BATCH_MAX_DELAY)
+box_move_batcher = WriteBatcher("box move", flush_box_moves, WRITE_BATCH_MAX_SIZE, WRITE_BATCH_MAX_DELAY)
+# رویدادها در پس‌زمینه نوشته می‌شوند؛ دسته‌ها می‌توانند بزرگ‌تر و دیرتر از نوشتن‌های تعاملی باشند.
+review_event_batcher = WriteBatcher("review event", flush_review_events, WRITE_BATCH_MAX_SIZE * 5, WRITE_BATCH_MAX_DELAY * 20)
+
+async def close_write_batchers() -> None:
+    await message_insert_batcher.close()
+    await box_move_batcher.close()
+    await review_event_batcher.close()
+
+
+# =================================================================
+# توابع دسترسی به داده
+# =================================================================
+
+async def add_message_id_to_db(user_id: int, chat_id: int, message_id: int, content_text: str | None = None):
+    read_router.note_write(user_id)
+    try:
+        return await message_insert_batcher.submit((user_id, chat_id, message_id, content_text))
+    except psycopg.Error as e:
+        logger.error(f"Database error in add_message_id_to_db: {e}")
+        return False
+
+async def get_leitner_stats(user_id: int) -> dict:
+    stats = {f"box_{i}": 0 for i in range(1, MAX_LEITNER_BOX + 1)}
+    total = 0
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("SELECT leitner_box, count FROM user_box_counts WHERE user_id = %s", (user_id,))
+                rows = await cursor.fetchall()
+        for row in rows:
+            if 1 <= row['leitner_box'] <= MAX_LEITNER_BOX:
+                stats[f"box_{row['leitner_box']}"] = row['count']
+                total += row['count']
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_leitner_stats: {e}")
+    stats['total'] = total
+    return stats
+
+async def rebuild_box_counts(user_id: int | None = None) -> bool:
+    try:
+        async with db_pool.connection() as conn:
+            if user_id is None:
+                # بازسازی کامل: نوشتن روی messages تا پایان تراکنش متوقف می‌شود.
+                await conn.execute("LOCK TABLE messages, messages_archive IN SHARE MODE")
+                await conn.execute("DELETE FROM user_box_counts")
+                await conn.execute("""
+                INSERT INTO user_box_counts (user_id, leitner_box, count)
+                SELECT user_id, leitner_box, COUNT(*) FROM (
+                    SELECT user_id, leitner_box FROM messages WHERE tombstoned_at IS NULL
+                    UNION ALL
+                    SELECT user_id, leitner_box FROM messages_archive
+                ) cards GROUP BY user_id, leitner_box
+                """)
+            else:
+                # قفل ردیف‌های شمارنده این کاربر باعث می‌شود تریگرهای هم‌زمان پس از بازسازی اعمال شوند. ردیف همه جعبه‌ها
+                # اول ساخته می‌شود: این درج منتظر درج‌های هم‌زمانِ هنوز commit‌نشده همان ردیف‌ها می‌ماند تا FOR UPDATE
+                # آن‌ها را هم ببیند و شمارش بعدی تغییرشان را بازنویسی نکند.
+                await conn.execute("""
+                INSERT INTO user_box_counts (user_id, leitner_box, count)
+                SELECT %s, box, 0 FROM generate_series(1, %s) AS box
+                ON CONFLICT (user_id, leitner_box) DO NOTHING
+                """, (user_id, MAX_LEITNER_BOX))
+                await conn.execute("SELECT 1 FROM user_box_counts WHERE user_id = %s ORDER BY leitner_box FOR UPDATE", (user_id,))
+                await conn.execute("UPDATE user_box_counts SET count = 0 WHERE user_id = %s", (user_id,))
+                await conn.execute("""
+                INSERT INTO user_box_counts (user_id, leitner_box, count)
+                SELECT user_id, leitner_box, COUNT(*) FROM (
+                    SELECT user_id, leitner_box FROM messages WHERE user_id = %s AND tombstoned_at IS NULL
+                    UNION ALL
+                    SELECT user_id, leitner_box FROM messages_archive WHERE user_id = %s
+                ) cards GROUP BY user_id, leitner_box ORDER BY leitner_box
+                ON CONFLICT (user_id, leitner_box) DO UPDATE SET count = EXCLUDED.count;
+                """, (user_id, user_id))
+        logger.info(f"Box counters rebuilt for {'all users' if user_id is None else f'user {user_id}'}.")
+        return True
+    except psycopg.Error as e:
+        logger.error(f"Database error in rebuild_box_counts: {e}")
+        return False
+
+async def move_leitner_box(user_id: int, message_id: int, direction: str) -> tuple[int, int]:
+    # خروجی: (جعبه قبل، جعبه بعد)
+    if direction not in ('up', 'reset'):
+        return 0, 0
+    read_router.note_write(user_id)
+    try:
+        return await box_move_batcher.submit((user_id, message_id, direction))
+    except psycopg.Error as e:
+        logger.error(f"Database error in move_leitner_box: {e}")
+        return 0, 0
+
+def record_review_event(user_id: int, message_id: int, action: str, from_box: int | None, to_box: int | None) -> None:
+    # منتظر نوشتن نمی‌مانیم؛ از دست رفتن یک رویداد فقط آمار را کمی ناقص می‌کند.
+    future = review_event_batcher.submit((user_id, message_id, action, from_box, to_box))
+    future.add_done_callback(log_review_event_failure)
+
+def log_review_event_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Could not record review event: {future.exception()}")
+
+async def rollup_review_events(batch_size: int) -> int:
+    # واترمارک (آخرین id تجمیع‌شده) و جدول‌های تجمیعی در یک تراکنش جلو می‌روند؛ قفل ردیف وضعیت
+    # اجرای هم‌زمان چند پردازه را پشت سر هم می‌کند. خروجی: تعداد رویدادهای تجمیع‌شده
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            WITH state AS (
+                SELECT last_event_id FROM review_rollup_state WHERE name = 'review_stats' FOR UPDATE
+            ), batch AS (
+                SELECT e.id, e.user_id, e.action, e.from_box, e.created_at,
+                       (e.created_at AT TIME ZONE COALESCE(u.timezone, %(default_timezone)s))::date AS day
+                FROM review_events AS e CROSS JOIN state
+                LEFT JOIN users AS u ON u.user_id = e.user_id
+                -- created_at زمان شروع تراکنش است و با ترتیب id یکی نیست؛ فقط بخش پیوسته پیش از اولین رویدادی
+                -- که هنوز در بازه اطمینان است تجمیع می‌شود تا واترمارک از روی رویدادی رد نشود.
+                WHERE e.id > state.last_event_id AND e.id < COALESCE((
+                    SELECT min(pending.id) FROM review_events AS pending
+                    WHERE pending.id > state.last_event_id AND pending.created_at >= now() - %(safety_lag)s
+                ), 9223372036854775807)
+                ORDER BY e.id LIMIT %(batch_size)s
+            ), daily AS (
+                INSERT INTO review_stats_daily (user_id, day, ups, resets, deletes)
+                SELECT user_id, day, COUNT(*) FILTER (WHERE action = 'up'), COUNT(*) FILTER (WHERE action = 'reset'),
+                       COUNT(*) FILTER (WHERE action = 'delete')
+                FROM batch GROUP BY user_id, day ORDER BY user_id, day
+                ON CONFLICT (user_id, day) DO UPDATE SET
+                    ups = review_stats_daily.ups + EXCLUDED.ups,
+                    resets = review_stats_daily.resets + EXCLUDED.resets,
+                    deletes = review_stats_daily.deletes + EXCLUDED.deletes
+            ), totals AS (
+                INSERT INTO review_stats_users (user_id, leitner_box, ups, resets, deletes, last_review_at)
+                SELECT user_id, COALESCE(from_box, 0), COUNT(*) FILTER (WHERE action = 'up'),
+                       COUNT(*) FILTER (WHERE action = 'reset'), COUNT(*) FILTER (WHERE action = 'delete'), max(created_at)
+                FROM batch GROUP BY user_id, COALESCE(from_box, 0) ORDER BY 1, 2
+                ON CONFLICT (user_id, leitner_box) DO UPDATE SET
+                    ups = review_stats_users.ups + EXCLUDED.ups,
+                    resets = review_stats_users.resets + EXCLUDED.resets,
+                    deletes = review_stats_users.deletes + EXCLUDED.deletes,
+                    last_review_at = GREATEST(review_stats_users.last_review_at, EXCLUDED.last_review_at)
+            ), advanced AS (
+                UPDATE review_rollup_state SET last_event_id = batch_max.id, updated_at = now()
+                FROM (SELECT max(id) AS id FROM batch) AS batch_max
+                WHERE name = 'review_stats' AND batch_max.id IS NOT NULL
+            )
+            SELECT COUNT(*) FROM batch
+            """, {"default_timezone": DEFAULT_TIMEZONE, "safety_lag": REVIEW_ROLLUP_SAFETY_LAG, "batch_size": batch_size})
+            return (await cursor.fetchone())[0]
+    except psycopg.Error as e:
+        logger.error(f"Database error in rollup_review_events: {e}")
+        return 0
+
+async def get_review_history(user_id: int, days: int) -> dict:
+    history = {"recent_ups": 0, "recent_resets": 0, "active_days": 0, "total_ups": 0, "total_resets": 0}
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                WITH since AS (
+                    SELECT (now() AT TIME ZONE COALESCE(
+                        (SELECT timezone FROM users WHERE user_id = %(user_id)s), %(default_timezone)s
+                    ))::date - %(days)s + 1 AS day
+                ), recent AS (
+                    SELECT COALESCE(SUM(d.ups), 0) AS ups, COALESCE(SUM(d.resets), 0) AS resets,
+                           COUNT(*) FILTER (WHERE d.ups + d.resets > 0) AS active_days
+                    FROM review_stats_daily AS d, since WHERE d.user_id = %(user_id)s AND d.day >= since.day
+                ), totals AS (
+                    SELECT COALESCE(SUM(ups), 0)::bigint AS ups, COALESCE(SUM(resets), 0)::bigint AS resets
+                    FROM review_stats_users WHERE user_id = %(user_id)s
+                )
+                SELECT recent.ups AS recent_ups, recent.resets AS recent_resets, recent.active_days,
+                       totals.ups AS total_ups, totals.resets AS total_resets
+                FROM recent, totals
+                """, {"user_id": user_id, "days": days, "default_timezone": DEFAULT_TIMEZONE})
+                history.update(await cursor.fetchone())
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_review_history: {e}")
+    return history
+
+class SettingsCache:
+    # کش LRU با TTL؛ مقدار None یعنی ردیفی در دیتابیس نیست و مقدار پیش‌فرض استفاده می‌شود.
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[tuple[int, str], tuple[float, str | None]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int, key: str) -> tuple[bool, str | None]:
+        entry = self.entries.get((user_id, key))
+        if entry is None or entry[0] < time.monotonic():
+            # ورودی منقضی حذف می‌شود تا put(..., overwrite=False) بعد از خواندن از دیتابیس دوباره آن را پر کند.
+            if entry is not None:
+                del self.entries[(user_id, key)]
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end((user_id, key))
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, user_id: int, key: str, value: str | None, overwrite: bool = True) -> None:
+        cache_key = (user_id, key)
+        if not overwrite and cache_key in self.entries:
+            return
+        self.entries[cache_key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, key: str) -> None:
+        if self.entries.pop((user_id, key), None) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+settings_cache = SettingsCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+settings_listener_task: asyncio.Task | None = None
+
+async def listen_for_settings_changes() -> None:
+    # هر تغییر تنظیمات در پردازه‌های دیگر با NOTIFY اعلام می‌شود و اینجا از کش حذف می‌شود.
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {SETTINGS_NOTIFY_CHANNEL}")
+                # ممکن است در فاصله قطع اتصال اعلانی از دست رفته باشد.
+                settings_cache.clear()
+                logger.info("Listening for settings changes from other processes.")
+                async for notify in conn.notifies():
+                    token, user_id, key = notify.payload.split(":", 2)
+                    if token != PROCESS_TOKEN:
+                        settings_cache.invalidate(int(user_id), key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Settings change listener failed: {e}. Reconnecting in 5s.")
+            await asyncio.sleep(5)
+
+def start_settings_listener() -> None:
+    global settings_listener_task
+    settings_listener_task = asyncio.create_task(listen_for_settings_changes())
+
+async def stop_settings_listener() -> None:
+    if settings_listener_task is not None:
+        settings_listener_task.cancel()
+        await asyncio.gather(settings_listener_task, return_exceptions=True)
+
+async def get_setting(user_id: int, key: str, default: str) -> str:
+    found, value = settings_cache.get(user_id, key)
+    if found:
+        return default if value is None else value
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("SELECT value FROM settings WHERE user_id = %s AND key = %s", (user_id, key))
+            result = await cursor.fetchone()
+        value = result[0] if result else None
+        # اگر در این فاصله set_setting مقدار تازه‌تری در کش گذاشته باشد، آن را بازنویسی نمی‌کنیم.
+        settings_cache.put(user_id, key, value, overwrite=False)
+        return default if value is None else value
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_setting: {e}")
+        return default
+
+async def set_setting(user_id: int, key: str, value: str):
+    read_router.note_write(user_id)
+    try:
+        async with db_pool.connection() as conn:
+            await conn.execute("""
+            INSERT INTO settings (user_id, key, value) VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, key) DO UPDATE SET value = EXCLUDED.value;
+            """, (user_id, key, value))
+            await conn.execute("SELECT pg_notify(%s, %s)", (SETTINGS_NOTIFY_CHANNEL, f"{PROCESS_TOKEN}:{user_id}:{key}"))
+        settings_cache.put(user_id, key, value)
+        logger.info(f"Setting '{key}' for user '{user_id}' updated to '{value}'.")
+    except psycopg.Error as e:
+        logger.error(f"Database error in set_setting: {e}")
+
+async def get_review_candidates(user_id: int, limit: int) -> list:
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("SELECT message_id, chat_id FROM messages WHERE user_id = %s AND next_review_at <= now() AND tombstoned_at IS NULL ORDER BY next_review_at, id LIMIT %s", (user_id, limit))
+                return await cursor.fetchall()
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_review_candidates: {e}")
+        return []
+
+async def get_messages_in_box(user_id: int, box_number: int, after_id: int, limit: int) -> list:
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                if box_number == MAX_LEITNER_BOX:
+                    # کارت‌های بایگانی‌شده هم جزو آخرین جعبه‌اند؛ id بین دو جدول یکتاست، پس صفحه‌بندی keyset درست می‌ماند.
+                    await cursor.execute("""
+                    (SELECT id, message_id, chat_id FROM messages WHERE user_id = %s AND leitner_box = %s AND id > %s AND tombstoned_at IS NULL ORDER BY id LIMIT %s)
+                    UNION ALL
+                    (SELECT id, message_id, chat_id FROM messages_archive WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s)
+                    ORDER BY id ASC LIMIT %s
+                    """, (user_id, box_number, after_id, limit, user_id, after_id, limit, limit))
+                else:
+                    await cursor.execute("SELECT id, message_id, chat_id FROM messages WHERE user_id = %s AND leitner_box = %s AND id > %s AND tombstoned_at IS NULL ORDER BY id ASC LIMIT %s", (user_id, box_number, after_id, limit))
+                return await cursor.fetchall()
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_messages_in_box: {e}")
+        return []
+
+# حروف عربی به شکل فارسی و نیم‌فاصله به فاصله تبدیل می‌شوند تا «كتاب‌ها» و «کتاب ها» یکسان نمایه شوند.
+# همین نگاشت در SQL با translate() هم اعمال می‌شود (مثلاً هنگام import).
+SEARCH_CHARACTER_FROM, SEARCH_CHARACTER_TO = "يىك\u200c", "ییک "
+SEARCH_CHARACTER_MAP = str.maketrans(SEARCH_CHARACTER_FROM, SEARCH_CHARACTER_TO)
+SEARCH_TERM_PATTERN = re.compile(r"\w+")
+
+# با init_db و بسته به ساخته شدن ایندکس trigram (نصب بودن pg_trgm) مقدار می‌گیرد.
+search_uses_trigram = False
+
+def normalize_search_text(text: str) -> str:
+    return text.translate(SEARCH_CHARACTER_MAP)
+
+def build_search_query(text: str) -> tuple[str, str] | None:
+    # خروجی: (tsquery با پیشوند هر کلمه، الگوی ILIKE برای خود عبارت)؛ None اگر عبارت هیچ کلمه‌ای نداشته باشد.
+    # نویسه‌های ویژه LIKE (\، % و _) escape می‌شوند تا عین خودشان جست‌وجو شوند.
+    text = normalize_search_text(text)
+    terms = SEARCH_TERM_PATTERN.findall(text)
+    if not terms:
+        return None
+    tsquery = " & ".join(f"'{term}':*" for term in terms)
+    pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    return tsquery, pattern
+
+async def search_messages(user_id: int, text: str, before_id: int, limit: int) -> list:
+    # هر کلمه عبارت، به‌عنوان ابتدای یک کلمه از یادداشت جست‌وجو می‌شود؛ با pg_trgm خود عبارت در هر جای متن هم پیدا می‌شود.
+    # نتایج از جدیدترین کارت و با صفحه‌بندی keyset روی id (کمتر از before_id، یا از ابتدا اگر 0 باشد) برگردانده می‌شوند.
+    query = build_search_query(text)
+    if query is None:
+        return []
+    params = {"user_id": user_id, "before_id": before_id, "limit": limit, "tsquery": query[0], "pattern": query[1]}
+    match = "content_tsv @@ to_tsquery('simple', %(tsquery)s)"
+    if search_uses_trigram and len(normalize_search_text(text).strip()) >= SEARCH_MIN_SUBSTRING_LENGTH:
+        match = f"({match} OR content_text ILIKE %(pattern)s)"
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute(f"""
+                (SELECT id, message_id, chat_id, leitner_box, content_text FROM messages
+                 WHERE user_id = %(user_id)s AND {match} AND (%(before_id)s = 0 OR id < %(before_id)s) AND tombstoned_at IS NULL
+                 ORDER BY id DESC LIMIT %(limit)s)
+                UNION ALL
+                (SELECT id, message_id, chat_id, leitner_box, content_text FROM messages_archive
+                 WHERE user_id = %(user_id)s AND {match} AND (%(before_id)s = 0 OR id < %(before_id)s)
+                 ORDER BY id DESC LIMIT %(limit)s)
+                ORDER BY id DESC LIMIT %(limit)s
+                """, params)
+                return await cursor.fetchall()
+    except psycopg.Error as e:
+        logger.error(f"Database error in search_messages: {e}")
+        return []
+
+async def get_card(user_id: int, message_id: int) -> dict | None:
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                SELECT message_id, chat_id FROM messages WHERE user_id = %(user_id)s AND message_id = %(message_id)s AND tombstoned_at IS NULL
+                UNION ALL
+                SELECT message_id, chat_id FROM messages_archive WHERE user_id = %(user_id)s AND message_id = %(message_id)s
+                """, {"user_id": user_id, "message_id": message_id})
+                return await cursor.fetchone()
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_card: {e}")
+        return None
+
+async def activate_user(user_id: int, chat_id: int) -> None:
+    try:
+        async with db_pool.connection() as conn:
+            await conn.execute("""
+            INSERT INTO users (user_id, chat_id) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                active = TRUE, blocked_at = NULL, chat_id = EXCLUDED.chat_id,
+                -- زمان تحویل کاربری که دوباره فعال می‌شود از نو حساب می‌شود.
+                next_delivery_at = CASE WHEN users.active THEN users.next_delivery_at END
+            WHERE NOT users.active OR users.chat_id <> EXCLUDED.chat_id;
+            """, (user_id, chat_id))
+    except psycopg.Error as e:
+        logger.error(f"Database error in activate_user: {e}")
+
+async def deactivate_user(user_id: int) -> None:
+    # ارسال‌های در صف این کاربر هم حذف می‌شوند؛ تا /start بعدی کاری برایش انجام نمی‌شود.
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(
+                "UPDATE users SET active = FALSE, blocked_at = now() WHERE user_id = %s AND active", (user_id,)
+            )
+            if cursor.rowcount:
+                await conn.execute("DELETE FROM outbox WHERE user_id = %s", (user_id,))
+        if cursor.rowcount:
+            users_deactivated.inc()
+            logger.info(f"User {user_id} marked inactive.")
+    except psycopg.Error as e:
+        logger.error(f"Database error in deactivate_user: {e}")
+
+# زمان تحویل بعدی کاربری با نام مستعار u؛ پارامترهای نام‌دار از delivery_schedule_params می‌آیند.
+# ساعت انتخابی کاربر تا REVIEW_TIME_JITTER_SECONDS جابه‌جا می‌شود تا ساعت‌های پرطرفدار (مثلاً 08:00) یک‌جا شلیک نشوند.
+NEXT_DELIVERY_AT_SQL = """
+next_delivery_time(
+    COALESCE(u.timezone, %(default_timezone)s),
+    COALESCE(
+        u.review_time + make_interval(secs => mod(u.user_id, %(jitter_seconds)s)::int),
+        %(window_start)s::time + make_interval(mins => mod(u.user_id, %(window_minutes)s)::int)
+    ),
+    now()
+)"""
+
+def delivery_schedule_params(**params) -> dict:
+    return {
+        "default_timezone": DEFAULT_TIMEZONE,
+        "window_start": DEFAULT_REVIEW_WINDOW_START,
+        "window_minutes": max(int(DEFAULT_REVIEW_WINDOW_HOURS * 60), 1),
+        "jitter_seconds": max(REVIEW_TIME_JITTER_SECONDS, 1),
+        **params,
+    }
+
+async def schedule_new_users(limit: int) -> int:
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(f"""
+            UPDATE users AS u SET next_delivery_at = {NEXT_DELIVERY_AT_SQL}
+            WHERE u.user_id IN (
+                SELECT user_id FROM users WHERE active AND next_delivery_at IS NULL
+                LIMIT %(limit)s FOR UPDATE SKIP LOCKED
+            );
+            """, delivery_schedule_params(limit=limit))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in schedule_new_users: {e}")
+        return 0
+
+async def claim_due_deliveries(limit: int) -> tuple[int, int]:
+    # در یک تراکنش: کاربران سررسید قفل می‌شوند، زمان تحویل بعدی‌شان جلو می‌رود و کارت‌های سررسیدشان
+    # در outbox قرار می‌گیرد؛ پس ری‌استارت نه تحویلی را دوباره اجرا می‌کند و نه جا می‌اندازد.
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(f"""
+            WITH due AS (
+                SELECT user_id FROM users
+                WHERE active AND next_delivery_at <= now()
+                ORDER BY next_delivery_at LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            ), advanced AS (
+                UPDATE users AS u SET next_delivery_at = {NEXT_DELIVERY_AT_SQL}
+                FROM due WHERE u.user_id = due.user_id
+                RETURNING u.user_id, u.chat_id
+            ), queued AS (
+                INSERT INTO outbox (user_id, chat_id, from_chat_id, message_id, method, with_review_keyboard)
+                SELECT a.user_id, a.chat_id, c.chat_id, c.message_id, 'copy', TRUE
+                FROM advanced AS a
+                CROSS JOIN LATERAL (
+                    SELECT m.id, m.chat_id, m.message_id, m.next_review_at FROM messages AS m
+                    WHERE m.user_id = a.user_id AND m.next_review_at <= now() AND m.tombstoned_at IS NULL
+                    ORDER BY m.next_review_at, m.id
+                    LIMIT COALESCE(
+                        (SELECT s.value::int FROM settings AS s WHERE s.user_id = a.user_id AND s.key = 'daily_reviews'), 2
+                    )
+                ) AS c
+                ORDER BY a.user_id, c.next_review_at, c.id
+                RETURNING 1
+            )
+            SELECT (SELECT count(*) FROM advanced), (SELECT count(*) FROM queued);
+            """, delivery_schedule_params(limit=limit))
+            return await cursor.fetchone()
+    except psycopg.Error as e:
+        logger.error(f"Database error in claim_due_deliveries: {e}")
+        return 0, 0
+
+async def get_scheduler_lag() -> float:
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            SELECT COALESCE(EXTRACT(EPOCH FROM now() - min(next_delivery_at)), 0)
+            FROM users WHERE active AND next_delivery_at <= now()
+            """)
+            return float((await cursor.fetchone())[0])
+    except psycopg.Error as e:
+        logger.error(f"Database error in get_scheduler_lag: {e}")
+        return 0.0
+
+async def set_user_schedule(user_id: int, chat_id: int, timezone: str | None = None, review_time: dt_time | None = None) -> dict | None:
+    # خروجی: منطقه زمانی و ساعت مؤثر کاربر به همراه زمان تحویل بعدی
+    try:
+        async with db_pool.connection() as conn:
+            await conn.execute("""
+            INSERT INTO users (user_id, chat_id, timezone, review_time) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                timezone = COALESCE(EXCLUDED.timezone, users.timezone),
+                review_time = COALESCE(EXCLUDED.review_time, users.review_time);
+            """, (user_id, chat_id, timezone, review_time))
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute(f"""
+                UPDATE users AS u SET next_delivery_at = {NEXT_DELIVERY_AT_SQL}
+                WHERE u.user_id = %(user_id)s
+                RETURNING COALESCE(u.timezone, %(default_timezone)s) AS timezone, u.review_time, u.next_delivery_at;
+                """, delivery_schedule_params(user_id=user_id))
+                return await cursor.fetchone()
+    except psycopg.Error as e:
+        logger.error(f"Database error in set_user_schedule: {e}")
+        return None
+
+# فایل‌های داخل آرشیو خروجی و پرس‌وجوی COPY هر کدام؛ {user_filter} برای خروجی یک کاربر پر می‌شود
+# (کارت‌های بایگانی‌شده هم جزو deck هستند).
+EXPORT_QUERIES = {
+    "messages.csv": """
+        SELECT user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at, content_text FROM (
+            SELECT id, user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at, content_text
+            FROM messages WHERE tombstoned_at IS NULL {user_filter}
+            UNION ALL
+            SELECT id, user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at, content_text
+            FROM messages_archive WHERE TRUE {user_filter}
+        ) cards ORDER BY id
+    """,
+    "settings.csv": "SELECT user_id, key, value FROM settings WHERE TRUE {user_filter} ORDER BY user_id, key",
+}
+
+async def export_deck(user_id: int | None, directory: str) -> dict | None:
+    # خروجی COPY ... TO STDOUT تکه‌تکه روی دیسک نوشته می‌شود و کل deck هیچ‌وقت در حافظه نیست.
+    # هر دو جدول از یک snapshot خوانده می‌شوند. خروجی: تعداد ردیف هر فایل
+    user_filter, params = ("AND user_id = %s", (user_id,)) if user_id is not None else ("", ())
+    counts = {}
+    try:
+        async with read_router.pool(user_id).connection() as conn:
+            async with conn.transaction():
+                await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                for name, query in EXPORT_QUERIES.items():
+                    async with conn.cursor() as cursor:
+                        statement = f"COPY ({query.format(user_filter=user_filter)}) TO STDOUT WITH (FORMAT csv, HEADER)"
+                        with open(os.path.join(directory, name), "wb") as f:
+                            async with cursor.copy(statement, params * query.count("{user_filter}")) as copy:
+                                async for chunk in copy:
+                                    f.write(chunk)
+                        counts[name] = cursor.rowcount
+        return counts
+    except psycopg.Error as e:
+        logger.error(f"Database error in export_deck: {e}")
+        return None
+
+# ستون‌های مجاز هر فایل؛ ستون‌ها از سطر اول فایل خوانده می‌شوند تا خروجی‌های قدیمی‌تر (بدون content_text) هم وارد شوند.
+IMPORT_COLUMNS = {
+    "import_messages": {"user_id", "chat_id", "message_id", "leitner_box", "next_review_at", "last_reviewed_at", "content_text"},
+    "import_settings": {"user_id", "key", "value"},
+}
+
+def read_csv_header(path: str) -> list[str]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), [])
+
+async def import_deck(paths: dict, user_id: int | None, chat_id: int | None) -> dict | None:
+    # فایل‌ها با COPY ... FROM STDIN به جدول موقت می‌روند و با یک INSERT گروهی ادغام می‌شوند
+    # (triggerهای شمارنده جعبه و users هم یک بار برای هر دستور اجرا می‌شوند).
+    # با user_id/chat_id همه ردیف‌ها به همان کاربر و چت نسبت داده می‌شوند تا کسی نتواند پیام چت دیگری را وارد کند.
+    if user_id is not None:
+        read_router.note_write(user_id)
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                CREATE TEMP TABLE import_messages (
+                    user_id BIGINT, chat_id BIGINT, message_id BIGINT, leitner_box INTEGER,
+                    next_review_at TIMESTAMPTZ, last_reviewed_at TIMESTAMPTZ, content_text TEXT
+                ) ON COMMIT DROP
+                """)
+                await conn.execute("CREATE TEMP TABLE import_settings (user_id BIGINT, key TEXT, value TEXT) ON COMMIT DROP")
+                rows = {}
+                for name, table in (("messages.csv", "import_messages"), ("settings.csv", "import_settings")):
+                    if name not in paths:
+                        continue
+                    columns = read_csv_header(paths[name])
+                    if not columns or not set(columns) <= IMPORT_COLUMNS[table]:
+                        logger.warning(f"Rejected {name} with columns {columns}.")
+                        return None
+                    async with conn.cursor() as cursor:
+                        async with cursor.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER)") as copy:
+                            with open(paths[name], "rb") as f:
+                                while chunk := f.read(COPY_CHUNK_SIZE):
+                                    await copy.write(chunk)
+                        rows[name] = cursor.rowcount
+
+                cursor = await conn.execute("""
+                INSERT INTO messages (
+                    user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at, mastered_at,
+                    content_text, content_tsv
+                )
+                SELECT user_id, chat_id, message_id, leitner_box, next_review_at, last_reviewed_at,
+                       CASE WHEN leitner_box = %(max_box)s THEN COALESCE(last_reviewed_at, now()) END,
+                       content_text, to_tsvector('simple', translate(content_text, %(search_from)s, %(search_to)s))
+                FROM (
+                    SELECT COALESCE(%(user_id)s::bigint, user_id) AS user_id, COALESCE(%(chat_id)s::bigint, chat_id) AS chat_id,
+                           message_id, LEAST(GREATEST(COALESCE(leitner_box, 1), 1), %(max_box)s) AS leitner_box,
+                           COALESCE(next_review_at, now()) AS next_review_at, last_reviewed_at, NULLIF(content_text, '') AS content_text
+                    FROM import_messages WHERE message_id IS NOT NULL AND (%(user_id)s::bigint IS NOT NULL OR user_id IS NOT NULL)
+                ) AS v
+                WHERE NOT EXISTS (SELECT 1 FROM messages_archive AS a WHERE a.user_id = v.user_id AND a.message_id = v.message_id)
+                ON CONFLICT (user_id, message_id) DO NOTHING
+                """, {
+                    "max_box": MAX_LEITNER_BOX, "user_id": user_id, "chat_id": chat_id,
+                    "search_from": SEARCH_CHARACTER_FROM, "search_to": SEARCH_CHARACTER_TO,
+                })
+                inserted_messages = cursor.rowcount
+
+                # فقط تنظیمات شناخته‌شده با مقدار مجاز وارد می‌شوند؛ بقیه پردازه‌ها با NOTIFY کششان را پاک می‌کنند.
+                cursor = await conn.execute("""
+                WITH upserted AS (
+                    INSERT INTO settings (user_id, key, value)
+                    SELECT DISTINCT ON (1, 2) COALESCE(%s::bigint, user_id), key, value FROM import_settings
+                    WHERE key = 'daily_reviews' AND value ~ '^([1-9]|1[0-9]|20)$' AND (%s::bigint IS NOT NULL OR user_id IS NOT NULL)
+                    ORDER BY 1, 2
+                    ON CONFLICT (user_id, key) DO UPDATE SET value = EXCLUDED.value
+                    RETURNING user_id, key
+                )
+                SELECT user_id, key, pg_notify(%s, %s || ':' || user_id || ':' || key) FROM upserted
+                """, (user_id, user_id, SETTINGS_NOTIFY_CHANNEL, PROCESS_TOKEN))
+                updated_settings = await cursor.fetchall()
+        for setting_user_id, key, _ in updated_settings:
+            settings_cache.invalidate(setting_user_id, key)
+        return {
+            "messages": rows.get("messages.csv", 0),
+            "inserted_messages": inserted_messages,
+            "settings": len(updated_settings),
+        }
+    except psycopg.Error as e:
+        logger.error(f"Database error in import_deck: {e}")
+        return None
+
+async def delete_message_from_db(user_id: int, message_id: int) -> int | None:
+    # خروجی: جعبه کارت حذف‌شده (0 اگر کارتی نبود) یا None در صورت خطا
+    read_router.note_write(user_id)
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            WITH hot AS (
+                DELETE FROM messages WHERE user_id = %(user_id)s AND message_id = %(message_id)s RETURNING leitner_box
+            ), archived AS (
+                DELETE FROM messages_archive WHERE user_id = %(user_id)s AND message_id = %(message_id)s RETURNING leitner_box
+            )
+            SELECT leitner_box FROM hot UNION ALL SELECT leitner_box FROM archived
+            """, {"user_id": user_id, "message_id": message_id})
+            row = await cursor.fetchone()
+        logger.info(f"Message {message_id} deleted for user {user_id}.")
+        return row[0] if row else 0
+    except psycopg.Error as e:
+        logger.error(f"Database error in delete_message_from_db: {e}")
+        return None
+
+async def record_card_failure(user_id: int, message_id: int) -> dict | None:
+    # مرور بعدی کارت عقب می‌افتد تا انتخاب دوباره، کارت سررسید بعدی را جایگزین کند؛
+    # بعد از CARD_FAILURE_THRESHOLD خطای دائمی، کارت tombstone می‌شود و دیگر انتخاب نمی‌شود.
+    read_router.note_write(user_id)
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                WITH target AS (
+                    SELECT id, next_review_at FROM messages WHERE user_id = %s AND message_id = %s FOR UPDATE
+                )
+                UPDATE messages AS m SET
+                    failure_count = m.failure_count + 1,
+                    tombstoned_at = CASE WHEN m.failure_count + 1 >= %s THEN now() END,
+                    next_review_at = now() + %s
+                FROM target WHERE m.id = target.id
+                RETURNING target.id, target.next_review_at AS previous_review_at, m.failure_count,
+                          m.tombstoned_at IS NOT NULL AS tombstoned;
+                """, (user_id, message_id, CARD_FAILURE_THRESHOLD, CARD_FAILURE_RETRY_DELAY))
+                failure = await cursor.fetchone()
+        if failure and failure['tombstoned']:
+            cards_pruned.labels("tombstoned").inc()
+            logger.info(f"Message {message_id} of user {user_id} tombstoned after {failure['failure_count']} failed deliveries.")
+        return failure
+    except psycopg.Error as e:
+        logger.error(f"Database error in record_card_failure: {e}")
+        return None
+
+async def enqueue_review_backfill(user_id: int, chat_id: int, after_review_at, after_id: int) -> int:
+    # کارت‌های همین نوبت به ترتیب (next_review_at, id) ارسال می‌شوند؛ کارت سررسید بعد از کارت خراب
+    # که در صف نیست، جای آن را می‌گیرد.
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            INSERT INTO outbox (user_id, chat_id, from_chat_id, message_id, method, with_review_keyboard)
+            SELECT m.user_id, %s, m.chat_id, m.message_id, 'copy', TRUE
+            FROM messages AS m
+            WHERE m.user_id = %s AND m.next_review_at <= now() AND m.tombstoned_at IS NULL
+              AND (m.next_review_at, m.id) > (%s, %s)
+              AND NOT EXISTS (SELECT 1 FROM outbox AS o WHERE o.user_id = m.user_id AND o.message_id = m.message_id)
+            ORDER BY m.next_review_at, m.id LIMIT 1;
+            """, (chat_id, user_id, after_review_at, after_id))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in enqueue_review_backfill: {e}")
+        return 0
+
+async def delete_tombstoned_cards(batch_size: int) -> int:
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            DELETE FROM messages WHERE id IN (
+                SELECT id FROM messages WHERE tombstoned_at IS NOT NULL
+                LIMIT %s FOR UPDATE SKIP LOCKED
+            );
+            """, (batch_size,))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in delete_tombstoned_cards: {e}")
+        return 0
+
+async def archive_mastered_cards(batch_size: int) -> int:
+    # هر دسته یک تراکنش کوتاه است و فقط قفل ردیف‌های همان دسته را می‌گیرد (SKIP LOCKED).
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(f"""
+            WITH moved AS (
+                DELETE FROM messages WHERE (id, user_id) IN (
+                    SELECT id, user_id FROM messages
+                    WHERE mastered_at <= now() - %s AND leitner_box = {MAX_LEITNER_BOX} AND tombstoned_at IS NULL
+                    ORDER BY mastered_at LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {CARD_COLUMNS}
+            )
+            INSERT INTO messages_archive ({CARD_COLUMNS}) SELECT {CARD_COLUMNS} FROM moved;
+            """, (ARCHIVE_MASTERED_AFTER, batch_size))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in archive_mastered_cards: {e}")
+        return 0
+
+async def enqueue_forward_all(user_id: int, chat_id: int, batch_key: str) -> int:
+    # زمان آماده‌شدن ردیف‌ها با نرخ مجاز هر چت فاصله می‌گیرد تا یک «نمایش همه» بزرگ کارگرهای صف را قبضه نکند؛
+    # هر OUTBOX_GROUP_SIZE ردیف با هم آماده می‌شوند تا کارگر صف آن‌ها را در یک forwardMessages بفرستد.
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("""
+            INSERT INTO outbox (user_id, chat_id, from_chat_id, message_id, method, batch_key, available_at)
+            SELECT user_id, %s, chat_id, message_id, 'forward', %s,
+                   now() + ((row_number() OVER (ORDER BY id) - 1) / %s) * %s
+            FROM (
+                SELECT id, user_id, chat_id, message_id FROM messages WHERE user_id = %s AND tombstoned_at IS NULL
+                UNION ALL
+                SELECT id, user_id, chat_id, message_id FROM messages_archive WHERE user_id = %s
+            ) cards ORDER BY id ASC;
+            """, (chat_id, batch_key, OUTBOX_GROUP_SIZE, timedelta(seconds=1 / TELEGRAM_PER_CHAT_RATE), user_id, user_id))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in enqueue_forward_all: {e}")
+        return 0
+
+async def count_outbox_batch(batch_key: str) -> int | None:
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("SELECT COUNT(*) FROM outbox WHERE batch_key = %s", (batch_key,))
+            return (await cursor.fetchone())[0]
+    except psycopg.Error as e:
+        logger.error(f"Database error in count_outbox_batch: {e}")
+        return None
+
+async def cancel_outbox_batch(batch_key: str) -> int:
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute("DELETE FROM outbox WHERE batch_key = %s", (batch_key,))
+            return cursor.rowcount
+    except psycopg.Error as e:
+        logger.error(f"Database error in cancel_outbox_batch: {e}")
+        return 0
+
+async def count_outbox_depth() -> dict:
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                SELECT COUNT(*) FILTER (WHERE available_at <= now()) AS ready,
+                       COUNT(*) FILTER (WHERE available_at > now()) AS delayed
+                FROM outbox
+                """)
+                return await cursor.fetchone()
+    except psycopg.Error as e:
+        logger.error(f"Database error in count_outbox_depth: {e}")
+        return {}
+
+async def claim_outbox_batch(batch_size: int) -> list:
+    try:
+        async with db_pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                UPDATE outbox SET available_at = now() + %s, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM outbox WHERE available_at <= now()
+                    ORDER BY id LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id, chat_id, from_chat_id, message_id, method, with_review_keyboard, attempts;
+                """, (timedelta(seconds=OUTBOX_LEASE_SECONDS), batch_size))
+                rows = await cursor.fetchall()
+        return sorted(rows, key=lambda row: row['id'])
+    except psycopg.Error as e:
+        logger.error(f"Database error in claim_outbox_batch: {e}")
+        return []
+
+async def complete_outbox_items(ids: list) -> None:
+    if not ids: return
+    try:
+        async with db_pool.connection() as conn:
+            await conn.execute("DELETE FROM outbox WHERE id = ANY(%s)", (ids,))
+    except psycopg.Error as e:
+        logger.error(f"Database error in complete_outbox_items: {e}")
+
+async def reschedule_outbox_items(ids: list, delay: float) -> None:
+    if not ids: return
+    try:
+        async with db_pool.connection() as conn:
+            await conn.execute("UPDATE outbox SET available_at = now() + %s WHERE id = ANY(%s)", (timedelta(seconds=delay), ids))
+    except psycopg.Error as e:
+        logger.error(f"Database error in reschedule_outbox_items: {e}")
+
+
+# =================================================================
+# دستورات و دکمه‌های اصلی (تابع start اصلاح شد)
+# =================================================================
+
+# <--- تابع start با parse_mode=HTML اصلاح شد --->
+@observed_handler
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    
+    keyboard = [
+        ["🎲 مرور روزانه", "📊 آمار لایتنر"],
+        ["📚 نمایش همه", "⚙️ تنظیمات"],
+        ["❓ راهنما"]
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    
+    # /start کاربری را که قبلاً ربات را بلاک کرده بود دوباره فعال می‌کند.
+    await activate_user(user_id, update.effective_chat.id)
+    stats = await get_leitner_stats(user_id) 
+    
+    # <--- متن خوشامدگویی به فرمت HTML تغییر کرد --->
+    welcome_message = (
+        f"سلام! به سیستم یادآوری لایتنر شخصی خود خوش آمدید.\n\n"
+        f"شما <b>{stats['total']}</b> یادداشت در آرشیو خود دارید.\n\n"
+        "هر چیزی برای من بفرستید تا به <b>جعبه ۱</b> لایتنر شما اضافه شود.\n\n"
+        "اگر نمی‌دانید چطور کار می‌کند، دکمه <b>«❓ راهنما»</b> را بزنید."
+    )
+    
+    # <--- parse_mode به HTML تغییر کرد تا خطا برطرف شود --->
+    await update.message.reply_text(
+        welcome_message, 
+        reply_markup=reply_markup, 
+        parse_mode=ParseMode.HTML
+    )
+
+@observed_handler
+async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(
+        HELP_MESSAGE_TEXT, 
+        parse_mode=ParseMode.HTML, 
+        disable_web_page_preview=True
+    )
+
+@observed_handler
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # تلگرام بلاک و آنبلاک شدن ربات در چت خصوصی را خودش خبر می‌دهد.
+    member_update = update.my_chat_member
+    if member_update.chat.type != "private":
+        return
+    if member_update.new_chat_member.status == "kicked":
+        await deactivate_user(member_update.from_user.id)
+    elif member_update.new_chat_member.status == "member":
+        await activate_user(member_update.from_user.id, member_update.chat.id)
+
+@observed_handler
+async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    message_id = update.message.message_id
+    content_text = update.message.text or update.message.caption
+    
+    if await add_message_id_to_db(user_id, chat_id, message_id, content_text):
+        stats = await get_leitner_stats(user_id) 
+        await update.message.reply_text(f"✅ به جعبه ۱ شما اضافه شد! (مجموع: {stats['total']})", reply_to_message_id=message_id)
+
+# =================================================================
+# محدودکننده نرخ ارسال تلگرام (Token bucket)
+# =================================================================
+
+# خطاهای دائمی که یعنی پیام مبدأ کارت دیگر وجود ندارد
+MISSING_MESSAGE_ERRORS = ("message to copy not found", "message to forward not found", "message_id_invalid")
+
+def is_missing_message_error(error: BadRequest) -> bool:
+    return any(text in error.message.lower() for text in MISSING_MESSAGE_ERRORS)
+
+def is_dead_chat_error(error: Exception) -> bool:
+    # کاربر ربات را بلاک کرده، حسابش حذف شده یا چت دیگر وجود ندارد.
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in error.message.lower())
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, priority: bool = False) -> float:
+        # توکن همین حالا رزرو می‌شود (ممکن است منفی شود) و زمان انتظار تا نوبت آن برگردانده می‌شود.
+        # درخواست با اولویت پشت رزروهای قبلی نمی‌ماند و فقط توقف ناشی از 429 را رعایت می‌کند؛
+        # توکنش همچنان کم می‌شود، پس ارسال‌های انبوه بعدی هزینه آن را می‌دهند.
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 and not priority else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class TelegramRateLimiter:
+    def __init__(self, global_rate: float, per_chat_rate: float, per_chat_burst: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10_000:
+                self.chat_buckets = {cid: b for cid, b in self.chat_buckets.items() if not b.is_idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id: int, priority: bool = False) -> None:
+        started = time.perf_counter()
+        wait = self._chat_bucket(chat_id).reserve(priority)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        wait = self.global_bucket.reserve(priority)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        telegram_send_wait.labels("priority" if priority else "bulk").observe(time.perf_counter() - started)
+
+    async def call(self, chat_id: int, method, /, *args, **kwargs):
+        return await self._call(chat_id, False, method, args, kwargs)
+
+    async def call_priority(self, chat_id: int, method, /, *args, **kwargs):
+        # برای پاسخ به کار خود کاربر (مثل ویرایش کارت بعد از زدن دکمه) که نباید پشت ارسال‌های انبوه بماند.
+        return await self._call(chat_id, True, method, args, kwargs)
+
+    async def _call(self, chat_id: int, priority: bool, method, args: tuple, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, priority)
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"Flood control hit for chat {chat_id}, pausing sends for {delay}s (attempt {attempt + 1}).")
+                self.global_bucket.pause(delay)
+                self._chat_bucket(chat_id).pause(delay)
+                if attempt == self.max_retries:
+                    raise
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = min(2 ** attempt, 30)
+                logger.warning(f"Network error while sending to chat {chat_id}: {e}. Retrying in {backoff}s.")
+                await asyncio.sleep(backoff)
+
+
+rate_limiter = TelegramRateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE * TELEGRAM_RATE_SHARE,
+    per_chat_rate=TELEGRAM_PER_CHAT_RATE,
+    per_chat_burst=TELEGRAM_PER_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+
+# =================================================================
+# صف ارسال پایدار (Outbox) و کارگرهای تخلیه آن
+# =================================================================
+
+outbox_tasks: list[asyncio.Task] = []
+
+async def deliver_outbox_item(bot, item: dict) -> str:
+    # خروجی: done (ارسال شد یا خطای دائمی داشت)، retry (بعداً دوباره) یا dead_chat (کاربر غیرفعال شد).
+    try:
+        if item['method'] == 'forward':
+            await rate_limiter.call(
+                item['chat_id'], bot.forward_message,
+                chat_id=item['chat_id'], from_chat_id=item['from_chat_id'], message_id=item['message_id'],
+            )
+        else:
+            reply_markup = review_keyboard(item['message_id']) if item['with_review_keyboard'] else None
+            await rate_limiter.call(
+                item['chat_id'], bot.copy_message,
+                chat_id=item['chat_id'], from_chat_id=item['from_chat_id'], message_id=item['message_id'],
+                reply_markup=reply_markup,
+            )
+        outbox_deliveries.labels("sent").inc()
+        return "done"
+    except (BadRequest, Forbidden) as e:
+        logger.warning(f"Dropping outbox item {item['id']} ({item['method']} {item['message_id']} for user {item['user_id']}): {e}")
+        outbox_deliveries.labels("dropped").inc()
+        if is_dead_chat_error(e):
+            await deactivate_user(item['user_id'])
+            return "dead_chat"
+        if is_missing_message_error(e):
+            failure = await record_card_failure(item['user_id'], item['message_id'])
+            if failure and item['with_review_keyboard']:
+                await enqueue_review_backfill(item['user_id'], item['chat_id'], failure['previous_review_at'], failure['id'])
+        return "done"
+    except Exception as e:
+        return retry_or_give_up(item, e)
+
+def retry_or_give_up(item: dict, error: Exception) -> str:
+    if item['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"Giving up on outbox item {item['id']} after {item['attempts']} attempts: {error}")
+        outbox_deliveries.labels("given_up").inc()
+        return "done"
+    logger.warning(f"Outbox item {item['id']} failed (attempt {item['attempts']}), will retry: {error}")
+    outbox_deliveries.labels("retry").inc()
+    return "retry"
+
+def group_outbox_items(items: list) -> list[list]:
+    # ردیف‌های پشت‌سرهم بدون کیبورد مرور، از یک چت مبدأ و با یک روش، در یک copyMessages/forwardMessages
+    # فرستاده می‌شوند. Bot API شناسه‌ها را صعودی می‌خواهد، پس جایی که ترتیب می‌شکند گروه تازه شروع می‌شود.
+    groups: list[list] = []
+    for item in items:
+        group = groups[-1] if groups else None
+        last = group[-1] if group else None
+        if (last is not None and not item['with_review_keyboard'] and not last['with_review_keyboard']
+                and item['method'] == last['method'] and item['from_chat_id'] == last['from_chat_id']
+                and item['message_id'] > last['message_id'] and len(group) < OUTBOX_GROUP_SIZE):
+            group.append(item)
+        else:
+            groups.append([item])
+    return groups
+
+async def deliver_outbox_group(bot, items: list) -> list[str]:
+    # خروجی: نتیجه هر ردیف به ترتیب؛ بعد از dead_chat ردیف دیگری امتحان نمی‌شود.
+    if len(items) == 1:
+        return [await deliver_outbox_item(bot, items[0])]
+
+    first = items[0]
+    method = bot.forward_messages if first['method'] == 'forward' else bot.copy_messages
+    try:
+        # پیام‌هایی که در مبدأ پیدا نشوند را تلگرام بی‌صدا رد می‌کند و بقیه ارسال می‌شوند.
+        await rate_limiter.call(
+            first['chat_id'], method,
+            chat_id=first['chat_id'], from_chat_id=first['from_chat_id'],
+            message_ids=[item['message_id'] for item in items],
+        )
+        outbox_deliveries.labels("sent").inc(len(items))
+        return ["done"] * len(items)
+    except (BadRequest, Forbidden) as e:
+        if is_dead_chat_error(e):
+            logger.warning(f"Dropping {len(items)} outbox items for user {first['user_id']}: {e}")
+            outbox_deliveries.labels("dropped").inc(len(items))
+            await deactivate_user(first['user_id'])
+            return ["dead_chat"]
+        # خطای کل گروه به پیام خاصی نسبت داده نمی‌شود؛ ردیف‌ها تکی فرستاده می‌شوند تا خطای هر کدام جدا ثبت شود.
+        logger.warning(f"Grouped {first['method']} of {len(items)} items for user {first['user_id']} failed, sending one by one: {e}")
+        results = []
+        for item in items:
+            results.append(await deliver_outbox_item(bot, item))
+            if results[-1] == "dead_chat":
+                break
+        return results
+    except Exception as e:
+        return [retry_or_give_up(item, e) for item in items]
+
+async def process_outbox_batch(bot, batch: list) -> None:
+    by_chat: dict[int, list] = {}
+    for item in batch:
+        by_chat.setdefault(item['chat_id'], []).append(item)
+
+    done, failed = [], []
+
+    async def deliver_chat(items: list):
+        # ترتیب ارسال در هر چت حفظ می‌شود؛ چت‌های مختلف هم‌زمان ارسال می‌شوند.
+        position = 0
+        for group in group_outbox_items(items):
+            for result in await deliver_outbox_group(bot, group):
+                if result == "dead_chat":
+                    # بقیه ردیف‌های این چت ارسال نمی‌شوند (deactivate_user آن‌ها را از صف حذف کرده است).
+                    done.extend(rest['id'] for rest in items[position:])
+                    return
+                (failed if result == "retry" else done).append(items[position]['id'])
+                position += 1
+
+    await asyncio.gather(*(deliver_chat(items) for items in by_chat.values()))
+    await complete_outbox_items(done)
+    await reschedule_outbox_items(failed, OUTBOX_RETRY_DELAY)
+
+async def outbox_worker(bot, worker_id: int) -> None:
+    logger.info(f"Outbox worker {worker_id} started.")
+    while True:
+        try:
+            batch = await claim_outbox_batch(OUTBOX_BATCH_SIZE)
+            if not batch:
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+                continue
+            await process_outbox_batch(bot, batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox worker {worker_id} crashed on a batch: {e}")
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+def start_outbox_workers(bot) -> None:
+    for worker_id in range(OUTBOX_WORKERS):
+        outbox_tasks.append(asyncio.create_task(outbox_worker(bot, worker_id)))
+
+async def stop_outbox_workers() -> None:
+    for task in outbox_tasks:
+        task.cancel()
+    await asyncio.gather(*outbox_tasks, return_exceptions=True)
+    outbox_tasks.clear()
+
+# =================================================================
+# کارهای طولانی هر کاربر
+# =================================================================
+# مرور دستی، نمایش جعبه و «نمایش همه» چند ثانیه طول می‌کشند چون ارسال‌ها با نرخ هر چت محدودند.
+# این کارها بیرون از قفل آپدیت‌های کاربر اجرا می‌شوند تا یادداشت‌های تازه‌اش پشت آن‌ها نمانند،
+# و از هر نوع فقط یکی برای هر کاربر در جریان است.
+
+class UserTaskRegistry:
+    def __init__(self):
+        self.tasks: dict[int, dict[str, asyncio.Task]] = {}
+
+    def get(self, user_id: int, kind: str) -> asyncio.Task | None:
+        return self.tasks.get(user_id, {}).get(kind)
+
+    def start(self, user_id: int, kind: str, coroutine, name: str | None = None, replace: bool = False) -> asyncio.Task | None:
+        # خروجی None یعنی کار هم‌نوعی در جریان بود و این یکی رد شد؛ با replace کار قبلی لغو می‌شود.
+        running = self.get(user_id, kind)
+        if running is not None:
+            if not replace:
+                coroutine.close()
+                user_tasks_refused.labels(kind).inc()
+                return None
+            running.cancel()
+
+        task = asyncio.create_task(coroutine, name=name)
+        self.tasks.setdefault(user_id, {})[kind] = task
+        task.add_done_callback(lambda task: self.finished(user_id, kind, task))
+        return task
+
+    def finished(self, user_id: int, kind: str, task: asyncio.Task) -> None:
+        tasks = self.tasks.get(user_id)
+        if tasks and tasks.get(kind) is task:
+            del tasks[kind]
+            if not tasks:
+                del self.tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background {kind} task for user {user_id} failed: {task.exception()}")
+
+    def cancel(self, user_id: int, kind: str, name: str | None = None) -> bool:
+        task = self.get(user_id, kind)
+        if task is None or (name is not None and task.get_name() != name):
+            return False
+        task.cancel()
+        return True
+
+    async def stop(self) -> None:
+        tasks = [task for user_task_map in self.tasks.values() for task in user_task_map.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+
+user_tasks = UserTaskRegistry()
+
+# =================================================================
+# منطق اصلی مرور و بازخورد لایتنر
+# =================================================================
+
+def review_keyboard(message_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ یادم بود", callback_data=f"leitner_up_{message_id}"),
+        InlineKeyboardButton("🤔 مرور مجدد", callback_data=f"leitner_reset_{message_id}"),
+        InlineKeyboardButton("🗑️ حذف", callback_data=f"leitner_del_{message_id}")
+    ]])
+
+class RenderedMessageCache:
+    # آخرین متن و کیبوردی که روی هر پیام گذاشته‌ایم؛ ویرایشی که چیزی را عوض نمی‌کند فرستاده نمی‌شود.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[int, int], tuple[str, str | None]] = OrderedDict()
+
+    def get(self, chat_id: int, message_id: int) -> tuple[str, str | None] | None:
+        state = self.entries.get((chat_id, message_id))
+        if state is not None:
+            self.entries.move_to_end((chat_id, message_id))
+        return state
+
+    def put(self, chat_id: int, message_id: int, state: tuple[str, str | None]) -> None:
+        self.entries[(chat_id, message_id)] = state
+        self.entries.move_to_end((chat_id, message_id))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        self.entries.pop((chat_id, message_id), None)
+
+rendered_messages = RenderedMessageCache(RENDERED_MESSAGES_CACHE_SIZE)
+
+async def answer_callback(query) -> None:
+    # پاسخ نرسیده فقط یعنی دکمه کمی بیشتر در حالت بارگذاری می‌ماند؛ کار اصلی نباید متوقف شود.
+    try:
+        await query.answer()
+    except TelegramError as e:
+        logger.warning(f"Could not answer callback query: {e}")
+
+async def edit_rendered_message(query, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> None:
+    message = query.message
+    state = (text, reply_markup.to_json() if reply_markup else None)
+    if rendered_messages.get(message.chat_id, message.message_id) == state:
+        telegram_edits_skipped.inc()
+        return
+
+    if message.text:
+        method, content = query.edit_message_text, {"text": text}
+    else:
+        method, content = query.edit_message_caption, {"caption": text}
+    try:
+        await rate_limiter.call_priority(message.chat_id, method, **content, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    rendered_messages.put(message.chat_id, message.message_id, state)
+
+async def trigger_leitner_review(bot, user_id: int, chat_id: int) -> int:
+    daily_reviews = int(await get_setting(user_id, 'daily_reviews', '2'))
+    logger.info(f"Triggering {daily_reviews} Leitner reviews for user {user_id}...")
+    
+    sent = 0
+    # کارت‌هایی که پیام مبدأشان حذف شده عقب می‌افتند، پس انتخاب دوباره کارت سررسید بعدی را می‌آورد.
+    while sent < daily_reviews:
+        messages = await get_review_candidates(user_id, daily_reviews - sent)
+        if not messages: break
+
+        pruned = 0
+        for msg in messages:
+            message_id = msg['message_id']
+            from_chat_id = msg['chat_id'] 
+            
+            reply_markup = review_keyboard(message_id)
+            try:
+                await rate_limiter.call(chat_id, bot.copy_message, chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=reply_markup)
+                sent += 1
+            except (BadRequest, Forbidden) as e:
+                if is_dead_chat_error(e):
+                    logger.warning(f"Chat of user {user_id} is unreachable, stopping review: {e}")
+                    await deactivate_user(user_id)
+                    return sent
+                logger.error(f"Failed to copy message {message_id} for user {user_id} (BadRequest): {e}. It might be deleted.")
+                if is_missing_message_error(e) and await record_card_failure(user_id, message_id):
+                    pruned += 1
+            except Exception as e:
+                logger.error(f"An unexpected error occurred while copying message {message_id} for user {user_id}: {e}")
+        if not pruned: break
+            
+    return sent
+
+async def run_review_scheduler(context: ContextTypes.DEFAULT_TYPE):
+    # هر tick فقط کاربرانی را که ساعت مرورشان رسیده در صف می‌گذارد؛ بار به‌جای یک جهش روزانه در طول روز پخش می‌شود.
+    # چند پردازه می‌توانند هم‌زمان tick بزنند (SKIP LOCKED). بعد از یک قطعی طولانی، عقب‌ماندگی
+    # با سقف SCHEDULER_MAX_USERS_PER_TICK در هر tick جبران می‌شود.
+    started_at = time.monotonic()
+    while await schedule_new_users(SCHEDULER_BATCH_SIZE) == SCHEDULER_BATCH_SIZE:
+        pass
+
+    users = cards = 0
+    while users < SCHEDULER_MAX_USERS_PER_TICK:
+        limit = min(SCHEDULER_BATCH_SIZE, SCHEDULER_MAX_USERS_PER_TICK - users)
+        batch_users, batch_cards = await claim_due_deliveries(limit)
+        users += batch_users
+        cards += batch_cards
+        if batch_users < limit:
+            break
+
+    scheduler_users.inc(users)
+    scheduler_cards.inc(cards)
+    scheduler_lag.set(await get_scheduler_lag())
+    scheduler_tick_duration.set(time.monotonic() - started_at)
+    if users:
+        logger.info(f"Review scheduler queued {cards} cards for {users} users in {time.monotonic() - started_at:.2f}s.")
+
+async def sweep_tombstoned_cards(context: ContextTypes.DEFAULT_TYPE):
+    # کارت‌های tombstone‌شده دسته‌دسته حذف می‌شوند؛ شمارنده‌های جعبه همان هنگام tombstone شدن کم شده‌اند.
+    total = 0
+    while True:
+        deleted = await delete_tombstoned_cards(TOMBSTONE_SWEEP_BATCH)
+        total += deleted
+        if deleted < TOMBSTONE_SWEEP_BATCH:
+            break
+    if total:
+        cards_pruned.labels("deleted").inc(total)
+        logger.info(f"Swept {total} tombstoned cards.")
+
+async def sweep_mastered_cards(context: ContextTypes.DEFAULT_TYPE):
+    # کارت‌هایی که مدت‌ها در آخرین جعبه مانده‌اند از مسیر داغ (مرور، زمان‌بند، نمای جعبه‌های دیگر) بیرون می‌روند.
+    total = 0
+    for _ in range(ARCHIVE_SWEEP_MAX_BATCHES):
+        archived = await archive_mastered_cards(ARCHIVE_SWEEP_BATCH)
+        total += archived
+        if archived < ARCHIVE_SWEEP_BATCH:
+            break
+    if total:
+        cards_archived.inc(total)
+        logger.info(f"Archived {total} mastered cards.")
+
+async def rollup_review_stats(context: ContextTypes.DEFAULT_TYPE):
+    total = 0
+    while True:
+        rolled_up = await rollup_review_events(REVIEW_ROLLUP_BATCH)
+        total += rolled_up
+        if rolled_up < REVIEW_ROLLUP_BATCH:
+            break
+    if total:
+        logger.info(f"Rolled up {total} review events.")
+
+
+@observed_handler
+async def handle_leitner_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    try:
+        data_part = query.data.replace("leitner_", "", 1)
+        parts = data_part.rsplit("_", 1)
+        action = parts[0]
+        message_id = int(parts[1])
+
+    except (ValueError, IndexError, TypeError):
+        logger.error(f"Invalid callback data received: {query.data}")
+        await answer_callback(query)
+        await query.edit_message_text(text="❌ خطای داخلی.")
+        return
+
+    # پاسخ به callback و نوشتن در دیتابیس هم‌زمان انجام می‌شوند تا دکمه زودتر از حالت بارگذاری دربیاید.
+    new_box = deleted = None
+    if action in ("up", "reset"):
+        _, (old_box, new_box) = await asyncio.gather(answer_callback(query), move_leitner_box(user_id, message_id, action))
+        if new_box:
+            record_review_event(user_id, message_id, action, old_box, new_box)
+    elif action == "del_confirm":
+        _, deleted = await asyncio.gather(answer_callback(query), delete_message_from_db(user_id, message_id))
+        if deleted:
+            record_review_event(user_id, message_id, "delete", deleted, None)
+    else:
+        await answer_callback(query)
+
+    feedback_text = ""
+    new_keyboard = None 
+
+    if action == "up":
+        feedback_text = f"👍 عالی! این یادداشت به جعبه <b>{new_box}</b> منتقل شد."
+    
+    elif action == "reset":
+        feedback_text = f"🔄 این یادداشت برای مرور بیشتر به جعبه <b>{new_box}</b> برگشت."
+    
+    elif action == "del":
+        feedback_text = "⚠️ <b>آیا از حذف این یادداشت مطمئن هستید؟</b>\nاین عمل قابل بازگشت نیست."
+        new_keyboard = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("🚮 بله، حذف کن", callback_data=f"leitner_del_confirm_{message_id}"),
+                InlineKeyboardButton("↪️ انصراف", callback_data=f"leitner_del_cancel_{message_id}")
+            ]
+        ])
+
+    elif action == "del_confirm":
+        feedback_text = "🗑️ یادداشت برای همیشه حذف شد." if deleted is not None else "❌ خطایی در هنگام حذف رخ داد."
+
+    elif action == "del_cancel":
+        feedback_text = "عملیات حذف لغو شد."
+        new_keyboard = review_keyboard(message_id)
+
+    else:
+        feedback_text = "❌ دستور نامعتبر."
+
+    try:
+        if action == "del_confirm" and deleted is not None:
+            rendered_messages.forget(query.message.chat_id, query.message.message_id)
+            await rate_limiter.call_priority(query.message.chat_id, query.delete_message)
+        else:
+            await edit_rendered_message(query, feedback_text, new_keyboard)
+    except BadRequest as e:
+        logger.warning(f"Could not edit message after callback: {e}")
+    except Exception as e:
+        logger.error(f"Failed to edit/delete message after callback: {e}")
+
+
+# =================================================================
+# منوی آمار
+# =================================================================
+
+async def build_stats_menu(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    stats, history = await asyncio.gather(get_leitner_stats(user_id), get_review_history(user_id, REVIEW_HISTORY_DAYS))
+    
+    keyboard = []
+    for i in range(1, MAX_LEITNER_BOX + 1):
+        box_count = stats[f'box_{i}']
+        button_text = f"📦 جعبه {i} ({box_count} مورد)"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"view_box_{i}")])
+    
+    keyboard.append([InlineKeyboardButton("❌ بستن", callback_data="stats_close")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    stats_text = f"📊 <b>آمار جعبه لایتنر شما</b>\n\n"
+    recent_reviews = history['recent_ups'] + history['recent_resets']
+    total_reviews = history['total_ups'] + history['total_resets']
+    if total_reviews:
+        # آمار از جدول‌های تجمیعی خوانده می‌شود و تا چند دقیقه از مرورهای اخیر عقب است.
+        recent_rate = round(100 * history['recent_ups'] / recent_reviews) if recent_reviews else 0
+        total_rate = round(100 * history['total_ups'] / total_reviews)
+        stats_text += (
+            f"📈 {REVIEW_HISTORY_DAYS} روز اخیر: {recent_reviews} مرور در {history['active_days']} روز، {recent_rate}٪ یادم بود\n"
+            f"🗂 از ابتدا: {total_reviews} مرور، {total_rate}٪ یادم بود\n\n"
+        )
+    stats_text += "برای مشاهده محتوای هر جعبه، روی دکمه آن کلیک کنید."
+    return stats_text, reply_markup
+
+@observed_handler
+async def stats_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await show_stats_menu(update, context)
+
+async def show_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # بدون observed_handler تا وقتی از هندلرهای دیگر صدا زده می‌شود، یک آپدیت دو بار ثبت نشود.
+    user_id = update.effective_user.id
+    stats_text, reply_markup = await build_stats_menu(user_id)
+
+    if update.message:
+        await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    elif update.callback_query:
+        try:
+            await update.callback_query.message.edit_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        except BadRequest:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+@observed_handler
+async def handle_view_box_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    chat_id = query.message.chat_id
+    
+    # view_box_{box} برای صفحه اول و view_box_{box}_{page}_{last_id} برای صفحه‌های بعدی (صفحه‌بندی keyset)
+    try:
+        parts = query.data.split("_")
+        box_number = int(parts[2])
+        page = int(parts[3]) if len(parts) > 3 else 1
+        after_id = int(parts[4]) if len(parts) > 4 else 0
+    except (ValueError, IndexError):
+        await query.answer()
+        await query.edit_message_text("❌ خطای داخلی در انتخاب جعبه.")
+        return
+
+    messages = await get_messages_in_box(user_id, box_number, after_id, BOX_PAGE_SIZE + 1)
+    has_more = len(messages) > BOX_PAGE_SIZE
+    messages = messages[:BOX_PAGE_SIZE]
+
+    if not messages:
+        await query.answer(f"جعبه {box_number} یادداشت دیگری ندارد.", show_alert=True)
+        if page > 1:
+            await show_stats_menu(update, context)
+        return
+
+    await query.answer()
+    try:
+        await query.delete_message()
+    except BadRequest as e:
+        logger.warning(f"Could not delete box view navigation message: {e}")
+
+    # انتخاب جعبه یا صفحه دیگر ارسال صفحه قبلی را که هنوز تمام نشده لغو می‌کند.
+    user_tasks.start(
+        user_id, "box_view", send_box_page(context.bot, user_id, chat_id, box_number, page, messages, has_more), replace=True
+    )
+
+async def send_box_page(bot, user_id: int, chat_id: int, box_number: int, page: int, messages: list, has_more: bool) -> None:
+    for msg in messages:
+        message_id = msg['message_id']
+        try:
+            await rate_limiter.call(
+                chat_id, bot.copy_message,
+                chat_id=chat_id,
+                from_chat_id=msg['chat_id'],
+                message_id=message_id,
+                reply_markup=review_keyboard(message_id)
+            )
+        except BadRequest as e:
+            logger.warning(f"Could not copy message {message_id} from box view for user {user_id}: {e}")
+            if is_missing_message_error(e):
+                await record_card_failure(user_id, message_id)
+        except Exception as e:
+            logger.warning(f"Could not copy message {message_id} from box view for user {user_id}: {e}")
+
+    if has_more:
+        first_index = (page - 1) * BOX_PAGE_SIZE + 1
+        last_index = first_index + len(messages) - 1
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("▶️ صفحه بعد", callback_data=f"view_box_{box_number}_{page + 1}_{messages[-1]['id']}")],
+            [InlineKeyboardButton("📊 بازگشت به آمار", callback_data="stats_open")],
+        ])
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"📦 جعبه {box_number}: یادداشت‌های <b>{first_index}</b> تا <b>{last_index}</b> نمایش داده شد.",
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup
+        )
+    else:
+        stats_text, reply_markup = await build_stats_menu(user_id)
+        await bot.send_message(chat_id=chat_id, text=stats_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+@observed_handler
+async def handle_stats_open_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.answer()
+    await show_stats_menu(update, context)
+
+
+@observed_handler
+async def handle_stats_close_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    try:
+        await query.delete_message()
+    except Exception as e:
+        logger.warning(f"Could not delete stats message: {e}")
+
+# =================================================================
+# جست‌وجوی یادداشت‌ها
+# =================================================================
+# /search عبارت فهرست یادداشت‌هایی را که متن یا کپشنشان عبارت را دارد (از جدیدترین) در یک پیام می‌فرستد.
+# عبارت جست‌وجو در سطر اول همان پیام نتایج است و دکمه صفحه بعد آن را از پیام خودش می‌خواند؛ پس هر پیام نتایج
+# فقط عبارت خودش را ورق می‌زند و وضعیتی جایی ذخیره نمی‌شود. callback_data فقط صفحه و id آخرین نتیجه را دارد.
+SEARCH_HEADER_PATTERN = re.compile(r"^🔎 نتایج جست‌وجوی «(.*)» \(صفحه \d+\):$")
+
+def search_query_from_results(message) -> str | None:
+    # پیام‌های قدیمی‌تر از ۴۸ ساعت (InaccessibleMessage) متن ندارند.
+    match = SEARCH_HEADER_PATTERN.match((getattr(message, "text", None) or "").split("\n", 1)[0])
+    return match.group(1) if match else None
+
+def build_search_page(text: str, page: int, results: list, has_more: bool) -> tuple[str, InlineKeyboardMarkup]:
+    first_index = (page - 1) * SEARCH_PAGE_SIZE + 1
+    lines = [f"🔎 نتایج جست‌وجوی «{html.escape(text)}» (صفحه {page}):", ""]
+    buttons = []
+    for index, card in enumerate(results, first_index):
+        snippet = " ".join(card['content_text'].split())
+        if len(snippet) > SEARCH_SNIPPET_LENGTH:
+            snippet = snippet[:SEARCH_SNIPPET_LENGTH] + "…"
+        lines.append(f"<b>{index}.</b> 📦{card['leitner_box']} — {html.escape(snippet)}")
+        buttons.append(InlineKeyboardButton(str(index), callback_data=f"search_show_{card['message_id']}"))
+    lines.append("\nبرای دیدن هر یادداشت، شماره آن را بزنید.")
+
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    if has_more:
+        keyboard.append([InlineKeyboardButton("▶️ صفحه بعد", callback_data=f"search_page_{page + 1}_{results[-1]['id']}")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@observed_handler
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    text = " ".join(context.args)
+    if not SEARCH_TERM_PATTERN.search(normalize_search_text(text)):
+        await update.message.reply_text("🔎 برای جست‌وجو در یادداشت‌ها بنویسید: /search عبارت")
+        return
+
+    results = await search_messages(user_id, text, 0, SEARCH_PAGE_SIZE + 1)
+    if not results:
+        await update.message.reply_text(f"🔎 یادداشتی با «{text}» پیدا نشد.")
+        return
+    page_text, reply_markup = build_search_page(text, 1, results[:SEARCH_PAGE_SIZE], len(results) > SEARCH_PAGE_SIZE)
+    await update.message.reply_text(page_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+@observed_handler
+async def handle_search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    # search_page_{page}_{last_id}
+    try:
+        parts = query.data.split("_")
+        page = int(parts[2])
+        before_id = int(parts[3])
+    except (ValueError, IndexError):
+        await query.answer()
+        return
+
+    text = search_query_from_results(query.message)
+    results = await search_messages(user_id, text, before_id, SEARCH_PAGE_SIZE + 1) if text else []
+    if not results:
+        await query.answer("نتیجه دیگری نیست.", show_alert=True)
+        return
+    await query.answer()
+    page_text, reply_markup = build_search_page(text, page, results[:SEARCH_PAGE_SIZE], len(results) > SEARCH_PAGE_SIZE)
+    try:
+        await query.edit_message_text(page_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        logger.warning(f"Could not edit search results message: {e}")
+
+@observed_handler
+async def handle_search_show_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    chat_id = query.message.chat_id
+
+    try:
+        message_id = int(query.data.replace("search_show_", "", 1))
+    except ValueError:
+        await query.answer()
+        return
+
+    card = await get_card(user_id, message_id)
+    if card is None:
+        await query.answer("این یادداشت دیگر وجود ندارد.", show_alert=True)
+        return
+    await query.answer()
+    try:
+        await rate_limiter.call(
+            chat_id, context.bot.copy_message,
+            chat_id=chat_id,
+            from_chat_id=card['chat_id'],
+            message_id=message_id,
+            reply_markup=review_keyboard(message_id)
+        )
+    except BadRequest as e:
+        logger.warning(f"Could not copy message {message_id} from search for user {user_id}: {e}")
+        if is_missing_message_error(e):
+            await record_card_failure(user_id, message_id)
+
+# =================================================================
+# سایر دکمه‌ها و مکالمه تنظیمات
+# =================================================================
+
+@observed_handler
+async def handle_review_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if user_tasks.start(user_id, "review", run_manual_review(context.bot, update.message, user_id, chat_id)) is None:
+        await update.message.reply_text("⏳ مرور قبلی هنوز در حال ارسال است. لطفاً تا پایان آن صبر کنید.")
+
+async def run_manual_review(bot, message, user_id: int, chat_id: int) -> None:
+    daily_reviews = int(await get_setting(user_id, 'daily_reviews', '2'))
+    
+    await message.reply_text(f"⏳ در حال یافتن <b>{daily_reviews}</b> یادداشت برای مرور...", parse_mode=ParseMode.HTML)
+    sent_count = await trigger_leitner_review(bot, user_id, chat_id)
+    if sent_count == 0:
+        stats = await get_leitner_stats(user_id)
+        if stats['total'] == 0:
+            await message.reply_text("هنوز هیچ یادداشتی برای مرور ذخیره نکرده‌اید!")
+        else:
+            await message.reply_text("🎉 فعلاً یادداشتی برای مرور سررسید نشده است. بعداً دوباره سر بزنید!")
+
+def show_all_batch_key(user_id: int, job_id: str) -> str:
+    return f"showall:{user_id}:{job_id}"
+
+def show_all_stop_keyboard(job_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ توقف ارسال", callback_data=f"showall_stop_{job_id}")]])
+
+async def track_show_all_progress(bot, user_id: int, chat_id: int, status_message_id: int, job_id: str, total: int) -> None:
+    batch_key = show_all_batch_key(user_id, job_id)
+    last_text = None
+    try:
+        while True:
+            await asyncio.sleep(SHOW_ALL_PROGRESS_INTERVAL)
+            remaining = await count_outbox_batch(batch_key)
+            if remaining is None:
+                continue
+            if remaining == 0:
+                await rate_limiter.call(chat_id, bot.edit_message_text, chat_id=chat_id, message_id=status_message_id, text=f"✅ ارسال تمام شد. ({total} یادداشت)")
+                return
+            text = f"📤 در حال ارسال یادداشت‌ها: <b>{total - remaining}</b> از <b>{total}</b>"
+            if text != last_text:
+                await rate_limiter.call(
+                    chat_id, bot.edit_message_text,
+                    chat_id=chat_id, message_id=status_message_id, text=text,
+                    parse_mode=ParseMode.HTML, reply_markup=show_all_stop_keyboard(job_id)
+                )
+                last_text = text
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Show-all progress tracking stopped for user {user_id}: {e}")
+
+@observed_handler
+async def list_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if user_tasks.get(user_id, "show_all"):
+        await update.message.reply_text("⏳ ارسال قبلی هنوز در جریان است. برای شروع دوباره، ابتدا آن را متوقف کنید.")
+        return
+    
+    job_id = uuid.uuid4().hex[:12]
+    queued = await enqueue_forward_all(user_id, chat_id, show_all_batch_key(user_id, job_id))
+    
+    if not queued:
+        await update.message.reply_text("هنوز هیچ یادداشتی ذخیره نکرده‌اید!")
+        return
+
+    status_message = await update.message.reply_text(
+        f"📤 در حال ارسال یادداشت‌ها: <b>0</b> از <b>{queued}</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=show_all_stop_keyboard(job_id)
+    )
+    user_tasks.start(
+        user_id, "show_all",
+        track_show_all_progress(context.bot, user_id, chat_id, status_message.message_id, job_id, queued),
+        name=show_all_batch_key(user_id, job_id)
+    )
+
+@observed_handler
+async def handle_show_all_stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    # کلید دسته از روی شناسه همین کاربر ساخته می‌شود، پس هر کاربر فقط ارسال خودش را متوقف می‌کند.
+    job_id = query.data.replace("showall_stop_", "", 1)
+    batch_key = show_all_batch_key(user_id, job_id)
+    await cancel_outbox_batch(batch_key)
+    user_tasks.cancel(user_id, "show_all", name=batch_key)
+
+    try:
+        await query.edit_message_text("⏹ ارسال متوقف شد.")
+    except BadRequest as e:
+        logger.warning(f"Could not edit show-all status message: {e}")
+
+@observed_handler
+async def settings_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user_id = update.effective_user.id
+    current_count = await get_setting(user_id, 'daily_reviews', '2')
+    
+    await update.message.reply_text(
+        f"⚙️ <b>تنظیمات</b>\n\nتعداد مرور روزانه در حال حاضر: <b>{current_count}</b>\n\n"
+        "لطفاً تعداد جدید را به صورت یک عدد (مثلاً 5) ارسال کنید.\nبرای لغو، /cancel را بزنید.",
+        parse_mode=ParseMode.HTML
+    )
+    return AWAITING_REVIEW_COUNT
+
+@observed_handler
+async def settings_receive_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user_id = update.effective_user.id
+    try:
+        new_count = int(update.message.text)
+        if 1 <= new_count <= 20:
+            await set_setting(user_id, 'daily_reviews', str(new_count))
+            await update.message.reply_text(f"✅ تعداد مرور روزانه به <b>{new_count}</b> تغییر کرد.", parse_mode=ParseMode.HTML)
+            return ConversationHandler.END
+        else:
+            await update.message.reply_text("❌ لطفاً یک عدد بین ۱ تا ۲۰ وارد کنید.")
+            return AWAITING_REVIEW_COUNT
+    except (ValueError, TypeError):
+        await update.message.reply_text("❌ ورودی نامعتبر است. لطفاً فقط یک عدد ارسال کنید.")
+        return AWAITING_REVIEW_COUNT
+
+@observed_handler
+async def settings_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("عملیات لغو شد.")
+    return ConversationHandler.END
+
+def format_schedule(schedule: dict) -> str:
+    next_at = schedule['next_delivery_at'].astimezone(ZoneInfo(schedule['timezone']))
+    review_time = schedule['review_time'].strftime('%H:%M') if schedule['review_time'] else "خودکار"
+    return (
+        f"🕰 منطقه زمانی: <b>{schedule['timezone']}</b>\n"
+        f"⏰ ساعت مرور روزانه: <b>{review_time}</b>\n"
+        f"📬 مرور بعدی: <b>{next_at.strftime('%Y-%m-%d %H:%M')}</b>"
+    )
+
+@observed_handler
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    timezone = context.args[0] if context.args else None
+    if timezone is not None:
+        try:
+            ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError):
+            await update.message.reply_text("❌ منطقه زمانی نامعتبر است. مثال: /timezone Asia/Tehran")
+            return
+
+    schedule = await set_user_schedule(user_id, update.effective_chat.id, timezone=timezone)
+    if schedule is None:
+        await update.message.reply_text("❌ ذخیره منطقه زمانی ممکن نشد. لطفاً دوباره تلاش کنید.")
+        return
+    prefix = "✅ منطقه زمانی ذخیره شد.\n\n" if timezone else "برای تغییر: /timezone Asia/Tehran\n\n"
+    await update.message.reply_text(prefix + format_schedule(schedule), parse_mode=ParseMode.HTML)
+
+@observed_handler
+async def review_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    review_time = None
+    if context.args:
+        try:
+            review_time = datetime.strptime(context.args[0], "%H:%M").time()
+        except ValueError:
+            await update.message.reply_text("❌ ساعت نامعتبر است. مثال: /reviewtime 08:30")
+            return
+
+    schedule = await set_user_schedule(user_id, update.effective_chat.id, review_time=review_time)
+    if schedule is None:
+        await update.message.reply_text("❌ ذخیره ساعت مرور ممکن نشد. لطفاً دوباره تلاش کنید.")
+        return
+    prefix = "✅ ساعت مرور روزانه ذخیره شد.\n\n" if review_time else "برای تغییر: /reviewtime 08:30\n\n"
+    await update.message.reply_text(prefix + format_schedule(schedule), parse_mode=ParseMode.HTML)
+
+# =================================================================
+# خروجی گرفتن و بازگردانی deck (COPY)
+# =================================================================
+# /export خروجی یادداشت‌ها و تنظیمات خود کاربر را به صورت tar.gz (messages.csv و settings.csv) می‌فرستد.
+# فرستادن همین فایل با کپشن /import آن را برمی‌گرداند. خروجی و بازگردانی کل نمونه از حد حجم فایل Bot API
+# بزرگ‌تر است و فقط روی سرور انجام می‌شود: python main.py export|import <مسیر فایل>
+
+def write_export_archive(directory: str, archive_path: str) -> None:
+    with tarfile.open(archive_path, "w:gz") as tar:
+        for name in EXPORT_QUERIES:
+            tar.add(os.path.join(directory, name), arcname=name)
+
+def extract_import_archive(archive_path: str, directory: str, max_file_bytes: int | None = None) -> dict:
+    # فقط فایل‌های شناخته‌شده استخراج می‌شوند (بدون مسیر دلخواه یا لینک) و اندازه هر کدام می‌تواند محدود شود.
+    paths = {}
+    with tarfile.open(archive_path, "r:*") as tar:
+        for member in tar:
+            if member.name not in EXPORT_QUERIES or not member.isfile():
+                continue
+            if max_file_bytes is not None and member.size > max_file_bytes:
+                raise ValueError(f"{member.name} is larger than {max_file_bytes} bytes")
+            path = os.path.join(directory, member.name)
+            with tar.extractfile(member) as source, open(path, "wb") as target:
+                shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+            paths[member.name] = path
+    return paths
+
+@observed_handler
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if context.args[:1] == ["all"]:
+        await update.message.reply_text(INSTANCE_TRANSFER_MESSAGE)
+        return
+
+    await update.message.reply_text("⏳ در حال آماده‌سازی فایل خروجی...")
+    with tempfile.TemporaryDirectory() as directory:
+        counts = await export_deck(user_id, directory)
+        if counts is None:
+            await update.message.reply_text("❌ ساخت خروجی ممکن نشد. لطفاً بعداً دوباره تلاش کنید.")
+            return
+        archive_path = os.path.join(directory, "export.tar.gz")
+        await asyncio.to_thread(write_export_archive, directory, archive_path)
+        if os.path.getsize(archive_path) > TELEGRAM_UPLOAD_MAX_BYTES:
+            logger.warning(f"Export of user {user_id} is larger than {TELEGRAM_UPLOAD_MAX_BYTES} bytes; not sent.")
+            await update.message.reply_text(
+                f"❌ فایل خروجی از {TELEGRAM_UPLOAD_MAX_BYTES // 1000000} مگابایت بزرگ‌تر است و تلگرام اجازه ارسالش را نمی‌دهد. "
+                "لطفاً برای گرفتن خروجی با مدیر ربات تماس بگیرید."
+            )
+            return
+        filename = f"leitner-{user_id}-{datetime.now():%Y%m%d-%H%M}.tar.gz"
+        with open(archive_path, "rb") as archive:
+            await update.message.reply_document(
+                archive,
+                filename=filename,
+                caption=(
+                    f"📦 {counts['messages.csv']} یادداشت و {counts['settings.csv']} تنظیم.\n"
+                    "برای بازگردانی، همین فایل را با کپشن /import بفرستید."
+                ),
+            )
+    logger.info(f"Exported {counts} for user {user_id}.")
+
+@observed_handler
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("📥 برای بازگردانی، فایل خروجی /export را بفرستید و در کپشن آن /import بنویسید.")
+
+@observed_handler
+async def import_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if update.message.caption.split()[1:2] == ["all"]:
+        await update.message.reply_text(INSTANCE_TRANSFER_MESSAGE)
+        return
+    if (update.message.document.file_size or 0) > TELEGRAM_DOWNLOAD_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ ربات‌های تلگرام فقط فایل‌های تا {TELEGRAM_DOWNLOAD_MAX_BYTES // 1000000} مگابایت را می‌توانند دریافت کنند. "
+            "لطفاً برای بازگردانی این فایل با مدیر ربات تماس بگیرید."
+        )
+        return
+
+    await update.message.reply_text("⏳ در حال بازگردانی...")
+    with tempfile.TemporaryDirectory() as directory:
+        archive_path = os.path.join(directory, "import.tar.gz")
+        try:
+            telegram_file = await update.message.document.get_file()
+            await telegram_file.download_to_drive(archive_path)
+            paths = await asyncio.to_thread(extract_import_archive, archive_path, directory, IMPORT_MAX_FILE_BYTES)
+        except (BadRequest, tarfile.TarError, OSError, ValueError) as e:
+            logger.warning(f"Rejected import file from user {user_id}: {e}")
+            await update.message.reply_text("❌ فایل قابل خواندن نیست. لطفاً همان فایل tar.gz که /export ساخته را بفرستید.")
+            return
+        if not paths:
+            await update.message.reply_text("❌ فایل messages.csv یا settings.csv در آرشیو پیدا نشد.")
+            return
+        result = await import_deck(paths, user_id, update.effective_chat.id)
+
+    if result is None:
+        await update.message.reply_text("❌ بازگردانی انجام نشد؛ ساختار فایل معتبر نیست. هیچ تغییری ذخیره نشد.")
+        return
+    await update.message.reply_text(
+        f"✅ بازگردانی انجام شد.\n"
+        f"یادداشت‌های جدید: <b>{result['inserted_messages']}</b> از {result['messages']} "
+        f"(بقیه از قبل وجود داشتند)\nتنظیمات: <b>{result['settings']}</b>",
+        parse_mode=ParseMode.HTML,
+    )
+    logger.info(f"Imported {result} for user {user_id}.")
+
+INSTANCE_TRANSFER_MESSAGE = (
+    "⛔️ خروجی و بازگردانی کل ربات از حد حجم فایل تلگرام بزرگ‌تر است و از چت انجام نمی‌شود.\n"
+    "مدیر می‌تواند روی سرور اجرا کند:\npython main.py export leitner.tar.gz\npython main.py import leitner.tar.gz"
+)
+
+async def transfer_instance(command: str, path: str) -> bool:
+    # خروجی یا بازگردانی کل نمونه از خط فرمان: COPY مستقیماً به فایل‌های روی دیسک (و از آن‌ها) جریان می‌یابد.
+    await open_db_pool()
+    try:
+        await init_db()
+        with tempfile.TemporaryDirectory() as directory:
+            if command == "export":
+                counts = await export_deck(None, directory)
+                if counts is None:
+                    return False
+                await asyncio.to_thread(write_export_archive, directory, path)
+                logger.info(f"Exported {counts} for all users to {path}.")
+                return True
+            try:
+                paths = await asyncio.to_thread(extract_import_archive, path, directory)
+            except (tarfile.TarError, OSError) as e:
+                logger.error(f"Could not read import file {path}: {e}")
+                return False
+            if not paths:
+                logger.error(f"Neither messages.csv nor settings.csv found in {path}.")
+                return False
+            result = await import_deck(paths, None, None)
+            if result is None:
+                return False
+            logger.info(f"Imported {result} for all users from {path}.")
+            return True
+    finally:
+        await close_db_pool()
+
+# =================================================================
+# دستورات مدیریتی (فقط برای YOUR_CHAT_ID)
+# =================================================================
+
+@observed_handler
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = settings_cache.stats()
+    await update.message.reply_text(
+        f"🗂 <b>کش تنظیمات</b>\n\n"
+        f"اندازه: <b>{stats['size']}</b>\n"
+        f"Hit: <b>{stats['hits']}</b> | Miss: <b>{stats['misses']}</b> ({stats['hit_ratio']:.1%})\n"
+        f"Invalidation: <b>{stats['invalidations']}</b>",
+        parse_mode=ParseMode.HTML
+    )
+
+@observed_handler
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /reconcile برای همه کاربران، /reconcile <user_id> فقط برای یک کاربر
+    try:
+        user_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("❌ شناسه کاربر باید عدد باشد.")
+        return
+
+    await update.message.reply_text("⏳ در حال بازسازی شمارنده‌های جعبه‌ها...")
+    if await rebuild_box_counts(user_id):
+        await update.message.reply_text("✅ شمارنده‌ها از روی جدول messages بازسازی شدند.")
+    else:
+        await update.message.reply_text("❌ خطایی در بازسازی شمارنده‌ها رخ داد.")
+
+# =================================================================
+# تابع اصلی
+# =================================================================
+# دکمه‌های منوی اصلی؛ مثل callbackها تکرارشان در صف کاری جز بار اضافه نمی‌سازد.
+MENU_BUTTON_TEXTS = frozenset({"🎲 مرور روزانه", "📊 آمار لایتنر", "📚 نمایش همه", "⚙️ تنظیمات", "❓ راهنما"})
+
+def update_action_key(update: Update) -> str | None:
+    # یادداشت‌ها و دستورها هیچ‌وقت یکی نمی‌شوند؛ فقط دکمه‌ها و callbackها.
+    if update.callback_query and update.callback_query.data:
+        return f"callback:{update.callback_query.data}"
+    if update.message and update.message.text in MENU_BUTTON_TEXTS:
+        return f"button:{update.message.text}"
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # آپدیت‌های کاربران مختلف هم‌زمان پردازش می‌شوند، اما آپدیت‌های هر کاربر به ترتیب رسیدن و پشت سر هم.
+    # دکمه یا callback تکراری که هنوز در صف است، در حال اجراست یا کمتر از USER_DEBOUNCE_SECONDS
+    # از پایانش گذشته دور ریخته می‌شود، و صف هر کاربر سقف دارد.
+    # سمافور PTB پیش از do_process_update گرفته می‌شود و آپدیتی که پشت قفل کاربرش منتظر است هم آن را نگه می‌داشت؛
+    # پس سمافور PTB عملاً نامحدود است و سقف واقعی (slots) فقط برای آپدیتی گرفته می‌شود که قفل کاربرش را دارد.
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.user_locks: dict[int, list] = {}
+        self.recent_actions: set[tuple[int, str]] = set()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+
+        # [قفل، تعداد آپدیت‌های در انتظار، تعداد دکمه/callbackهای در انتظار]؛
+        # قفل کاربری که کاری ندارد حذف می‌شود تا دیکشنری رشد نکند.
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0, 0])
+        action = update_action_key(update)
+        reason = None
+        if action is not None and (key, action) in self.recent_actions:
+            reason = "duplicate"
+        elif action is not None and entry[2] >= USER_MAX_PENDING_ACTIONS:
+            reason = "actions"
+        elif entry[1] >= USER_MAX_PENDING_UPDATES:
+            reason = "backlog"
+        if reason is not None:
+            if entry[1] == 0:
+                del self.user_locks[key]
+            await self.drop_update(update, coroutine, key, reason)
+            return
+
+        entry[1] += 1
+        if action is not None:
+            entry[2] += 1
+            self.recent_actions.add((key, action))
+        try:
+            async with entry[0], self.slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if action is not None:
+                entry[2] -= 1
+                asyncio.get_running_loop().call_later(USER_DEBOUNCE_SECONDS, self.recent_actions.discard, (key, action))
+            if entry[1] == 0:
+                del self.user_locks[key]
+
+    async def drop_update(self, update: Update, coroutine, user_id: int, reason: str) -> None:
+        coroutine.close()
+        updates_dropped.labels(reason).inc()
+        if reason != "duplicate":
+            logger.warning(f"Dropping update {update.update_id} from user {user_id}: too many pending updates ({reason}).")
+        # بدون پاسخ، دکمه شیشه‌ای تا چند ثانیه در حالت بارگذاری می‌ماند.
+        if update.callback_query:
+            try:
+                await update.callback_query.answer()
+            except TelegramError as e:
+                logger.warning(f"Could not answer dropped callback query: {e}")
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def on_startup(application: Application) -> None:
+    await open_db_pool()
+    await init_db()
+    start_settings_listener()
+    start_metrics(application)
+    if RUN_MODE in ("all", "worker"):
+        start_outbox_workers(application.bot)
+
+async def on_shutdown(application: Application) -> None:
+    await user_tasks.stop()
+    await stop_outbox_workers()
+    await stop_metrics()
+    await stop_settings_listener()
+    await close_write_batchers()
+    await close_db_pool()
+
+async def run_worker(application: Application) -> None:
+    # حالت worker آپدیتی از تلگرام نمی‌گیرد؛ فقط job_queue و کارگرهای صف را اجرا می‌کند.
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await stop_event.wait()
+        await application.stop()
+        await on_shutdown(application)
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description="Export or import the whole Leitner instance as a tar.gz of CSV files.")
+        parser.add_argument("command", choices=("export", "import"))
+        parser.add_argument("path")
+        args = parser.parse_args()
+        if not DATABASE_URL:
+            logger.error("FATAL: Missing environment variable: DATABASE_URL")
+            sys.exit(1)
+        sys.exit(0 if asyncio.run(transfer_instance(args.command, args.path)) else 1)
+
+    if not BOT_TOKEN:
+        logger.error("FATAL: Missing environment variable: BOT_TOKEN")
+        return
+    if not DATABASE_URL:
+        logger.error("FATAL: Missing environment variable: DATABASE_URL")
+        return
+    if RUN_MODE not in ("all", "bot", "worker"):
+        logger.error(f"FATAL: Invalid RUN_MODE '{RUN_MODE}' (expected all, bot or worker)")
+        return
+    if not 0 < TELEGRAM_RATE_SHARE <= 1:
+        logger.error(f"FATAL: TELEGRAM_RATE_SHARE must be in (0, 1] (got {TELEGRAM_RATE_SHARE})")
+        return
+    if UPDATE_MODE not in ("polling", "webhook"):
+        logger.error(f"FATAL: Invalid UPDATE_MODE '{UPDATE_MODE}' (expected polling or webhook)")
+        return
+    if UPDATE_MODE == "webhook" and RUN_MODE != "worker" and not WEBHOOK_URL:
+        logger.error("FATAL: Missing environment variable: WEBHOOK_URL (required when UPDATE_MODE=webhook)")
+        return
+        
+    application = build_application()
+
+    if RUN_MODE == "worker":
+        logger.info("Starting Leitner worker (daily reviews + outbox)...")
+        asyncio.run(run_worker(application))
+        return
+
+    if UPDATE_MODE == "webhook":
+        logger.info(f"Starting Leitner System Bot in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        return
+
+    logger.info("Starting Leitner System Bot (Multi-User Edition with Delete Feature)...")
+    application.run_polling()
+
+def build_application() -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = builder.build()
+
+    private_chat_filter = filters.ChatType.PRIVATE
+
+    conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.TEXT & filters.Regex("^⚙️ تنظیمات$") & private_chat_filter, settings_start)],
+        states={AWAITING_REVIEW_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND & private_chat_filter, settings_receive_count)],},
+        fallbacks=[CommandHandler("cancel", settings_cancel, filters=private_chat_filter)],
+    )
+    application.add_handler(conv_handler)
+
+    application.add_handler(CommandHandler("start", start, filters=private_chat_filter))
+    application.add_handler(CommandHandler("timezone", timezone_command, filters=private_chat_filter))
+    application.add_handler(CommandHandler("reviewtime", review_time_command, filters=private_chat_filter))
+    application.add_handler(CommandHandler("export", export_command, filters=private_chat_filter))
+    application.add_handler(CommandHandler("import", import_command, filters=private_chat_filter))
+    application.add_handler(CommandHandler("search", search_command, filters=private_chat_filter))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/import(\s|$)") & private_chat_filter, import_document_handler
+    ))
+    application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    admin_filter = private_chat_filter & filters.User(user_id=YOUR_CHAT_ID)
+    application.add_handler(CommandHandler("cachestats", cache_stats_command, filters=admin_filter))
+    application.add_handler(CommandHandler("reconcile", reconcile_command, filters=admin_filter))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^🎲 مرور روزانه$") & private_chat_filter, handle_review_button))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📊 آمار لایتنر$") & private_chat_filter, stats_menu_handler))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^📚 نمایش همه$") & private_chat_filter, list_all_messages))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^❓ راهنما$") & private_chat_filter, show_help))
+    
+    application.add_handler(CallbackQueryHandler(handle_leitner_callback, pattern="^leitner_"))
+    application.add_handler(CallbackQueryHandler(handle_view_box_callback, pattern="^view_box_"))
+    application.add_handler(CallbackQueryHandler(handle_stats_close_callback, pattern="^stats_close$"))
+    application.add_handler(CallbackQueryHandler(handle_stats_open_callback, pattern="^stats_open$"))
+    application.add_handler(CallbackQueryHandler(handle_show_all_stop_callback, pattern="^showall_stop_"))
+    application.add_handler(CallbackQueryHandler(handle_search_page_callback, pattern="^search_page_"))
+    application.add_handler(CallbackQueryHandler(handle_search_show_callback, pattern="^search_show_"))
+
+    button_texts = ["^🎲 مرور روزانه$", "^📊 آمار لایتنر$", "^📚 نمایش همه$", "^⚙️ تنظیمات$", "^❓ راهنما$"]
+    button_regex = "|".join(button_texts)
+    application.add_handler(MessageHandler(
+        filters.ALL & (~filters.COMMAND) & (~filters.Regex(button_regex)) & private_chat_filter,
+        handle_new_message
+    ))
+
+    if RUN_MODE in ("all", "worker"):
+        job_queue = application.job_queue
+        job_queue.run_repeating(run_review_scheduler, interval=SCHEDULER_TICK_SECONDS, first=10)
+        job_queue.run_repeating(sweep_tombstoned_cards, interval=TOMBSTONE_SWEEP_INTERVAL, first=60)
+        job_queue.run_repeating(sweep_mastered_cards, interval=ARCHIVE_SWEEP_INTERVAL, first=120)
+        job_queue.run_repeating(rollup_review_stats, interval=REVIEW_ROLLUP_INTERVAL, first=30)
+
+    return application
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
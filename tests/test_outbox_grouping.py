@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import main
+
+
+def item(message_id: int, from_chat_id: int = 1, method: str = "copy", with_review_keyboard: bool = False) -> dict:
+    return {
+        "message_id": message_id, "from_chat_id": from_chat_id, "method": method,
+        "with_review_keyboard": with_review_keyboard,
+    }
+
+
+def ids(groups: list) -> list:
+    return [[entry["message_id"] for entry in group] for group in groups]
+
+
+def test_consecutive_plain_items_are_grouped():
+    assert ids(main.group_outbox_items([item(1), item(2), item(5)])) == [[1, 2, 5]]
+
+
+def test_group_breaks_on_source_method_and_keyboard():
+    items = [
+        item(1), item(2, from_chat_id=2), item(3, from_chat_id=2),
+        item(4, from_chat_id=2, method="forward"), item(5, from_chat_id=2, with_review_keyboard=True),
+        item(6, from_chat_id=2),
+    ]
+    assert ids(main.group_outbox_items(items)) == [[1], [2, 3], [4], [5], [6]]
+
+
+def test_group_breaks_where_message_ids_stop_increasing():
+    # Bot API شناسه‌ها را صعودی می‌خواهد؛ ترتیب ارسال نباید عوض شود.
+    assert ids(main.group_outbox_items([item(3), item(7), item(5), item(6), item(6)])) == [[3, 7], [5, 6], [6]]
+
+
+def test_group_size_is_capped(monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_GROUP_SIZE", 2)
+    assert ids(main.group_outbox_items([item(i) for i in range(1, 6)])) == [[1, 2], [3, 4], [5]]
+
+
+def test_grouping_preserves_order():
+    items = [item(i % 7, from_chat_id=i % 3, with_review_keyboard=i % 5 == 0) for i in range(40)]
+    groups = main.group_outbox_items(items)
+    assert [entry for group in groups for entry in group] == items
+    assert main.group_outbox_items([]) == []
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import pytest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+
+import main
+
+
+class FakeClock:
+    # هم time.monotonic و هم asyncio.sleep را جایگزین می‌کند؛ خوابیدن فقط ساعت را جلو می‌برد.
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    monkeypatch.setattr(main.asyncio, "sleep", fake.sleep)
+    return fake
+
+
+def test_bucket_allows_burst_then_spaces_reservations(clock):
+    bucket = main.TokenBucket(rate=2, capacity=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_bucket_refills_over_time_up_to_capacity(clock):
+    bucket = main.TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.reserve()
+    clock.now += 1
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5)
+    clock.now += 100
+    assert bucket.is_idle()
+    assert bucket.tokens == 3
+
+
+def test_priority_skips_the_queue_but_still_spends_a_token(clock):
+    bucket = main.TokenBucket(rate=1, capacity=1)
+    bucket.reserve()
+    assert bucket.reserve(priority=True) == 0.0
+    # کارت بعدی انبوه هزینه رزرو با اولویت را می‌دهد.
+    assert bucket.reserve() == pytest.approx(2.0)
+
+
+def test_pause_holds_every_reservation_until_it_ends(clock):
+    bucket = main.TokenBucket(rate=10, capacity=10)
+    bucket.pause(5)
+    assert bucket.reserve() == pytest.approx(5.0)
+    assert bucket.reserve(priority=True) == pytest.approx(5.0)
+    assert not bucket.is_idle()
+    # توقف کوتاه‌تر، توقف طولانی‌تر قبلی را کوتاه نمی‌کند.
+    bucket.pause(1)
+    clock.now += 2
+    assert bucket.reserve() == pytest.approx(3.0)
+
+
+def test_limiter_waits_for_chat_and_global_buckets(clock):
+    limiter = main.TelegramRateLimiter(global_rate=10, per_chat_rate=1, per_chat_burst=1, max_retries=0)
+
+    async def send(**kwargs):
+        return kwargs["text"]
+
+    async def scenario():
+        return [await limiter.call(1, send, text=str(i)) for i in range(3)]
+
+    assert asyncio.run(scenario()) == ["0", "1", "2"]
+    assert clock.sleeps == [pytest.approx(1.0), pytest.approx(1.0)]
+
+
+def test_retry_after_pauses_buckets_and_retries(clock):
+    limiter = main.TelegramRateLimiter(global_rate=10, per_chat_rate=10, per_chat_burst=10, max_retries=2)
+    attempts = []
+
+    async def send():
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            raise RetryAfter(7)
+        return "sent"
+
+    assert asyncio.run(limiter.call(1, send)) == "sent"
+    assert attempts[1] - attempts[0] == pytest.approx(7.0)
+    # سقف سراسری برای چت‌های دیگر هم متوقف شده بود.
+    assert limiter.global_bucket.paused_until == pytest.approx(attempts[0] + 7)
+
+
+def test_retry_after_is_raised_after_max_retries(clock):
+    limiter = main.TelegramRateLimiter(global_rate=10, per_chat_rate=10, per_chat_burst=10, max_retries=1)
+
+    async def send():
+        raise RetryAfter(3)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.call(1, send))
+
+
+def test_idle_chat_buckets_are_evicted(clock):
+    limiter = main.TelegramRateLimiter(global_rate=10, per_chat_rate=1, per_chat_burst=1, max_retries=0)
+    for chat_id in range(10_000):
+        limiter._chat_bucket(chat_id)
+    limiter._chat_bucket(0).reserve()
+    limiter._chat_bucket(10_000)
+    assert set(limiter.chat_buckets) == {0, 10_000}
+
+
+def test_rendered_cache_evicts_least_recently_used():
+    cache = main.RenderedMessageCache(max_size=2)
+    cache.put(1, 1, ("a", None))
+    cache.put(1, 2, ("b", None))
+    assert cache.get(1, 1) == ("a", None)
+    cache.put(1, 3, ("c", None))
+    assert cache.get(1, 2) is None
+    assert cache.get(1, 1) == ("a", None)
+    cache.forget(1, 1)
+    assert cache.get(1, 1) is None
+    assert cache.get(1, 3) == ("c", None)
+
+
+class FakeQuery:
+    def __init__(self):
+        self.message = type("Message", (), {"chat_id": 5, "message_id": 9, "text": "old"})()
+        self.edits = []
+
+    async def edit_message_text(self, **kwargs):
+        self.edits.append(kwargs["text"])
+
+
+def test_unchanged_edit_is_not_sent(clock, monkeypatch):
+    monkeypatch.setattr(main, "rendered_messages", main.RenderedMessageCache(10))
+    query = FakeQuery()
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("x", callback_data="x")]])
+
+    async def scenario():
+        await main.edit_rendered_message(query, "new", keyboard)
+        await main.edit_rendered_message(query, "new", keyboard)
+        await main.edit_rendered_message(query, "newer", keyboard)
+
+    asyncio.run(scenario())
+    assert query.edits == ["new", "newer"]
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import main
+
+
+def test_each_word_becomes_a_prefix_term():
+    assert main.build_search_query("leitner box") == ("'leitner':* & 'box':*", "%leitner box%")
+
+
+def test_like_wildcards_are_escaped():
+    tsquery, pattern = main.build_search_query("50% off_sale")
+    assert tsquery == "'50':* & 'off_sale':*"
+    assert pattern == "%50\\% off\\_sale%"
+    assert main.build_search_query("a\\b")[1] == "%a\\\\b%"
+
+
+def test_quotes_do_not_reach_the_tsquery():
+    assert main.build_search_query("it's")[0] == "'it':* & 's':*"
+
+
+def test_empty_or_punctuation_only_query_is_rejected():
+    for text in ("", "   ", "...", "%", "!?", "\\", "«»"):
+        assert main.build_search_query(text) is None
+
+
+def test_arabic_letters_and_half_space_are_normalized():
+    tsquery, pattern = main.build_search_query("كتاب‌ها")
+    assert tsquery == "'کتاب':* & 'ها':*"
+    assert pattern == "%کتاب ها%"
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_expired_entry_is_refilled(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    cache = main.SettingsCache(max_size=10, ttl=60)
+    cache.put(1, "daily_limit", "20", overwrite=False)
+    assert cache.get(1, "daily_limit") == (True, "20")
+
+    clock.now += 61
+    assert cache.get(1, "daily_limit") == (False, None)
+    # get_setting بعد از خواندن از دیتابیس با overwrite=False دوباره پر می‌کند.
+    cache.put(1, "daily_limit", "25", overwrite=False)
+    assert cache.get(1, "daily_limit") == (True, "25")
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_refill_does_not_overwrite_fresh_value(monkeypatch):
+    monkeypatch.setattr(main.time, "monotonic", FakeClock())
+    cache = main.SettingsCache(max_size=10, ttl=60)
+    assert cache.get(1, "daily_limit") == (False, None)
+    # set_setting در فاصله خواندن از دیتابیس مقدار تازه‌تری گذاشته است.
+    cache.put(1, "daily_limit", "30")
+    cache.put(1, "daily_limit", "20", overwrite=False)
+    assert cache.get(1, "daily_limit") == (True, "30")
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    monkeypatch.setattr(main.time, "monotonic", FakeClock())
+    cache = main.SettingsCache(max_size=2, ttl=60)
+    cache.put(1, "a", "1")
+    cache.put(2, "a", "2")
+    cache.get(1, "a")
+    cache.put(3, "a", "3")
+    assert cache.get(2, "a") == (False, None)
+    assert cache.get(1, "a") == (True, "1")
+    assert cache.get(3, "a") == (True, "3")
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+from telegram import Update
+
+import fake_telegram
+import main
+
+
+def note(user_id: int, message_id: int) -> Update:
+    return Update.de_json(fake_telegram.message_update(user_id, message_id, f"note {message_id}"), None)
+
+
+async def handle(started: dict, finished: dict, name, seconds: float) -> None:
+    started[name] = time.perf_counter()
+    await asyncio.sleep(seconds)
+    finished[name] = time.perf_counter()
+
+
+def test_waiting_updates_do_not_hold_slots():
+    # ۱۰ یادداشت پشت سر هم از یک کاربر نباید کاربر دیگر را پشت صف خودش نگه دارد.
+    async def scenario():
+        processor = main.PerUserUpdateProcessor(4)
+        started, finished = {}, {}
+        tasks = [
+            asyncio.create_task(processor.process_update(note(1, i), handle(started, finished, i, 0.2)))
+            for i in range(10)
+        ]
+        await asyncio.sleep(0.01)
+        other_sent = time.perf_counter()
+        await processor.process_update(note(2, 1), handle(started, finished, "other", 0.01))
+        other_elapsed = time.perf_counter() - other_sent
+        await asyncio.gather(*tasks)
+        return other_elapsed, started
+
+    other_elapsed, started = asyncio.run(scenario())
+    assert other_elapsed < 0.1
+    # آپدیت‌های یک کاربر همچنان به ترتیب رسیدن اجرا می‌شوند.
+    assert [started[i] for i in range(10)] == sorted(started[i] for i in range(10))
+
+
+def test_slots_limit_running_updates():
+    async def scenario():
+        processor = main.PerUserUpdateProcessor(2)
+        running = peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(note(user_id, 1), work()) for user_id in range(6)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2
+
+
+def menu_button(user_id: int, text: str) -> Update:
+    return Update.de_json(fake_telegram.message_update(user_id, 1, text), None)
+
+
+def dropped(reason: str) -> float:
+    return main.updates_dropped.labels(reason)._value.get()
+
+
+def run_blocked_behind_first(processor, updates: list) -> list:
+    # اولین آپدیت تا آخر منتظر می‌ماند تا بقیه در صف همان کاربر جمع شوند؛ خروجی: آپدیت‌هایی که اجرا شدند
+    async def scenario():
+        release = asyncio.Event()
+        ran = []
+
+        async def work(index: int):
+            ran.append(index)
+            if index == 0:
+                await release.wait()
+
+        tasks = [asyncio.create_task(processor.process_update(update, work(i))) for i, update in enumerate(updates)]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+        return ran
+
+    return asyncio.run(scenario())
+
+
+def test_backlog_cap_drops_updates_beyond_limit(monkeypatch):
+    # سقف از سمافور هم‌زمانی بزرگ‌تر است تا معلوم شود شمارش پیش از گرفتن سهم انجام می‌شود.
+    monkeypatch.setattr(main, "USER_MAX_PENDING_UPDATES", 5)
+    processor = main.PerUserUpdateProcessor(2)
+    before = dropped("backlog")
+    ran = run_blocked_behind_first(processor, [note(10, i) for i in range(8)])
+    assert ran == [0, 1, 2, 3, 4]
+    assert dropped("backlog") - before == 3
+    assert processor.user_locks == {}
+
+
+def test_action_cap_and_duplicates_are_dropped(monkeypatch):
+    monkeypatch.setattr(main, "USER_MAX_PENDING_ACTIONS", 2)
+    monkeypatch.setattr(main, "USER_DEBOUNCE_SECONDS", 0)
+    processor = main.PerUserUpdateProcessor(2)
+    before_actions, before_duplicates = dropped("actions"), dropped("duplicate")
+    updates = [
+        note(11, 1),
+        menu_button(11, "📊 آمار لایتنر"),
+        menu_button(11, "📊 آمار لایتنر"),
+        menu_button(11, "❓ راهنما"),
+        menu_button(11, "⚙️ تنظیمات"),
+        note(11, 2),
+    ]
+    ran = run_blocked_behind_first(processor, updates)
+    assert ran == [0, 1, 3, 5]
+    assert dropped("duplicate") - before_duplicates == 1
+    assert dropped("actions") - before_actions == 1
+
+
+def handler_counts() -> dict:
+    return {
+        sample.labels["handler"]: sample.value for sample in main.handler_latency.collect()[0].samples
+        if sample.name.endswith("_count")
+    }
+
+
+def test_stats_callback_is_observed_once(monkeypatch):
+    async def build_stats_menu(user_id):
+        return "stats", None
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(main, "build_stats_menu", build_stats_menu)
+    query = SimpleNamespace(answer=noop, message=SimpleNamespace(edit_text=noop))
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=None, callback_query=query)
+    before = handler_counts()
+    asyncio.run(main.handle_stats_open_callback(update, None))
+    after = handler_counts()
+    assert after["handle_stats_open_callback"] - before.get("handle_stats_open_callback", 0) == 1
+    assert after.get("stats_menu_handler", 0) == before.get("stats_menu_handler", 0)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import psycopg
+
+import main
+
+
+def test_repeated_keys_land_in_later_rounds_in_order():
+    keys = [(1, 10), (1, 11), (1, 10), (2, 10), (1, 10), (1, 11)]
+    rounds = main.split_into_rounds(keys)
+    assert rounds == [[0, 1, 3], [2, 5], [4]]
+    for indexes in rounds:
+        round_keys = [keys[i] for i in indexes]
+        assert len(round_keys) == len(set(round_keys))
+    # تکرارهای هر کلید به ترتیب رسیدن در دسته‌های پشت سر هم می‌آیند.
+    for key in set(keys):
+        occurrences = [i for i, k in enumerate(keys) if k == key]
+        round_of = {i: n for n, indexes in enumerate(rounds) for i in indexes}
+        assert [round_of[i] for i in occurrences] == list(range(len(occurrences)))
+
+
+def test_distinct_keys_share_one_round():
+    assert main.split_into_rounds([(1, 1), (1, 2), (2, 1)]) == [[0, 1, 2]]
+    assert main.split_into_rounds([]) == []
+
+
+def test_batch_flushes_when_full_and_routes_results():
+    batches = []
+
+    async def flush(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    async def scenario():
+        batcher = main.WriteBatcher("test", flush, max_batch=3, max_delay=60)
+        futures = [batcher.submit(i) for i in range(1, 4)]
+        return await asyncio.gather(*futures)
+
+    assert asyncio.run(scenario()) == [10, 20, 30]
+    assert batches == [[1, 2, 3]]
+
+
+def test_partial_batch_flushes_after_delay():
+    batches = []
+
+    async def flush(items):
+        batches.append(list(items))
+        return [True] * len(items)
+
+    async def scenario():
+        batcher = main.WriteBatcher("test", flush, max_batch=100, max_delay=0.01)
+        first, second = batcher.submit("a"), batcher.submit("b")
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+
+    asyncio.run(scenario())
+    assert batches == [["a", "b"]]
+
+
+def test_deadlock_is_retried_once_then_reported_to_every_caller():
+    calls = 0
+
+    async def flush(items):
+        nonlocal calls
+        calls += 1
+        raise psycopg.errors.DeadlockDetected("deadlock")
+
+    async def scenario():
+        batcher = main.WriteBatcher("test", flush, max_batch=2, max_delay=60)
+        futures = [batcher.submit(i) for i in range(2)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert calls == 2
+    assert all(isinstance(result, psycopg.errors.DeadlockDetected) for result in results)